@@ -0,0 +1,211 @@
+import os
+import math
+import faiss
+import numpy as np
+from typing import Optional
+
+# flat: 精确检索；ivf_flat: 倒排+原始向量；hnsw: 图索引；ivf_pq: 倒排+乘积量化（内存最小）
+INDEX_TYPES = ('flat', 'ivf_flat', 'hnsw', 'ivf_pq')
+
+# 向量存储精度（flat/hnsw/ivf_flat有效，ivf_pq本身已量化）：fp32原始向量；
+# fp16半精度，内存减半；sq8每维8位标量量化，内存约为1/4，需要在样本上训练每维的取值范围
+STORAGE_TYPES = ('fp32', 'fp16', 'sq8')
+_SQ_TYPES = {'fp16': faiss.ScalarQuantizer.QT_fp16, 'sq8': faiss.ScalarQuantizer.QT_8bit}
+
+# sq8训练取值范围所需的最少向量数
+SQ8_MIN_TRAIN = 1000
+
+
+def index_spec_from_env() -> dict:
+    """从环境变量读取索引配置，nlist为0时训练时按数据量自动选择"""
+    return {
+        'type': os.getenv("VECTOR_INDEX_TYPE", "flat"),
+        'nlist': int(os.getenv("VECTOR_INDEX_NLIST", "0")),
+        'nprobe': int(os.getenv("VECTOR_INDEX_NPROBE", "16")),
+        'hnsw_m': int(os.getenv("VECTOR_INDEX_HNSW_M", "32")),
+        'ef_construction': int(os.getenv("VECTOR_INDEX_EF_CONSTRUCTION", "200")),
+        'ef_search': int(os.getenv("VECTOR_INDEX_EF_SEARCH", "64")),
+        'pq_m': int(os.getenv("VECTOR_INDEX_PQ_M", "16")),
+        'storage': os.getenv("VECTOR_INDEX_STORAGE", "fp32"),
+        'train_size': int(os.getenv("VECTOR_INDEX_TRAIN_SIZE", "100000"))
+    }
+
+
+def normalize_spec(spec: dict) -> dict:
+    spec = {**index_spec_from_env(), **(spec or {})}
+    if spec['type'] not in INDEX_TYPES:
+        raise ValueError(f"不支持的索引类型: {spec['type']}，可选: {', '.join(INDEX_TYPES)}")
+    if spec['storage'] not in STORAGE_TYPES:
+        raise ValueError(f"不支持的向量存储精度: {spec['storage']}，可选: {', '.join(STORAGE_TYPES)}")
+    return spec
+
+
+def storage_type(spec: dict) -> str:
+    """实际的向量存储方式，ivf_pq固定为乘积量化"""
+    return 'pq' if spec['type'] == 'ivf_pq' else spec['storage']
+
+
+def needs_training(spec: dict) -> bool:
+    return spec['type'] in ('ivf_flat', 'ivf_pq') or storage_type(spec) == 'sq8'
+
+
+def fallback_spec(spec: dict) -> dict:
+    """训练数据不足时使用的精确索引（fp16无需训练，可以保留）"""
+    return dict(spec, type='flat', storage='fp16' if storage_type(spec) == 'fp16' else 'fp32')
+
+
+def auto_nlist(count: int) -> int:
+    return int(min(65536, max(16, 4 * math.sqrt(count))))
+
+
+def min_train_size(spec: dict, count: int) -> int:
+    """训练所需的最少向量数（每个聚类中心约39个样本，PQ码本需要256个中心）"""
+    size = SQ8_MIN_TRAIN if storage_type(spec) == 'sq8' else 0
+    if spec['type'] in ('ivf_flat', 'ivf_pq'):
+        size = max(size, 39 * (spec['nlist'] or auto_nlist(count)))
+    if spec['type'] == 'ivf_pq':
+        size = max(size, 39 * 256)
+    return size
+
+
+def build_index(spec: dict, dimension: int, train_vectors: np.ndarray = None) -> faiss.Index:
+    """按配置创建索引（内积相似度）
+
+    flat和hnsw外包IndexIDMap2以支持自定义向量ID；IVF自身支持按ID添加和删除，
+    并开启哈希直接映射以支持按ID取回向量。需要训练的类型必须提供train_vectors。
+    """
+    index_type = spec['type']
+    storage = storage_type(spec)
+    if needs_training(spec):
+        if train_vectors is None or len(train_vectors) == 0:
+            raise ValueError(f"{index_type}（{storage}）索引需要训练数据")
+        train_vectors = np.ascontiguousarray(train_vectors, dtype=np.float32)
+
+    if index_type in ('flat', 'hnsw'):
+        if index_type == 'flat' and storage == 'fp32':
+            inner = faiss.IndexFlatIP(dimension)
+        elif index_type == 'flat':
+            inner = faiss.IndexScalarQuantizer(dimension, _SQ_TYPES[storage], faiss.METRIC_INNER_PRODUCT)
+        elif storage == 'fp32':
+            inner = faiss.IndexHNSWFlat(dimension, spec['hnsw_m'], faiss.METRIC_INNER_PRODUCT)
+        else:
+            inner = faiss.IndexHNSWSQ(dimension, _SQ_TYPES[storage], spec['hnsw_m'], faiss.METRIC_INNER_PRODUCT)
+        if index_type == 'hnsw':
+            inner.hnsw.efConstruction = spec['ef_construction']
+        if not inner.is_trained:
+            inner.train(train_vectors)
+        index = faiss.IndexIDMap2(inner)
+        configure_search(index, spec)
+        return index
+
+    nlist = spec['nlist'] or auto_nlist(len(train_vectors))
+    quantizer = faiss.IndexFlatIP(dimension)
+    if index_type == 'ivf_pq':
+        pq_m = spec['pq_m']
+        if dimension % pq_m:
+            raise ValueError(f"向量维度 {dimension} 不能被 pq_m={pq_m} 整除")
+        index = faiss.IndexIVFPQ(quantizer, dimension, nlist, pq_m, 8, faiss.METRIC_INNER_PRODUCT)
+    elif storage == 'fp32':
+        index = faiss.IndexIVFFlat(quantizer, dimension, nlist, faiss.METRIC_INNER_PRODUCT)
+    else:
+        index = faiss.IndexIVFScalarQuantizer(quantizer, dimension, nlist, _SQ_TYPES[storage],
+                                              faiss.METRIC_INNER_PRODUCT)
+
+    index.train(train_vectors)
+    index.own_fields = True
+    quantizer.this.disown()
+    configure_search(index, spec)
+    return index
+
+
+def sample_rows(count: int, size: int, seed: int = 0) -> np.ndarray:
+    if count <= size:
+        return np.arange(count)
+    return np.sort(np.random.default_rng(seed).choice(count, size, replace=False))
+
+
+def _inner(index: faiss.Index) -> faiss.Index:
+    if isinstance(index, (faiss.IndexIDMap, faiss.IndexIDMap2)):
+        return faiss.downcast_index(index.index)
+    return faiss.downcast_index(index)
+
+
+def index_type(index: faiss.Index) -> str:
+    """识别已加载索引的类型"""
+    inner = _inner(index)
+    if isinstance(inner, faiss.IndexHNSW):
+        return 'hnsw'
+    if isinstance(inner, faiss.IndexIVFPQ):
+        return 'ivf_pq'
+    if isinstance(inner, faiss.IndexIVF):
+        return 'ivf_flat'
+    return 'flat'
+
+
+def index_storage(index: faiss.Index) -> str:
+    """识别已加载索引的向量存储方式（fp32/fp16/sq8/pq）"""
+    inner = _inner(index)
+    if isinstance(inner, faiss.IndexIVFPQ):
+        return 'pq'
+    if isinstance(inner, faiss.IndexHNSW):
+        inner = faiss.downcast_index(inner.storage)
+    if isinstance(inner, (faiss.IndexScalarQuantizer, faiss.IndexIVFScalarQuantizer)):
+        return next((name for name, qtype in _SQ_TYPES.items() if qtype == inner.sq.qtype), 'sq')
+    return 'fp32'
+
+
+def matches_spec(index: faiss.Index, spec: dict) -> bool:
+    """索引是否已经是spec配置的类型和存储方式（未训练时为精确索引）"""
+    return index_type(index) == spec['type'] and index_storage(index) == storage_type(spec)
+
+
+def configure_search(index: faiss.Index, spec: dict):
+    """设置检索参数（nprobe / efSearch），IVF同时确保可以按ID取回向量"""
+    inner = _inner(index)
+    if isinstance(inner, faiss.IndexIVF):
+        inner.nprobe = spec['nprobe']
+        if inner.direct_map.type != faiss.DirectMap.Hashtable:
+            inner.set_direct_map_type(faiss.DirectMap.Hashtable)
+    elif isinstance(inner, faiss.IndexHNSW):
+        inner.hnsw.efSearch = spec['ef_search']
+
+
+def search_params(index: faiss.Index, spec: dict, selector=None) -> Optional[faiss.SearchParameters]:
+    """生成带过滤条件的检索参数，IVF/HNSW需要使用对应的参数类型，否则会丢失nprobe/efSearch"""
+    if selector is None:
+        return None
+
+    inner = _inner(index)
+    if isinstance(inner, faiss.IndexIVF):
+        return faiss.SearchParametersIVF(sel=selector, nprobe=spec['nprobe'])
+    if isinstance(inner, faiss.IndexHNSW):
+        return faiss.SearchParametersHNSW(sel=selector, efSearch=spec['ef_search'])
+    return faiss.SearchParameters(sel=selector)
+
+
+def supports_remove(index: faiss.Index) -> bool:
+    """HNSW不支持删除，只能标记删除，等重建时再清理"""
+    return not isinstance(_inner(index), faiss.IndexHNSW)
+
+
+def stored_ids(index: faiss.Index) -> np.ndarray:
+    """IndexIDMap中实际保存的全部向量ID（包括HNSW中已标记删除的）"""
+    if isinstance(index, (faiss.IndexIDMap, faiss.IndexIDMap2)):
+        return faiss.vector_to_array(index.id_map).astype(np.int64)
+    return np.zeros(0, dtype=np.int64)
+
+
+def read_index(file_path: str, mmap: bool = False) -> faiss.Index:
+    """读取索引文件
+
+    mmap为True时向量数据以只读方式内存映射，不复制到进程堆内存，多个工作进程共享同一份页缓存；
+    这样加载的索引不能直接修改（FAISS会直接中止进程），写入前需要用writable_copy复制一份。
+    """
+    if mmap:
+        return faiss.read_index(file_path, faiss.IO_FLAG_MMAP_IFC | faiss.IO_FLAG_READ_ONLY)
+    return faiss.read_index(file_path)
+
+
+def writable_copy(index: faiss.Index) -> faiss.Index:
+    """把内存映射的只读索引复制到进程内存中"""
+    return faiss.deserialize_index(faiss.serialize_index(index))
@@ -1,10 +1,15 @@
 from flask import Flask, render_template, request, jsonify, redirect, url_for, flash, Response
 from flask_login import LoginManager, UserMixin, login_user, login_required, logout_user, current_user
 from flask_sqlalchemy import SQLAlchemy
-from langchain_community.document_loaders import PyPDFLoader, Docx2txtLoader, TextLoader
 from model_utils import DeepSeekApiRag
+from job_queue import BackgroundJobQueue
+from ingestion import file_sha256
 import os
-from datetime import datetime
+import json
+import time
+import socket
+import threading
+from datetime import datetime, timedelta
 import uuid
 from dotenv import load_dotenv
 from werkzeug.security import generate_password_hash, check_password_hash
@@ -19,7 +24,8 @@ app.config['SQLALCHEMY_DATABASE_URI'] = os.getenv('DATABASE_URL', 'sqlite:///use
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
 app.config['UPLOAD_FOLDER'] = os.path.join(app.root_path, 'uploads')
 app.config['KNOWLEDGE_BASE_FOLDER'] = os.path.join(app.root_path, 'knowledge_base')  # 新增知识库文件夹配置
-app.config['MAX_CONTENT_LENGTH'] = 10 * 1024 * 1024
+# 上传文件大小上限（MB），文件流式入库，可以按需调大
+app.config['MAX_CONTENT_LENGTH'] = int(os.getenv('MAX_UPLOAD_SIZE_MB', '10')) * 1024 * 1024
 
 # 确保上传文件夹和知识库文件夹存在
 os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
@@ -80,6 +86,7 @@ class Chat(db.Model):
     # 关联消息和知识库
     messages = db.relationship('Message', backref='chat', lazy=True, cascade="all, delete-orphan")
     knowledge_base = db.relationship('KnowledgeBase', backref='chats')
+    memory_reset = db.relationship('ChatMemoryReset', backref='chat', uselist=False, cascade="all, delete-orphan")
 
 
 # 消息模型
@@ -91,6 +98,13 @@ class Message(db.Model):
     created_at = db.Column(db.DateTime, default=datetime.now)
 
 
+# 对话记忆清空位置：对话记忆从消息表重新加载时只读取该消息之后的消息
+class ChatMemoryReset(db.Model):
+    chat_id = db.Column(db.Integer, db.ForeignKey('chat.id'), primary_key=True)
+    after_message_id = db.Column(db.Integer, nullable=False, default=0)
+    created_at = db.Column(db.DateTime, default=datetime.now)
+
+
 # 上传文档模型
 class UploadedDocument(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -102,6 +116,43 @@ class UploadedDocument(db.Model):
     file_size = db.Column(db.Integer, nullable=False)  # 文件大小
     uploaded_at = db.Column(db.DateTime, default=datetime.now)  # 上传时间
 
+    # 关联入库任务（旧数据没有任务记录，视为已入库）
+    ingestion_job = db.relationship('IngestionJob', backref='document', uselist=False, cascade="all, delete-orphan")
+
+
+# 入库任务模型：上传后立即记录，由后台工作线程解析、嵌入并写入向量数据库
+class IngestionJob(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    document_id = db.Column(db.Integer, db.ForeignKey('uploaded_document.id'), nullable=False, unique=True)
+    status = db.Column(db.String(20), nullable=False, default='queued')  # queued/parsing/embedding/indexed/failed
+    attempts = db.Column(db.Integer, nullable=False, default=0)  # 已尝试次数
+    chunks = db.Column(db.Integer, nullable=False, default=0)  # 已入库的文本块数量
+    error = db.Column(db.Text)  # 最近一次失败原因
+    worker = db.Column(db.String(100))  # 认领该任务的进程（主机名:进程号），排队和结束时为空
+    lease_until = db.Column(db.DateTime)  # 认领的租约到期时间，处理期间每次更新状态时续约
+    created_at = db.Column(db.DateTime, default=datetime.now)
+    updated_at = db.Column(db.DateTime, default=datetime.now, onupdate=datetime.now)
+
+    def to_dict(self):
+        return {
+            'job_id': self.id,
+            'document_id': self.document_id,
+            'filename': self.document.filename if self.document else None,
+            'status': self.status,
+            'attempts': self.attempts,
+            'chunks': self.chunks,
+            'error': self.error,
+            'updated_at': self.updated_at.isoformat() if self.updated_at else None
+        }
+
+
+# 待删除的文档向量：删除文档或知识库时与数据库修改一起提交，由写入进程从向量数据库中删除后移除记录
+class VectorDeletion(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    document_id = db.Column(db.Integer)  # 为空表示删除整个知识库索引
+    knowledge_base_id = db.Column(db.Integer)
+    created_at = db.Column(db.DateTime, default=datetime.now)
+
 
 @login_manager.user_loader
 def load_user(user_id):
@@ -113,15 +164,60 @@ api_key = os.getenv("DEEPSEEK_API_KEY")
 db_path = os.getenv("VECTOR_DB_PATH", "law_faiss")
 
 
+def load_conversation_history(conversation_id, limit):
+    """从消息表读取对话最近的消息，用于对话记忆被淘汰或服务重启后恢复上下文
+
+    只读取上次清空记忆之后的消息；开头的助手消息（新建对话时的问候语）不属于对话记忆，跳过。
+    可能在流式响应的生成器中调用，因此使用独立的应用上下文。
+    """
+    try:
+        chat_id = int(conversation_id.split('_', 1)[1])
+    except (IndexError, ValueError):
+        return []
+
+    with app.app_context():
+        query = Message.query.filter_by(chat_id=chat_id)
+        reset = ChatMemoryReset.query.get(chat_id)
+        if reset:
+            query = query.filter(Message.id > reset.after_message_id)
+        messages = query.order_by(Message.id.desc()).limit(limit).all()
+        history = [('assistant' if message.role == 'bot' else 'user', message.content)
+                   for message in reversed(messages)]
+
+    while history and history[0][0] == 'assistant':
+        history.pop(0)
+    return history
+
+
 def initialize_vector_database():
-    """初始化向量数据库，自动处理knowledge_base文件夹"""
+    """初始化向量数据库，自动处理knowledge_base文件夹
+
+    多进程部署（gunicorn/uvicorn多个工作进程）时，向量库只由一个进程写入：取得写锁的进程（写入进程）
+    处理全部入库任务和向量删除，其他进程只读，只在数据库中记录入库任务和待删除的向量（VectorDeletion），
+    检索前发现写入进程保存了新数据时重新加载（见DeepSeekApiRag.refresh_vector_db）。
+    写入进程在处理第一个请求时选出（见start_ingestion_queue），它退出后由下一个取得写锁的进程接替。
+    启动时的构建和元数据补充也需要写锁，同时启动的进程中只有一个执行，完成后释放写锁。
+    """
     global rag_model
 
     # 初始化RAG模型
     rag_model = DeepSeekApiRag(api_key, db_path)
+    rag_model.memory.history_loader = load_conversation_history
+
+    if not rag_model.acquire_writer():
+        print("向量数据库正由其他进程写入，本进程只读")
+        return
+    try:
+        build_vector_database()
+    finally:
+        # 调试模式下重载器的父进程也会执行到这里，写锁留给实际处理请求的进程
+        rag_model.release_writer()
 
+
+def build_vector_database():
+    """向量数据库不存在时构建，已存在时为旧数据补充元数据（调用方持有写锁）"""
     # 检查向量数据库是否已存在
-    if not os.path.exists(db_path):
+    if rag_model.vector_db is None:
         print("向量数据库不存在，开始构建...")
 
         # 首先处理knowledge_base文件夹
@@ -135,46 +231,342 @@ def initialize_vector_database():
 
         # 然后处理已上传的文档（从数据库记录）
         with app.app_context():
-            all_docs = UploadedDocument.query.all()
+            # 后台任务尚未完成的文档由任务队列处理，入库失败的文档不再重复解析
+            all_docs = [doc for doc in UploadedDocument.query.all()
+                        if doc.ingestion_job is None or doc.ingestion_job.status == 'indexed']
             if all_docs:
                 print("正在处理已上传的文档...")
-                # 收集所有文本一次性处理
-                all_texts = []
-                for doc in all_docs:
-                    if os.path.exists(doc.file_path):
-                        try:
-                            # 支持TXT文件
-                            if doc.file_path.lower().endswith('.pdf'):
-                                loader = PyPDFLoader(doc.file_path)
-                            elif doc.file_path.lower().endswith(('.doc', '.docx')):
-                                loader = Docx2txtLoader(doc.file_path)
-                            elif doc.file_path.lower().endswith('.txt'):
-                                loader = TextLoader(doc.file_path, encoding='utf-8')
-                            else:
-                                continue
-
-                            pages = loader.load()
-                            documents = rag_model.text_splitter.split_documents(pages)
-                            texts = [doc.page_content for doc in documents]
-                            all_texts.extend(texts)
-                            print(f"已读取文档: {doc.filename}, {len(texts)} 个文本块")
-                        except Exception as e:
-                            print(f"处理文档 {doc.filename} 失败: {e}")
-
-                # 一次性添加所有文本
-                if all_texts:
-                    rag_model.add_documents(all_texts)
-                    print(f"已上传文档处理完成，共 {len(all_texts)} 个文本块")
+                # 并行解析全部文档并一次性添加，每个文本块标记所属文档、知识库和用户
+                rag_model.add_files([
+                    (doc.file_path, {
+                        'doc_id': doc.id,
+                        'kb_id': doc.knowledge_base_id,
+                        'user_id': doc.user_id,
+                        'source': doc.filename
+                    })
+                    for doc in all_docs
+                ])
+                print("已上传文档处理完成")
     else:
         print("向量数据库已存在，跳过初始化构建")
 
+        # 为旧数据补充知识库和用户元数据，使按知识库过滤检索生效
+        with app.app_context():
+            updated = 0
+            for doc in UploadedDocument.query.all():
+                updated += rag_model.tag_document(
+                    doc.id,
+                    save_to_disk=False,
+                    kb_id=doc.knowledge_base_id,
+                    user_id=doc.user_id,
+                    source=doc.filename
+                )
+            if updated:
+                rag_model.save_vector_db()
+                print(f"已为 {updated} 个文档块补充元数据")
+
+
+def add_missing_columns():
+    """db.create_all不会修改已有的表：给旧数据库的ingestion_job表补上后来增加的列"""
+    existing = {column['name'] for column in db.inspect(db.engine).get_columns(IngestionJob.__tablename__)}
+    for column in IngestionJob.__table__.columns:
+        if column.name in existing:
+            continue
+        column_type = column.type.compile(dialect=db.engine.dialect)
+        try:
+            with db.engine.begin() as conn:
+                conn.execute(db.text(f"ALTER TABLE {IngestionJob.__tablename__} ADD COLUMN {column.name} {column_type}"))
+            print(f"已为 {IngestionJob.__tablename__} 表添加列: {column.name}")
+        except Exception as e:
+            # 多个工作进程同时启动时，其他进程可能已经添加
+            print(f"添加列 {column.name} 失败: {e}")
+
 
 # 创建数据库表和初始化向量数据库
 with app.app_context():
     db.create_all()
+    add_missing_columns()
     initialize_vector_database()
 
 
+# 后台入库任务
+INGEST_MAX_ATTEMPTS = int(os.getenv('INGEST_MAX_ATTEMPTS', '3'))
+INGEST_RETRY_DELAY = float(os.getenv('INGEST_RETRY_DELAY', '10'))
+# 超过该大小的文件单独流式入库，较小的文件合并成一批嵌入
+INGEST_STREAM_THRESHOLD = int(os.getenv('INGEST_STREAM_THRESHOLD_MB', '5')) * 1024 * 1024
+# 认领任务的租约：处理中的任务超过这个时间没有更新状态，视为处理它的进程已退出，可由接替的写入进程接管
+INGEST_LEASE_SECONDS = float(os.getenv('INGEST_LEASE_SECONDS', '600'))
+# 写入进程检查其他进程提交的入库任务和待删除向量的间隔（秒）
+INGEST_POLL_INTERVAL = float(os.getenv('INGEST_POLL_INTERVAL', '2'))
+ACTIVE_JOB_STATUSES = ('queued', 'parsing', 'embedding')
+PROCESSING_JOB_STATUSES = ('parsing', 'embedding')
+
+
+def ingestion_worker_id():
+    """当前进程的标识（多个工作进程、多台服务器共用一个数据库时区分任务归属）"""
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
+def claim_ingestion_job(job_id):
+    """认领排队中的任务：只有成功把状态从queued改为parsing的一方处理该任务，
+    同一任务被重复提交（上传、重试定时器、启动时恢复、轮询）也只会处理一次"""
+    now = datetime.now()
+    claimed = IngestionJob.query.filter_by(id=job_id, status='queued').update({
+        'status': 'parsing',
+        'worker': ingestion_worker_id(),
+        'lease_until': now + timedelta(seconds=INGEST_LEASE_SECONDS),
+        'updated_at': now
+    })
+    db.session.commit()
+    return claimed == 1
+
+
+def update_ingestion_job(job_id, **fields):
+    """更新本进程认领的任务：处理中的状态更新同时续约，重新排队或结束时释放认领
+
+    文档在处理期间被删除（任务记录已不存在），或租约过期后任务已被其他进程接管时，更新不生效。
+    """
+    now = datetime.now()
+    fields['updated_at'] = now
+    if fields.get('status') in ('queued', 'indexed', 'failed'):
+        fields.update(worker=None, lease_until=None)
+    else:
+        fields['lease_until'] = now + timedelta(seconds=INGEST_LEASE_SECONDS)
+    IngestionJob.query.filter_by(id=job_id, worker=ingestion_worker_id()).update(fields)
+    db.session.commit()
+
+
+def fail_ingestion_job(job, error, retry=True):
+    """记录失败，未超过最大尝试次数时延迟重新入队"""
+    print(f"入库任务 {job['id']}（文档 {job['doc_id']}）失败: {error}")
+    if retry and job['attempts'] < INGEST_MAX_ATTEMPTS:
+        update_ingestion_job(job['id'], status='queued', chunks=0, error=str(error))
+        ingestion_queue.submit(job['id'], delay=INGEST_RETRY_DELAY * job['attempts'])
+    else:
+        update_ingestion_job(job['id'], status='failed', chunks=0, error=str(error))
+
+
+def process_ingestion_jobs(job_ids):
+    """处理一批入库任务：小文件并行解析、合并嵌入后一次写入索引，大文件逐个流式入库
+
+    只处理本次认领成功的任务。任务和文档信息先复制出来，处理期间文档被删除也不会影响后续的状态更新。
+    """
+    with app.app_context():
+        try:
+            claimed_ids = [job_id for job_id in job_ids if claim_ingestion_job(job_id)]
+            jobs = []
+            for job in IngestionJob.query.filter(IngestionJob.id.in_(claimed_ids)).all():
+                doc = job.document
+                jobs.append({
+                    'id': job.id,
+                    'attempts': job.attempts + 1,
+                    'doc_id': doc.id,
+                    'file_path': doc.file_path,
+                    'file_size': doc.file_size,
+                    'metadata': {
+                        'doc_id': doc.id,
+                        'kb_id': doc.knowledge_base_id,
+                        'user_id': doc.user_id,
+                        'source': doc.filename
+                    }
+                })
+
+            batch, streaming = [], []
+            file_paths = set()
+            for job in jobs:
+                if job['file_path'] in file_paths:
+                    # 同一批中内容相同的文件：等前一个入库后再处理，届时直接引用已有向量
+                    update_ingestion_job(job['id'], status='queued')
+                    ingestion_queue.submit(job['id'], delay=INGEST_RETRY_DELAY)
+                    continue
+                file_paths.add(job['file_path'])
+
+                if not os.path.exists(job['file_path']):
+                    update_ingestion_job(job['id'], attempts=job['attempts'])
+                    fail_ingestion_job(job, '文件不存在', retry=False)
+                    continue
+
+                update_ingestion_job(job['id'], attempts=job['attempts'], error=None)
+                # 大文件，以及独立知识库索引模式下属于知识库的文件，走单文件流式入库
+                if job['file_size'] > INGEST_STREAM_THRESHOLD or (
+                        job['metadata']['kb_id'] and rag_model.kb_index_mode == 'separate'):
+                    streaming.append(job)
+                else:
+                    batch.append(job)
+
+            if batch:
+                ingest_job_batch(batch)
+            for job in streaming:
+                ingest_job_streaming(job)
+        finally:
+            db.session.remove()
+
+
+def ingest_job_batch(batch):
+    jobs_by_path = {job['file_path']: job for job in batch}
+    parse_errors = {}
+
+    def on_parsed(file_path, chunks, error):
+        job = jobs_by_path[file_path]
+        if error is not None:
+            parse_errors[job['id']] = error
+        else:
+            update_ingestion_job(job['id'], status='embedding', chunks=chunks)
+
+    try:
+        rag_model.add_files([(job['file_path'], job['metadata']) for job in batch], on_parsed=on_parsed)
+    except Exception as e:
+        # 嵌入或写索引失败：回滚这一批已写入的向量后重试
+        for job in batch:
+            if job['id'] not in parse_errors:
+                rag_model.delete_document(job['doc_id'])
+                fail_ingestion_job(job, e)
+    else:
+        for job in batch:
+            if job['id'] not in parse_errors:
+                update_ingestion_job(job['id'], status='indexed')
+    finally:
+        for job in batch:
+            if job['id'] in parse_errors:
+                fail_ingestion_job(job, parse_errors[job['id']])
+
+    finish_ingestion_jobs(batch)
+
+
+def ingest_job_streaming(job):
+    update_ingestion_job(job['id'], status='embedding')
+    metadata = job['metadata']
+    try:
+        rag_model.add_file_documents(
+            job['file_path'],
+            knowledge_base_id=metadata['kb_id'],
+            doc_id=metadata['doc_id'],
+            user_id=metadata['user_id'],
+            source=metadata['source'],
+            on_progress=lambda chunks: update_ingestion_job(job['id'], chunks=chunks)
+        )
+    except Exception as e:
+        fail_ingestion_job(job, e)
+    else:
+        update_ingestion_job(job['id'], status='indexed')
+
+    finish_ingestion_jobs([job])
+
+
+def finish_ingestion_jobs(jobs):
+    """处理期间被删除的文档：清理刚写入的向量"""
+    for job in jobs:
+        if UploadedDocument.query.get(job['doc_id']) is None:
+            rag_model.delete_document(job['doc_id'])
+
+
+ingestion_queue = BackgroundJobQueue(
+    process_ingestion_jobs,
+    workers=int(os.getenv('INGEST_JOB_WORKERS', '1')),
+    batch_size=int(os.getenv('INGEST_JOB_BATCH', '8')),
+    batch_wait=float(os.getenv('INGEST_JOB_BATCH_WAIT', '0.5'))
+)
+_ingestion_start_lock = threading.Lock()
+
+
+def take_over_expired_job(job_id):
+    """接管租约已过期的处理中任务（处理它的进程已退出），多个进程同时恢复时只有一个成功
+
+    本进程认领的任务不接管：长时间嵌入期间租约可能过期，但任务仍在处理中。
+    """
+    now = datetime.now()
+    taken = IngestionJob.query.filter(
+        IngestionJob.id == job_id,
+        IngestionJob.status.in_(PROCESSING_JOB_STATUSES),
+        db.or_(IngestionJob.worker.is_(None), IngestionJob.worker != ingestion_worker_id()),
+        db.or_(IngestionJob.lease_until.is_(None), IngestionJob.lease_until < now)
+    ).update({
+        'worker': ingestion_worker_id(),
+        'lease_until': now + timedelta(seconds=INGEST_LEASE_SECONDS)
+    }, synchronize_session=False)
+    db.session.commit()
+    return taken == 1
+
+
+def recover_ingestion_jobs(statuses):
+    """重新提交指定状态的任务：处理中的任务只恢复租约已过期的（处理它的写入进程已退出），返回恢复的数量"""
+    recovered = 0
+    for job in IngestionJob.query.filter(IngestionJob.status.in_(statuses)).all():
+        if job.status != 'queued':
+            if not take_over_expired_job(job.id):
+                continue
+            # 上次处理到一半中断，先清理可能已写入的部分向量
+            rag_model.delete_document(job.document_id)
+            update_ingestion_job(job.id, status='queued', chunks=0)
+        ingestion_queue.submit(job.id)
+        recovered += 1
+    return recovered
+
+
+_vector_deletion_lock = threading.Lock()
+
+
+def apply_vector_deletions():
+    """写入进程：从向量数据库中删除VectorDeletion记录的文档向量和知识库索引，完成后移除记录，失败的下次重试"""
+    with _vector_deletion_lock:
+        for deletion in VectorDeletion.query.order_by(VectorDeletion.id).all():
+            try:
+                if deletion.document_id is None:
+                    rag_model.kb_indexes.remove(deletion.knowledge_base_id)
+                else:
+                    rag_model.delete_document(deletion.document_id, knowledge_base_id=deletion.knowledge_base_id)
+            except Exception as e:
+                print(f"删除文档向量失败（稍后重试）: {e}")
+                continue
+            db.session.delete(deletion)
+            db.session.commit()
+
+
+def poll_writer_tasks():
+    """写入进程的轮询线程：处理其他进程记录的待删除向量，提交其他进程上传后创建的入库任务，
+    恢复之前的写入进程退出时未完成、租约已过期的任务"""
+    submitted = set()
+    while True:
+        time.sleep(INGEST_POLL_INTERVAL)
+        with app.app_context():
+            try:
+                apply_vector_deletions()
+                recovered = recover_ingestion_jobs(PROCESSING_JOB_STATUSES)
+                if recovered:
+                    print(f"已恢复 {recovered} 个租约过期的入库任务")
+                # 失败重试的任务（attempts>0）由本进程的重试定时器提交，这里只提交新任务
+                queued = {job_id for (job_id,) in
+                          db.session.query(IngestionJob.id).filter_by(status='queued', attempts=0)}
+                for job_id in sorted(queued - submitted):
+                    ingestion_queue.submit(job_id)
+                submitted = queued
+            except Exception as e:
+                print(f"轮询入库任务失败: {e}")
+            finally:
+                db.session.remove()
+
+
+@app.before_request
+def start_ingestion_queue():
+    """取得写锁的进程（写入进程）在第一个请求到来时启动后台入库队列和轮询线程，并恢复未完成的任务
+
+    只读进程在每个请求到来时尝试取得写锁（一次非阻塞的文件锁调用），写入进程退出后由其他进程接替。
+    """
+    if ingestion_queue.started:
+        return
+
+    with _ingestion_start_lock:
+        if ingestion_queue.started or not rag_model.acquire_writer():
+            return
+        ingestion_queue.start()
+
+        recovered = recover_ingestion_jobs(ACTIVE_JOB_STATUSES)
+        if recovered:
+            print(f"已恢复 {recovered} 个未完成的入库任务")
+
+        threading.Thread(target=poll_writer_tasks, name="ingestion-poller", daemon=True).start()
+
+
 # 路由定义
 @app.route('/')
 @login_required
@@ -333,22 +725,36 @@ def delete_knowledge_base(kb_id):
         flash('知识库不存在或无权访问', 'error')
         return redirect(url_for('knowledge_bases'))
 
-    # 删除关联的文档和文件
+    # 从数据库中删除知识库及其文档，同时记录待删除的文档向量和知识库索引（由写入进程删除）
+    file_paths = set()
     for doc in kb.documents:
-        if os.path.exists(doc.file_path):
-            try:
-                os.remove(doc.file_path)
-            except Exception as e:
-                print(f"删除文件失败: {e}")
-
-    # 从数据库中删除知识库及其文档
+        db.session.add(VectorDeletion(document_id=doc.id))
+        file_paths.add(doc.file_path)
+    db.session.add(VectorDeletion(knowledge_base_id=kb_id))
     db.session.delete(kb)
     db.session.commit()
 
+    # 本进程是写入进程时立即删除，否则由写入进程在下一次轮询时删除
+    if rag_model.is_writer:
+        apply_vector_deletions()
+
+    # 删除不再被引用的文件
+    for file_path in file_paths:
+        remove_unreferenced_file(file_path)
+
     flash('知识库已删除', 'success')
     return redirect(url_for('knowledge_bases'))
 
 
+def remove_unreferenced_file(file_path):
+    """上传文件按内容共享，没有上传记录引用时才删除"""
+    if UploadedDocument.query.filter_by(file_path=file_path).count() == 0 and os.path.exists(file_path):
+        try:
+            os.remove(file_path)
+        except Exception as e:
+            print(f"删除文件失败: {e}")
+
+
 # 文档上传路由
 @app.route('/upload', methods=['GET', 'POST'])
 @login_required
@@ -386,10 +792,14 @@ def upload_document():
                 flash('知识库不存在或无权访问', 'error')
                 return redirect(request.url)
 
-        # 生成唯一文件名并保存
-        filename = f"{uuid.uuid4()}.{file_ext}"
-        file_path = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-        file.save(file_path)
+        # 按内容寻址保存：文件名为内容的SHA-256，相同文件只保存一份
+        tmp_path = os.path.join(app.config['UPLOAD_FOLDER'], f"{uuid.uuid4()}.tmp")
+        file.save(tmp_path)
+        file_path = os.path.join(app.config['UPLOAD_FOLDER'], f"{file_sha256(tmp_path)}.{file_ext}")
+        if os.path.exists(file_path):
+            os.remove(tmp_path)
+        else:
+            os.replace(tmp_path, file_path)
 
         # 记录上传信息到数据库
         new_doc = UploadedDocument(
@@ -401,21 +811,17 @@ def upload_document():
             file_size=os.path.getsize(file_path)
         )
         db.session.add(new_doc)
-        db.session.commit()
+        db.session.flush()
 
-        try:
-            # 将文档添加到向量数据库
-            rag_model.add_file_documents(file_path)
-            flash('文件上传成功并已添加到向量数据库', 'success')
-        except Exception as e:
-            # 如果添加到向量数据库失败，删除已保存的文件和数据库记录
-            if os.path.exists(file_path):
-                os.remove(file_path)
-            db.session.delete(new_doc)
-            db.session.commit()
-            flash(f'文件上传失败: {str(e)}', 'error')
-            return redirect(request.url)
+        # 记录入库任务，由后台工作线程解析并写入向量数据库
+        job = IngestionJob(document_id=new_doc.id)
+        db.session.add(job)
+        db.session.commit()
+        # 只读进程不处理入库任务，由写入进程轮询到后处理
+        if ingestion_queue.started:
+            ingestion_queue.submit(job.id)
 
+        flash('文件上传成功，正在后台解析并添加到向量数据库', 'success')
         return redirect(url_for('upload_document'))
 
     # 获取当前用户的知识库和上传记录
@@ -425,6 +831,55 @@ def upload_document():
     return render_template('upload.html', knowledge_bases=knowledge_bases, uploaded_docs=uploaded_docs)
 
 
+def get_user_ingestion_jobs(job_ids=None):
+    query = IngestionJob.query.join(UploadedDocument).filter(UploadedDocument.user_id == current_user.id)
+    if job_ids:
+        query = query.filter(IngestionJob.id.in_(job_ids))
+    return query.order_by(IngestionJob.id.desc()).all()
+
+
+# 入库任务进度API：?ids=1,2 只返回指定任务，?active=1 只返回未完成的任务
+@app.route('/api/upload/jobs')
+@login_required
+def get_ingestion_jobs():
+    job_ids = [int(i) for i in request.args.get('ids', '').split(',') if i.isdigit()]
+    jobs = get_user_ingestion_jobs(job_ids)
+    if request.args.get('active'):
+        jobs = [job for job in jobs if job.status in ACTIVE_JOB_STATUSES]
+    return jsonify({'jobs': [job.to_dict() for job in jobs], 'queue': ingestion_queue.get_stats()})
+
+
+# 入库任务进度推送（SSE）：状态变化时推送，全部任务完成后结束
+@app.route('/api/upload/jobs/stream')
+@login_required
+def stream_ingestion_jobs():
+    job_ids = [int(i) for i in request.args.get('ids', '').split(',') if i.isdigit()]
+    user_id = current_user.id
+    timeout = float(os.getenv('INGEST_PROGRESS_STREAM_TIMEOUT', '600'))
+
+    def generate():
+        last = None
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            with app.app_context():
+                query = IngestionJob.query.join(UploadedDocument).filter(UploadedDocument.user_id == user_id)
+                if job_ids:
+                    query = query.filter(IngestionJob.id.in_(job_ids))
+                jobs = [job.to_dict() for job in query.order_by(IngestionJob.id.desc()).all()]
+                db.session.remove()
+
+            if jobs != last:
+                yield f"data: {json.dumps({'jobs': jobs}, ensure_ascii=False)}\n\n"
+                last = jobs
+            if not any(job['status'] in ACTIVE_JOB_STATUSES for job in jobs):
+                break
+            time.sleep(1)
+
+        yield "data: {\"done\": true}\n\n"
+
+    return Response(generate(), mimetype='text/event-stream')
+
+
 # 删除上传文档路由
 @app.route('/upload/<int:doc_id>/delete', methods=['POST'])
 @login_required
@@ -435,16 +890,23 @@ def delete_uploaded_document(doc_id):
         return redirect(url_for('upload_document'))
 
     try:
-        # 删除文件
-        if os.path.exists(doc.file_path):
-            os.remove(doc.file_path)
-
-        # 从数据库中删除记录
+        # 从数据库中删除记录，同时记录待从向量数据库（全局索引和所属知识库索引）中删除的文档向量
+        file_path = doc.file_path
+        db.session.add(VectorDeletion(document_id=doc.id, knowledge_base_id=doc.knowledge_base_id))
         db.session.delete(doc)
         db.session.commit()
 
-        # 重新构建向量数据库（因为FAISS不支持删除单个文档）
-        flash('文档已删除，下次启动时将重新构建向量数据库', 'success')
+        # 本进程是写入进程时立即删除，否则由写入进程在下一次轮询时删除
+        if rag_model.is_writer:
+            apply_vector_deletions()
+
+        # 删除文件（其他上传记录仍引用相同内容时保留）
+        remove_unreferenced_file(file_path)
+
+        if rag_model.is_writer:
+            flash('文档已删除，并已从向量数据库中移除', 'success')
+        else:
+            flash('文档已删除，将在几秒内从向量数据库中移除', 'success')
 
     except Exception as e:
         db.session.rollback()
@@ -453,6 +915,19 @@ def delete_uploaded_document(doc_id):
     return redirect(url_for('upload_document'))
 
 
+# 流式响应（SSE）的消息格式，同步接口和异步服务（asgi.py）共用
+SSE_DONE = "data: {\"done\": true}\n\n"
+
+
+def sse_content(content):
+    cleaned_content = content.replace('\n', '\\n').replace('"', '\\"')
+    return f"data: {{\"content\": \"{cleaned_content}\"}}\n\n"
+
+
+def sse_error(error_msg):
+    return f"data: {{\"error\": \"{error_msg}\"}}\n\n"
+
+
 # 修改后的流式对话路由（带记忆功能）
 @app.route('/ask_stream', methods=['POST', 'GET'])
 @login_required
@@ -477,28 +952,21 @@ def ask_stream():
     conversation_id = f"chat_{chat_id}"
 
     # 根据用户角色和选择的知识库使用不同的知识库
+    kb_kwargs = {}
     if current_user.role in ['expert', 'admin'] and kb_id:
         kb = KnowledgeBase.query.filter_by(id=kb_id, user_id=current_user.id).first()
         if kb:
-            doc_paths = [doc.file_path for doc in kb.documents]
-            temp_rag = DeepSeekApiRag(api_key, db_path)
-            for path in doc_paths:
-                if os.path.exists(path):
-                    temp_rag.add_file_documents(path)
-            result = temp_rag.generate_response_stream(
-                user_input,
-                conversation_id=conversation_id
-            )
-        else:
-            result = rag_model.generate_response_stream(
-                user_input,
-                conversation_id=conversation_id
-            )
-    else:
-        result = rag_model.generate_response_stream(
-            user_input,
-            conversation_id=conversation_id
-        )
+            # 在全局索引中按知识库过滤检索（独立索引模式下首次使用时构建知识库索引）
+            kb_kwargs = {
+                'knowledge_base_id': kb.id,
+                'knowledge_base_documents': [(doc.id, doc.file_path) for doc in kb.documents]
+            }
+
+    result = rag_model.generate_response_stream(
+        user_input,
+        conversation_id=conversation_id,
+        **kb_kwargs
+    )
 
     # 先保存用户消息到数据库
     try:
@@ -521,11 +989,10 @@ def ask_stream():
             for chunk in result['stream']:
                 content = chunk.content
                 full_response += content
-                cleaned_content = content.replace('\n', '\\n').replace('"', '\\"')
-                yield f"data: {{\"content\": \"{cleaned_content}\"}}\n\n"
+                yield sse_content(content)
 
-            # 保存AI回复到记忆
-            rag_model.save_bot_response(conversation_id, full_response)
+            # 保存AI回复到记忆（首轮问题同时写入语义回答缓存）
+            rag_model.save_bot_response(conversation_id, full_response, result.get('answer_cache_key'))
 
             # 在应用上下文中保存机器人回复到数据库
             with app.app_context():
@@ -550,7 +1017,7 @@ def ask_stream():
                     print(f"保存机器人回复失败: {e}")
                     db.session.rollback()
 
-            yield "data: {\"done\": true}\n\n"
+            yield SSE_DONE
 
         except Exception as e:
             print(f"流式响应错误: {e}")
@@ -578,8 +1045,8 @@ def ask_stream():
                     print(f"保存错误消息失败: {db_error}")
                     db.session.rollback()
 
-            yield f"data: {{\"error\": \"{error_msg}\"}}\n\n"
-            yield "data: {\"done\": true}\n\n"
+            yield sse_error(error_msg)
+            yield SSE_DONE
 
     return Response(generate(), mimetype='text/event-stream')
 
@@ -593,12 +1060,33 @@ def clear_chat_memory(chat_id):
     if not chat:
         return jsonify({'error': '对话不存在'}), 404
 
+    # 记录清空位置，对话记忆被淘汰或服务重启后也不会重新加载清空前的消息
+    last_message = Message.query.filter_by(chat_id=chat_id).order_by(Message.id.desc()).first()
+    reset = chat.memory_reset or ChatMemoryReset(chat_id=chat_id)
+    reset.after_message_id = last_message.id if last_message else 0
+    reset.created_at = datetime.now()
+    db.session.add(reset)
+    db.session.commit()
+
     conversation_id = f"chat_{chat_id}"
     rag_model.clear_conversation_memory(conversation_id)
 
     return jsonify({'success': True, 'message': '对话记忆已清空'})
 
 
+# 运行统计API（仅管理员）
+@app.route('/api/stats')
+@login_required
+def get_stats():
+    """获取检索缓存和重排序的运行统计"""
+    if current_user.role != 'admin':
+        return jsonify({'error': '无权访问'}), 403
+
+    stats = rag_model.get_stats()
+    stats['ingestion_queue'] = ingestion_queue.get_stats()
+    return jsonify(stats)
+
+
 # 对话相关API
 @app.route('/api/chats')
 @login_required
@@ -0,0 +1,208 @@
+"""异步（ASGI）服务入口
+
+/ask_stream 由原生异步的处理函数提供：检索在线程池中执行，重排序使用异步HTTP客户端，
+DeepSeek流式生成使用astream，数据库读写使用SQLAlchemy异步会话，等待网络时不占用线程，
+一个进程可以同时保持数百个流式连接。其余页面和接口仍由Flask应用处理（通过a2wsgi挂载），
+登录状态沿用Flask的会话Cookie，SSE消息格式与Flask的/ask_stream完全相同。
+
+依赖: starlette, uvicorn, a2wsgi, python-multipart, sqlalchemy[asyncio], aiosqlite（MySQL/PostgreSQL分别为aiomysql/asyncpg）
+
+启动:
+    uvicorn asgi:application --host 0.0.0.0 --port 5000
+"""
+import os
+import asyncio
+import contextlib
+from datetime import datetime
+from urllib.parse import quote
+
+from a2wsgi import WSGIMiddleware
+from flask_login.utils import decode_cookie
+from itsdangerous import BadSignature
+from sqlalchemy import select
+from sqlalchemy.engine import make_url
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
+from starlette.applications import Starlette
+from starlette.responses import JSONResponse, RedirectResponse, StreamingResponse
+from starlette.routing import Mount, Route
+
+import app as legal_app
+from app import app as flask_app, db, Chat, KnowledgeBase, Message, UploadedDocument, User
+from app import SSE_DONE, sse_content, sse_error
+
+# 同步驱动 -> 对应的异步驱动
+ASYNC_DRIVERS = {
+    'sqlite': 'sqlite+aiosqlite',
+    'sqlite+pysqlite': 'sqlite+aiosqlite',
+    'mysql': 'mysql+aiomysql',
+    'mysql+pymysql': 'mysql+aiomysql',
+    'postgresql': 'postgresql+asyncpg',
+    'postgresql+psycopg2': 'postgresql+asyncpg'
+}
+
+
+def async_database_url():
+    """异步数据库连接地址：ASYNC_DATABASE_URL，未设置时把Flask-SQLAlchemy实际使用的地址换成异步驱动
+    （SQLite的相对路径已由Flask-SQLAlchemy解析到instance目录，两边读写同一个文件）"""
+    url = os.getenv("ASYNC_DATABASE_URL")
+    if url:
+        return make_url(url)
+    with flask_app.app_context():
+        url = db.engine.url
+    return url.set(drivername=ASYNC_DRIVERS.get(url.drivername, url.drivername))
+
+
+engine = create_async_engine(async_database_url())
+Session = async_sessionmaker(engine, expire_on_commit=False)
+
+
+def _parse_id(value):
+    try:
+        return int(value) if value else None
+    except (TypeError, ValueError):
+        return None
+
+
+async def load_current_user(request, session):
+    """按Flask的会话Cookie（没有时按"记住我"Cookie）识别登录用户，与Flask-Login的判断一致"""
+    user_id = None
+    cookie = request.cookies.get(flask_app.config['SESSION_COOKIE_NAME'])
+    if cookie:
+        serializer = flask_app.session_interface.get_signing_serializer(flask_app)
+        try:
+            data = serializer.loads(cookie, max_age=int(flask_app.permanent_session_lifetime.total_seconds()))
+            user_id = data.get('_user_id')
+        except BadSignature:
+            pass
+
+    if user_id is None:
+        remember = request.cookies.get(flask_app.config.get('REMEMBER_COOKIE_NAME', 'remember_token'))
+        if remember:
+            with flask_app.app_context():
+                user_id = decode_cookie(remember)
+
+    user_id = _parse_id(user_id)
+    return await session.get(User, user_id) if user_id is not None else None
+
+
+async def save_bot_message(chat_id, content, kb_id=None):
+    """保存机器人回复（或错误消息）并更新对话时间和知识库"""
+    async with Session() as session:
+        try:
+            session.add(Message(chat_id=chat_id, role='bot', content=content))
+
+            chat = await session.get(Chat, chat_id)
+            if chat:
+                chat.updated_at = datetime.utcnow()
+                if kb_id:
+                    chat.knowledge_base_id = kb_id
+
+            await session.commit()
+            return True
+        except Exception as e:
+            print(f"保存机器人回复失败: {e}")
+            await session.rollback()
+            return False
+
+
+async def ask_stream(request):
+    """流式对话接口（带记忆），参数和返回格式与Flask的/ask_stream一致"""
+    params = request.query_params if request.method == 'GET' else await request.form()
+    user_input = params.get('user_input')
+    chat_id = _parse_id(params.get('chat_id'))
+    kb_id = _parse_id(params.get('knowledge_base_id'))
+    rag_model = legal_app.rag_model
+
+    async with Session() as session:
+        user = await load_current_user(request, session)
+        if user is None:
+            return RedirectResponse(f"/login?next={quote(request.url.path)}", status_code=302)
+
+        if not user_input or chat_id is None:
+            return JSONResponse({'error': '缺少必要参数'}, status_code=400)
+
+        print(f"用户提问(流式): {user_input}")
+
+        # 使用chat_id作为对话记忆的标识
+        conversation_id = f"chat_{chat_id}"
+
+        # 根据用户角色和选择的知识库使用不同的知识库
+        kb_kwargs = {}
+        if user.role in ['expert', 'admin'] and kb_id:
+            kb = (await session.execute(
+                select(KnowledgeBase).where(KnowledgeBase.id == kb_id, KnowledgeBase.user_id == user.id)
+            )).scalar_one_or_none()
+            if kb:
+                documents = await session.execute(
+                    select(UploadedDocument.id, UploadedDocument.file_path)
+                    .where(UploadedDocument.knowledge_base_id == kb.id))
+                kb_kwargs = {
+                    'knowledge_base_id': kb.id,
+                    'knowledge_base_documents': [(doc_id, file_path) for doc_id, file_path in documents]
+                }
+
+    result = await rag_model.agenerate_response_stream(
+        user_input,
+        conversation_id=conversation_id,
+        **kb_kwargs
+    )
+
+    # 先保存用户消息到数据库
+    async with Session() as session:
+        try:
+            session.add(Message(chat_id=chat_id, role='user', content=user_input))
+            await session.commit()
+            print(f"用户消息已保存到数据库，chat_id: {chat_id}")
+        except Exception as e:
+            print(f"保存用户消息失败: {e}")
+            await session.rollback()
+
+    async def generate():
+        full_response = ""
+        try:
+            # 流式输出响应
+            async for chunk in result['stream']:
+                content = chunk.content
+                full_response += content
+                yield sse_content(content)
+
+            # 保存AI回复到记忆（首轮问题同时写入语义回答缓存）
+            await asyncio.to_thread(rag_model.save_bot_response, conversation_id, full_response,
+                                    result.get('answer_cache_key'))
+
+            if await save_bot_message(chat_id, full_response, kb_id):
+                print(f"机器人回复已保存到数据库，长度: {len(full_response)}")
+
+            yield SSE_DONE
+
+        except Exception as e:
+            print(f"流式响应错误: {e}")
+            # 保存错误消息到记忆和数据库
+            error_msg = f"抱歉，生成回复时出现错误: {str(e)}"
+            await asyncio.to_thread(rag_model.save_bot_response, conversation_id, error_msg)
+            if await save_bot_message(chat_id, error_msg):
+                print("错误消息已保存到数据库")
+
+            yield sse_error(error_msg)
+            yield SSE_DONE
+
+    return StreamingResponse(generate(), media_type='text/event-stream')
+
+
+@contextlib.asynccontextmanager
+async def lifespan(_):
+    yield
+    reranker_close = getattr(legal_app.rag_model.reranker, 'aclose', None)
+    if reranker_close is not None:
+        await reranker_close()
+    await engine.dispose()
+
+
+application = Starlette(
+    routes=[
+        Route('/ask_stream', ask_stream, methods=['GET', 'POST']),
+        # 其余页面和接口交给Flask应用（在线程池中执行）
+        Mount('/', app=WSGIMiddleware(flask_app))
+    ],
+    lifespan=lifespan
+)
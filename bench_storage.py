@@ -0,0 +1,85 @@
+"""向量存储精度对比工具
+
+用库中全部向量分别按fp32、fp16、sq8存储构建索引，以float32精确检索为基准，
+比较top-k结果的召回率、top-1一致率、相似度误差、索引大小和查询延迟，
+用于评估量化存储（VECTOR_INDEX_STORAGE）对检索结果的影响。
+
+用法:
+    python bench_storage.py --db law_faiss --queries 200 --k 10
+    python bench_storage.py --type hnsw          # 对比HNSW索引下的各存储精度
+    python bench_storage.py --apply sq8          # 把向量库转换为sq8存储并保存
+"""
+import os
+import argparse
+import faiss
+import numpy as np
+from dotenv import load_dotenv
+from ann_index import STORAGE_TYPES, build_index, min_train_size, needs_training, normalize_spec, sample_rows
+from tune_index import recall_at_k, sample_queries, search_all
+from vector_store import load_vector_store
+
+load_dotenv()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="向量存储精度对比：fp16/sq8相对float32的top-k结果变化")
+    parser.add_argument('--db', default=os.getenv("VECTOR_DB_PATH", "law_faiss"), help="向量库路径")
+    parser.add_argument('--queries', type=int, default=200, help="抽样查询数量")
+    parser.add_argument('--questions', help="问题文件（每行一个），不指定时用库中文档块作为查询")
+    parser.add_argument('--k', type=int, default=10)
+    parser.add_argument('--type', help="索引类型（flat/ivf_flat/hnsw），默认使用向量库当前的索引类型")
+    parser.add_argument('--apply', choices=STORAGE_TYPES, help="把向量库转换为指定的存储精度并保存")
+    args = parser.parse_args()
+
+    store = load_vector_store(args.db, None)
+    if store is None:
+        print(f"向量库不存在: {args.db}")
+        return
+
+    index_type = args.type or store.index_spec['type']
+    if index_type == 'ivf_pq':
+        print("ivf_pq 已经是乘积量化存储，改为对比 flat 索引")
+        index_type = 'flat'
+
+    ids, vectors = store.live_vectors()
+    count, dimension = vectors.shape
+    print(f"向量库: {args.db}，{count} 个向量，维度 {dimension}，当前索引 {store.index_type}，"
+          f"存储 {store.get_stats()['storage']}")
+    if not store.exact_vectors:
+        print("注意：向量库当前为量化存储，基准使用的是还原后的近似向量")
+
+    queries, exclude_ids = sample_queries(ids, vectors, args.queries, args.questions)
+
+    baseline_spec = normalize_spec({'type': 'flat', 'storage': 'fp32'})
+    baseline = build_index(baseline_spec, dimension)
+    baseline.add_with_ids(vectors, ids)
+    ground_truth, truth_scores, _ = search_all(baseline, baseline_spec, queries, args.k, exclude_ids)
+
+    print(f"\n{index_type} 索引，基准为 float32 精确检索")
+    print(f"{'存储':<8}{'recall@' + str(args.k):>10}{'top-1一致':>10}{'相似度误差':>12}{'延迟(ms)':>10}{'大小(MB)':>10}")
+    for storage in STORAGE_TYPES:
+        spec = normalize_spec({'type': index_type, 'storage': storage})
+        if needs_training(spec) and count < min_train_size(spec, count):
+            print(f"{storage:<8}跳过：向量数量不足 {min_train_size(spec, count)}，无法训练")
+            continue
+
+        train_vectors = vectors[sample_rows(count, spec['train_size'])] if needs_training(spec) else None
+        index = build_index(spec, dimension, train_vectors)
+        index.add_with_ids(vectors, ids)
+        found, scores, latency = search_all(index, spec, queries, args.k, exclude_ids)
+
+        recall = recall_at_k(found, ground_truth)
+        top1 = float(np.mean(found[:, 0] == ground_truth[:, 0]))
+        # 同一位置上的相似度与float32精确检索结果的平均绝对差
+        score_error = float(np.mean(np.abs(scores - truth_scores)))
+        size_mb = faiss.serialize_index(index).nbytes / 2**20
+        print(f"{storage:<8}{recall:>10.3f}{top1:>10.3f}{score_error:>12.5f}{latency:>10.3f}{size_mb:>10.1f}")
+
+    if args.apply:
+        store.convert_index(dict(store.index_spec, storage=args.apply))
+        store.persist(args.db)
+        print(f"向量库已转换为 {args.apply} 存储并保存: {args.db}（同时设置 VECTOR_INDEX_STORAGE={args.apply}）")
+
+
+if __name__ == '__main__':
+    main()
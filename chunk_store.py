@@ -0,0 +1,248 @@
+import os
+import json
+import sqlite3
+import hashlib
+import threading
+import unicodedata
+from typing import Dict, Iterator, List, Optional, Tuple
+
+try:
+    import fcntl
+except ImportError:  # Windows：不检查写入进程
+    fcntl = None
+
+# 本进程持有的写锁：文档块存储文件的真实路径 -> (进程号, 锁文件)
+_writer_locks = {}
+_writer_locks_guard = threading.Lock()
+
+
+def try_acquire_writer_lock(file_path: str) -> bool:
+    """取得文档块存储（及其所在向量库目录）的写锁，其他进程持有时返回False，进程退出时自动释放
+
+    向量ID和段号由写入进程内的计数器分配，文档块存储的修改也要到保存时才提交，
+    所以同一个向量库只能由一个进程写入，其他进程可以加载和检索。锁按进程号记录，fork出的子进程需要重新获取。
+    """
+    if fcntl is None:
+        return True
+
+    key = os.path.realpath(file_path)
+    with _writer_locks_guard:
+        held = _writer_locks.get(key)
+        if held is not None and held[0] == os.getpid():
+            return True
+
+        lock_file = open(key + ".lock", 'a')
+        try:
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            lock_file.close()
+            return False
+        _writer_locks[key] = (os.getpid(), lock_file)
+        return True
+
+
+def acquire_writer_lock(file_path: str):
+    """取得写锁，其他进程持有时抛出RuntimeError，而不是分配重复的向量ID、互相覆盖文档块和段文件"""
+    if not try_acquire_writer_lock(file_path):
+        raise RuntimeError(f"向量库已由其他进程写入: {os.path.dirname(os.path.realpath(file_path))}，"
+                           f"同一个向量库只能由一个进程写入（多进程部署时由取得写锁的工作进程负责写入，"
+                           f"索引维护脚本需要停止服务后再运行）")
+
+
+def release_writer_locks():
+    """释放本进程持有的全部写锁（之后写入时重新获取）"""
+    with _writer_locks_guard:
+        for key, (pid, lock_file) in list(_writer_locks.items()):
+            if pid == os.getpid():
+                lock_file.close()
+                del _writer_locks[key]
+
+
+def content_hash(text: str) -> str:
+    """文档块内容哈希：NFKC规范化并合并空白后取SHA-256，排版差异不影响去重"""
+    normalized = " ".join(unicodedata.normalize("NFKC", text).split())
+    return hashlib.sha256(normalized.encode('utf-8')).hexdigest()
+
+
+class ChunkStore:
+    """文档块存储：文本和引用元数据保存在SQLite表中，按向量ID按需读取
+
+    内存中只保留有效向量ID集合，检索时只读取top-k命中的文档块；添加、删除、修改引用都是单行操作。
+    修改在同一个连接的事务中累积，由向量库在写入段文件之后提交（commit），段号记录在meta表中，
+    加载时只需重放比它新的段文件。删除只做标记（deleted为删除所在的段号），
+    保存的基础快照中的BM25索引已不包含它之后才真正清除（purge），以便重放段文件时取回被删除的文本。
+    未保存到磁盘的向量库使用内存数据库，第一次保存时整体复制到文件（attach）。
+    文件只允许一个进程写入：第一次修改时取得写锁（acquire_writer_lock），其他进程只读。
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS chunks (
+            id INTEGER PRIMARY KEY,
+            hash TEXT NOT NULL,
+            text TEXT NOT NULL,
+            refs TEXT NOT NULL,
+            deleted INTEGER
+        );
+        CREATE INDEX IF NOT EXISTS idx_chunks_hash ON chunks (hash);
+        CREATE TABLE IF NOT EXISTS meta (
+            key TEXT PRIMARY KEY,
+            value TEXT NOT NULL
+        );
+    """
+
+    def __init__(self, file_path: str = None):
+        self.file_path = file_path
+        self._lock = threading.RLock()
+        self._conn = self._connect(file_path or ":memory:")
+        self._ids = {row[0] for row in self._conn.execute("SELECT id FROM chunks WHERE deleted IS NULL")}
+
+    @classmethod
+    def _connect(cls, database: str, source: sqlite3.Connection = None) -> sqlite3.Connection:
+        """打开数据库，指定source时先把source的内容复制过来"""
+        # 向量库自身有锁保护，连接在请求线程、入库线程和后台合并线程之间共用
+        conn = sqlite3.connect(database, check_same_thread=False, timeout=30)
+        if source is not None:
+            source.backup(conn)
+        if database != ":memory:":
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+        conn.executescript(cls.SCHEMA)
+        conn.commit()
+        return conn
+
+    @staticmethod
+    def _remove_files(file_path: str):
+        for suffix in ("", "-wal", "-shm"):
+            if os.path.exists(file_path + suffix):
+                os.remove(file_path + suffix)
+
+    @classmethod
+    def create(cls, file_path: str) -> "ChunkStore":
+        """新建存储文件（已有的同名文件会被覆盖）"""
+        acquire_writer_lock(file_path)
+        cls._remove_files(file_path)
+        return cls(file_path)
+
+    def __len__(self) -> int:
+        return len(self._ids)
+
+    def __contains__(self, vector_id: int) -> bool:
+        return vector_id in self._ids
+
+    def ids(self) -> List[int]:
+        return sorted(self._ids)
+
+    @property
+    def applied_segment(self) -> int:
+        """已写入本存储的最后一个段号"""
+        with self._lock:
+            row = self._conn.execute("SELECT value FROM meta WHERE key = 'segment'").fetchone()
+            return int(row[0]) if row else 0
+
+    def _writable(self):
+        if self.file_path:
+            acquire_writer_lock(self.file_path)
+
+    def put(self, vector_id: int, text: str, refs: List[dict]):
+        self._writable()
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO chunks (id, hash, text, refs, deleted) VALUES (?, ?, ?, ?, NULL)",
+                (vector_id, content_hash(text), text, json.dumps(refs, ensure_ascii=False)))
+            self._ids.add(vector_id)
+
+    def set_refs(self, vector_id: int, refs: List[dict]):
+        self._writable()
+        with self._lock:
+            self._conn.execute("UPDATE chunks SET refs = ? WHERE id = ?",
+                               (json.dumps(refs, ensure_ascii=False), vector_id))
+
+    def delete(self, vector_id: int, segment: int):
+        """标记删除，segment为记录这次删除的段号"""
+        self._writable()
+        with self._lock:
+            self._conn.execute("UPDATE chunks SET deleted = ? WHERE id = ? AND deleted IS NULL",
+                               (segment, vector_id))
+            self._ids.discard(vector_id)
+
+    def get(self, vector_id: int) -> Optional[dict]:
+        return self.get_many([vector_id]).get(vector_id)
+
+    def get_many(self, vector_ids: List[int]) -> Dict[int, dict]:
+        """读取文档块：向量ID -> {'text', 'metadata', 'refs'}，不存在或已删除的ID不返回"""
+        vector_ids = [int(vector_id) for vector_id in vector_ids if vector_id in self._ids]
+        if not vector_ids:
+            return {}
+
+        entries = {}
+        with self._lock:
+            for start in range(0, len(vector_ids), 500):
+                batch = vector_ids[start:start + 500]
+                rows = self._conn.execute(
+                    f"SELECT id, text, refs FROM chunks WHERE deleted IS NULL AND id IN ({','.join('?' * len(batch))})",
+                    batch)
+                for vector_id, text, refs in rows:
+                    refs = json.loads(refs)
+                    entries[vector_id] = {'text': text, 'metadata': refs[0], 'refs': refs}
+        return {vector_id: entries[vector_id] for vector_id in vector_ids if vector_id in entries}
+
+    def text(self, vector_id: int, include_deleted: bool = False) -> Optional[str]:
+        """读取文本，include_deleted为True时也能取回已标记删除的文档块"""
+        condition = "" if include_deleted else " AND deleted IS NULL"
+        with self._lock:
+            row = self._conn.execute(f"SELECT text FROM chunks WHERE id = ?{condition}", (vector_id,)).fetchone()
+            return row[0] if row else None
+
+    def find(self, text_hash: str) -> Optional[int]:
+        """按内容哈希查找有效的文档块（旧数据中可能有重复内容，取ID最小的）"""
+        with self._lock:
+            row = self._conn.execute("SELECT MIN(id) FROM chunks WHERE hash = ? AND deleted IS NULL",
+                                     (text_hash,)).fetchone()
+            return row[0]
+
+    def iter_refs(self) -> Iterator[Tuple[int, List[dict]]]:
+        """遍历全部有效文档块的引用（不读取文本），用于加载时重建元数据倒排表"""
+        with self._lock:
+            rows = self._conn.execute("SELECT id, refs FROM chunks WHERE deleted IS NULL").fetchall()
+        for vector_id, refs in rows:
+            yield vector_id, json.loads(refs)
+
+    def iter_texts(self) -> Iterator[Tuple[int, str]]:
+        with self._lock:
+            rows = self._conn.execute("SELECT id, text FROM chunks WHERE deleted IS NULL").fetchall()
+        yield from rows
+
+    def commit(self, segment: int = None):
+        """提交累积的修改，segment为已写入的最后一个段号"""
+        self._writable()
+        with self._lock:
+            if segment is not None:
+                self._conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('segment', ?)", (str(segment),))
+            self._conn.commit()
+
+    def purge(self, max_segment: int = None):
+        """清除已标记删除的文档块，max_segment为None时全部清除（随下一次commit生效）"""
+        self._writable()
+        with self._lock:
+            if max_segment is None:
+                self._conn.execute("DELETE FROM chunks WHERE deleted IS NOT NULL")
+            else:
+                self._conn.execute("DELETE FROM chunks WHERE deleted IS NOT NULL AND deleted <= ?", (max_segment,))
+
+    def attach(self, file_path: str):
+        """把存储复制到file_path并改用该文件（第一次保存或另存到其他路径时）"""
+        if file_path == self.file_path:
+            return
+
+        acquire_writer_lock(file_path)
+        with self._lock:
+            self._conn.commit()
+            self._remove_files(file_path)
+            target = self._connect(file_path, source=self._conn)
+            self._conn.close()
+            self._conn = target
+            self.file_path = file_path
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
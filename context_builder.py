@@ -0,0 +1,369 @@
+import re
+import math
+import hashlib
+import threading
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, List, Optional, Set, Tuple
+from chunk_store import content_hash
+from legal_splitter import article_label, split_sentences
+
+# 中文字符及全角标点，按DeepSeek公布的换算比例约0.6 token/字，其他字符约0.3 token/字符
+_WIDE_CHARS = re.compile(r"[\u3000-\u303f\u3400-\u4dbf\u4e00-\u9fff\uf900-\ufaff\uff00-\uffef]")
+WIDE_CHAR_TOKENS = 0.6
+OTHER_CHAR_TOKENS = 0.3
+
+# 片段之间的分隔符（空行）和截断标记"..."按1个token计
+SEPARATOR_TOKENS = 1
+# 预算剩余不足这么多token时不再放入压缩或截断的文档
+MIN_PART_TOKENS = 32
+# 压缩后不相邻的句子之间的省略标记
+GAP_MARKER = "……"
+
+SUMMARY_PROMPT = """请把下面的法律咨询对话压缩成一段摘要，保留用户的身份和处境、已经讨论过的法律问题、涉及的法条和已给出的结论，不超过{max_chars}字，只输出摘要。
+
+已有摘要：
+{summary}
+
+新增对话：
+{turns}
+"""
+
+
+def estimate_tokens(text: str) -> int:
+    """估算文本的token数（不依赖分词器，与DeepSeek计费的token数接近）"""
+    if not text:
+        return 0
+    wide = len(_WIDE_CHARS.findall(text))
+    return math.ceil(wide * WIDE_CHAR_TOKENS + (len(text) - wide) * OTHER_CHAR_TOKENS)
+
+
+def truncate_tokens(text: str, max_tokens: int) -> str:
+    """截取不超过max_tokens个token的最长前缀"""
+    if estimate_tokens(text) <= max_tokens:
+        return text
+    total = 0.0
+    for end, char in enumerate(text):
+        total += WIDE_CHAR_TOKENS if _WIDE_CHARS.match(char) else OTHER_CHAR_TOKENS
+        if math.ceil(total) > max_tokens:
+            return text[:end]
+    return text
+
+
+def _fingerprint(role: str, content: str) -> str:
+    return hashlib.sha1(f"{role}\n{content}".encode('utf-8')).hexdigest()
+
+
+def _speaker(role: str) -> str:
+    return "用户" if role == 'user' else "助手"
+
+
+class SentenceCompressor:
+    """按问题对文档块做抽取式压缩
+
+    超出预算的文档块切分成句子（法条序号始终保留），全部文档的句子向量一次矩阵乘法与问题向量计算相似度，
+    每个文档块按相似度从高到低选取句子直到用完预算，再按原文顺序拼接，不相邻的句子之间加省略标记。
+    句子向量先查进程内缓存（sentence_cache，需要提供get/put，应有容量上限），未命中的一次批量交给embed_texts。
+    """
+
+    def __init__(self, embed_texts: Callable[[List[str]], np.ndarray], sentence_cache=None):
+        self.embed_texts = embed_texts
+        self.sentence_cache = sentence_cache
+        self._lock = threading.Lock()
+        self.stats = {'documents': 0, 'sentences': 0, 'embedded': 0, 'saved_tokens': 0, 'failures': 0}
+
+    def _count(self, key: str, value: int = 1):
+        with self._lock:
+            self.stats[key] += value
+
+    def _sentence_vectors(self, sentences: List[str]) -> np.ndarray:
+        hashes = [content_hash(sentence) for sentence in sentences]
+        vectors = [self.sentence_cache.get(text_hash) for text_hash in hashes] if self.sentence_cache else \
+            [None] * len(sentences)
+        missing = {}
+        for row, vector in enumerate(vectors):
+            if vector is None:
+                missing.setdefault(hashes[row], sentences[row])
+
+        if missing:
+            embedded = dict(zip(missing, self.embed_texts(list(missing.values()))))
+            self._count('embedded', len(missing))
+            for row, vector in enumerate(vectors):
+                if vector is None:
+                    vectors[row] = embedded[hashes[row]]
+                    if self.sentence_cache is not None:
+                        self.sentence_cache.put(hashes[row], vectors[row])
+        return np.vstack(vectors).astype(np.float32)
+
+    def compress(self, query_vector: np.ndarray, documents: List[str], budgets: List[int]) -> List[str]:
+        """把每个文档压缩到不超过对应budgets的token数，未超出预算的文档原样返回"""
+        results = list(documents)
+        pending = []  # (文档序号, 法条序号, 句子列表)
+        for index, (document, budget) in enumerate(zip(documents, budgets)):
+            if estimate_tokens(document) <= budget:
+                continue
+            label = article_label(document)
+            sentences = split_sentences(document[len(label):])
+            if len(sentences) > 1:
+                pending.append((index, label, sentences))
+            else:
+                results[index] = truncate_tokens(document, budget - SEPARATOR_TOKENS) + "..."
+        if not pending:
+            return results
+
+        all_sentences = [sentence for _, _, sentences in pending for sentence in sentences]
+        try:
+            scores = self._sentence_vectors(all_sentences) @ np.asarray(query_vector, dtype=np.float32)
+        except Exception as e:
+            print(f"文档压缩失败，改为直接截断: {e}")
+            self._count('failures')
+            for index, _, _ in pending:
+                results[index] = truncate_tokens(documents[index], budgets[index] - SEPARATOR_TOKENS) + "..."
+            return results
+
+        offset = 0
+        for index, label, sentences in pending:
+            doc_scores = scores[offset:offset + len(sentences)]
+            offset += len(sentences)
+
+            budget = budgets[index] - estimate_tokens(label)
+            selected, used = [], 0
+            for row in np.argsort(-doc_scores, kind='stable'):
+                tokens = estimate_tokens(sentences[row]) + SEPARATOR_TOKENS
+                if used + tokens <= budget:
+                    selected.append(row)
+                    used += tokens
+            if not selected:
+                results[index] = truncate_tokens(documents[index], budgets[index] - SEPARATOR_TOKENS) + "..."
+                continue
+
+            parts, previous = [label], -1
+            for row in sorted(selected):
+                if row != previous + 1:
+                    parts.append(GAP_MARKER)
+                parts.append(sentences[row])
+                previous = row
+            if previous != len(sentences) - 1:
+                parts.append(GAP_MARKER)
+            results[index] = "".join(parts)
+
+            self._count('documents')
+            self._count('sentences', len(sentences))
+            self._count('saved_tokens', estimate_tokens(documents[index]) - estimate_tokens(results[index]))
+        return results
+
+    def get_stats(self) -> dict:
+        with self._lock:
+            stats = dict(self.stats)
+        if self.sentence_cache is not None:
+            stats['sentence_cache'] = self.sentence_cache.get_stats()
+        return stats
+
+
+class ContextBuilder:
+    """按token预算组装提示词上下文
+
+    优先级依次为：检索到的文档（按排序，每篇最多doc_max_tokens，超出时用compressor按问题抽取相关的句子）、
+    最近的对话原文（从最新的消息往前，最近recent_turns轮以及尚未被摘要覆盖的更早消息）、
+    较早对话的滚动摘要。摘要按对话缓存，记录已覆盖的消息；最近recent_turns轮之前出现未覆盖的消息时
+    才在后台线程中用summarizer把它们并入已有摘要，不阻塞当前请求（当前请求使用已缓存的摘要）。
+    """
+
+    def __init__(self, token_budget: int = 4000, doc_max_tokens: int = 300, recent_turns: int = 3,
+                 summarizer: Callable[[str], str] = None, summary_max_tokens: int = 300, summary_cache=None,
+                 compressor: SentenceCompressor = None):
+        self.token_budget = token_budget
+        self.doc_max_tokens = doc_max_tokens
+        self.compressor = compressor
+        self.recent_messages = recent_turns * 2
+        self.summarizer = summarizer
+        self.summary_max_tokens = summary_max_tokens
+        # 对话ID -> {'summary', 'covered': 已并入摘要的消息指纹}，需要提供get/put/delete
+        self.summaries = summary_cache if summarizer is not None else None
+        self._executor = None
+        self._pending = set()
+        self._lock = threading.Lock()
+        self.stats = {
+            'requests': 0,
+            'prompt_tokens': 0,
+            'last_prompt_tokens': 0,
+            'api_requests': 0,
+            'api_prompt_tokens': 0,
+            'shortened_documents': 0,
+            'dropped_documents': 0,
+            'dropped_messages': 0,
+            'summaries_used': 0,
+            'summaries_generated': 0,
+            'summary_failures': 0
+        }
+
+    def _count(self, key: str, value: int = 1):
+        with self._lock:
+            self.stats[key] += value
+
+    def _build_documents(self, documents: List[Tuple[str, float]], budget: int,
+                         query_vector: np.ndarray = None) -> Tuple[List[str], int]:
+        # 先按排序依次分配每篇文档的预算（按压缩前后较大的token数预留），再一次性压缩全部超出预算的文档
+        prefixes, texts, budgets = [], [], []
+        reserved = 0
+        for i, (doc, score) in enumerate(documents):
+            prefix = f"【相关文档{i + 1}】(相似度:{score:.2f}): "
+            doc_budget = min(self.doc_max_tokens, budget - reserved - estimate_tokens(prefix) - SEPARATOR_TOKENS)
+            if doc_budget < MIN_PART_TOKENS:
+                self._count('dropped_documents', len(documents) - i)
+                break
+            prefixes.append(prefix)
+            texts.append(doc)
+            budgets.append(doc_budget)
+            reserved += estimate_tokens(prefix) + min(estimate_tokens(doc), doc_budget) + SEPARATOR_TOKENS
+
+        if self.compressor is not None and query_vector is not None:
+            texts = self.compressor.compress(query_vector, texts, budgets)
+        else:
+            texts = [text if estimate_tokens(text) <= doc_budget else
+                     truncate_tokens(text, doc_budget - SEPARATOR_TOKENS) + "..."
+                     for text, doc_budget in zip(texts, budgets)]
+        self._count('shortened_documents', sum(1 for text, (doc, _) in zip(texts, documents) if text != doc))
+
+        parts = [prefix + text for prefix, text in zip(prefixes, texts)]
+        return parts, sum(estimate_tokens(part) + SEPARATOR_TOKENS for part in parts)
+
+    def _valid_summary(self, conversation_id: str, fingerprints: Set[str]) -> Optional[dict]:
+        """取缓存的摘要；已覆盖的消息都不在当前历史中时（对话记忆被清空等）视为失效"""
+        if self.summaries is None or not conversation_id:
+            return None
+        entry = self.summaries.get(conversation_id)
+        if entry is None or not entry['covered'] & fingerprints:
+            return None
+        return entry
+
+    def build(self, template_tokens: int, documents: List[Tuple[str, float]], history: List[dict],
+              conversation_id: str = None, query_vector: np.ndarray = None) -> dict:
+        """组装上下文，template_tokens为不含上下文的提示词（模板和问题）的token数，query_vector用于压缩文档
+
+        返回 {'context', 'conversation_history', 'tokens': 各部分token数}
+        """
+        budget = self.token_budget - template_tokens
+        doc_parts, doc_tokens = self._build_documents(documents, budget, query_vector)
+        budget -= doc_tokens
+
+        turns = [(message['role'], message['content']) for message in history]
+        fingerprints = [_fingerprint(role, content) for role, content in turns]
+        entry = self._valid_summary(conversation_id, set(fingerprints))
+        covered = entry['covered'] if entry else set()
+
+        # 原文候选：最近recent_messages条消息，以及紧挨着它们、尚未并入摘要的更早消息
+        start = max(0, len(turns) - self.recent_messages)
+        while start > 0 and fingerprints[start - 1] not in covered:
+            start -= 1
+
+        header = "最近的对话历史：\n"
+        history_budget = budget - estimate_tokens(header) - SEPARATOR_TOKENS
+        lines, history_tokens = [], 0
+        first = len(turns)
+        for index in range(len(turns) - 1, start - 1, -1):
+            role, content = turns[index]
+            line = f"{_speaker(role)}: {content}"
+            tokens = estimate_tokens(line) + 4  # 序号和换行
+            if history_tokens + tokens > history_budget:
+                break
+            lines.append(line)
+            history_tokens += tokens
+            first = index
+        lines.reverse()
+
+        # 最近recent_messages条之前（或没有放入原文）的消息尚未并入摘要时，在后台更新摘要，
+        # 使它们在移出对话记忆之前已经被摘要覆盖；覆盖之前仍以原文放入
+        dropped = sum(1 for fingerprint in fingerprints[:first] if fingerprint not in covered)
+        self._count('dropped_messages', dropped)
+        boundary = max(first, len(turns) - self.recent_messages)
+        if any(fingerprint not in covered for fingerprint in fingerprints[:boundary]):
+            self._schedule_summary(conversation_id, turns[:boundary], set(fingerprints))
+
+        sections = []
+        summary_tokens = 0
+        if lines:
+            history_tokens += estimate_tokens(header) + SEPARATOR_TOKENS
+            budget -= history_tokens
+        if entry:
+            summary_header = "较早的对话摘要："
+            summary_budget = min(self.summary_max_tokens, budget - estimate_tokens(summary_header) - SEPARATOR_TOKENS)
+            if summary_budget >= MIN_PART_TOKENS:
+                summary = truncate_tokens(entry['summary'], summary_budget)
+                sections.append(summary_header + summary)
+                summary_tokens = estimate_tokens(sections[-1]) + SEPARATOR_TOKENS
+                self._count('summaries_used')
+        if lines:
+            sections.append(header + "".join(f"{i + 1}. {line}\n" for i, line in enumerate(lines)))
+
+        conversation_history = "\n\n".join(sections)
+        context_parts = doc_parts + ([conversation_history] if conversation_history else [])
+        return {
+            'context': "\n\n".join(context_parts) if context_parts else "无相关上下文",
+            'conversation_history': conversation_history or "无对话历史",
+            'tokens': {'documents': doc_tokens, 'history': history_tokens if lines else 0, 'summary': summary_tokens}
+        }
+
+    def _schedule_summary(self, conversation_id: str, older: List[Tuple[str, str]], fingerprints: Set[str]):
+        if self.summaries is None or not conversation_id:
+            return
+        with self._lock:
+            if conversation_id in self._pending:
+                return
+            self._pending.add(conversation_id)
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="context-summary")
+        self._executor.submit(self._refresh_summary, conversation_id, older, fingerprints)
+
+    def _refresh_summary(self, conversation_id: str, older: List[Tuple[str, str]], fingerprints: Set[str]):
+        """把尚未覆盖的较早消息并入摘要（后台线程）"""
+        try:
+            entry = self._valid_summary(conversation_id, fingerprints)
+            covered = entry['covered'] if entry else set()
+            new_turns = [(role, content) for role, content in older if _fingerprint(role, content) not in covered]
+            if not new_turns:
+                return
+
+            prompt = SUMMARY_PROMPT.format(
+                max_chars=int(self.summary_max_tokens / WIDE_CHAR_TOKENS),
+                summary=entry['summary'] if entry else "无",
+                turns="\n".join(f"{_speaker(role)}: {content}" for role, content in new_turns)
+            )
+            summary = truncate_tokens(self.summarizer(prompt).strip(), self.summary_max_tokens)
+            # 只保留仍在对话历史中的消息指纹，已移出历史的消息不会再出现
+            covered = (covered & fingerprints) | {_fingerprint(role, content) for role, content in new_turns}
+            self.summaries.put(conversation_id, {'summary': summary, 'covered': covered})
+            self._count('summaries_generated')
+        except Exception as e:
+            print(f"对话摘要生成失败: {e}")
+            self._count('summary_failures')
+        finally:
+            with self._lock:
+                self._pending.discard(conversation_id)
+
+    def clear(self, conversation_id: str):
+        if self.summaries is not None:
+            self.summaries.delete(conversation_id)
+
+    def record_prompt(self, prompt_tokens: int):
+        with self._lock:
+            self.stats['requests'] += 1
+            self.stats['prompt_tokens'] += prompt_tokens
+            self.stats['last_prompt_tokens'] = prompt_tokens
+
+    def record_usage(self, input_tokens: int):
+        """记录接口返回的实际提示词token数"""
+        with self._lock:
+            self.stats['api_requests'] += 1
+            self.stats['api_prompt_tokens'] += input_tokens
+
+    def get_stats(self) -> dict:
+        with self._lock:
+            stats = dict(self.stats)
+        stats['token_budget'] = self.token_budget
+        if self.compressor is not None:
+            stats['compression'] = self.compressor.get_stats()
+        stats['avg_prompt_tokens'] = stats['prompt_tokens'] / stats['requests'] if stats['requests'] else 0.0
+        stats['avg_api_prompt_tokens'] = (stats['api_prompt_tokens'] / stats['api_requests']
+                                          if stats['api_requests'] else 0.0)
+        return stats
@@ -0,0 +1,295 @@
+import json
+import time
+import sqlite3
+import threading
+from abc import ABC, abstractmethod
+from collections import OrderedDict, deque
+from typing import List, Optional, Tuple
+
+# 对话消息：(角色, 内容)，角色为user/assistant
+Turn = Tuple[str, str]
+
+
+class BaseConversationStore(ABC):
+    """对话记忆存储后端接口
+
+    每个对话只保存最近max_messages条消息。对话不存在（从未写入、被淘汰或过期）时get返回None，
+    append返回False，由ConversationMemory从消息表加载历史后调用create写入。
+    """
+
+    @abstractmethod
+    def get(self, conversation_id: str) -> Optional[List[Turn]]:
+        """对话的全部消息（按时间顺序），对话不存在时返回None"""
+
+    @abstractmethod
+    def append(self, conversation_id: str, role: str, content: str, max_messages: int) -> bool:
+        """在已存在的对话末尾追加一条消息并只保留最近max_messages条，对话不存在时返回False"""
+
+    @abstractmethod
+    def create(self, conversation_id: str, messages: List[Turn], max_messages: int) -> bool:
+        """对话不存在时用messages创建，已存在（例如其他工作进程刚刚创建）时不做修改并返回False"""
+
+    @abstractmethod
+    def delete(self, conversation_id: str):
+        """删除对话（清除记忆）"""
+
+    def get_stats(self) -> dict:
+        return {}
+
+
+class InProcessConversationStore(BaseConversationStore):
+    """进程内存储：最多保留max_conversations个对话，按最近使用顺序淘汰，超过idle_ttl秒未使用的对话也会被移除
+
+    多个工作进程之间不共享，同一对话的请求落到其他进程时会从消息表重新加载。
+    """
+
+    def __init__(self, max_conversations: int = 1000, idle_ttl: float = 3600):
+        self.max_conversations = max(1, max_conversations)
+        self.idle_ttl = idle_ttl
+        self.conversations = OrderedDict()  # 对话ID -> (消息deque, 最近使用时间)
+        self._lock = threading.Lock()
+        self.evictions = 0
+
+    def _evict(self):
+        """移除空闲超时的对话，并把对话数量限制在max_conversations以内（调用方需持有锁）"""
+        now = time.monotonic()
+        while self.conversations:
+            conversation_id, (_, last_used) = next(iter(self.conversations.items()))
+            if len(self.conversations) <= self.max_conversations and \
+                    not (self.idle_ttl and now - last_used > self.idle_ttl):
+                break
+            del self.conversations[conversation_id]
+            self.evictions += 1
+
+    def _touch(self, conversation_id: str) -> Optional[deque]:
+        self._evict()
+        entry = self.conversations.get(conversation_id)
+        if entry is None:
+            return None
+        self.conversations[conversation_id] = (entry[0], time.monotonic())
+        self.conversations.move_to_end(conversation_id)
+        return entry[0]
+
+    def get(self, conversation_id: str) -> Optional[List[Turn]]:
+        with self._lock:
+            history = self._touch(conversation_id)
+            return list(history) if history is not None else None
+
+    def append(self, conversation_id: str, role: str, content: str, max_messages: int) -> bool:
+        with self._lock:
+            history = self._touch(conversation_id)
+            if history is None:
+                return False
+            history.append((role, content))
+            return True
+
+    def create(self, conversation_id: str, messages: List[Turn], max_messages: int) -> bool:
+        with self._lock:
+            if self._touch(conversation_id) is not None:
+                return False
+            self.conversations[conversation_id] = (deque(messages, maxlen=max_messages), time.monotonic())
+            self._evict()
+            return True
+
+    def delete(self, conversation_id: str):
+        with self._lock:
+            self.conversations.pop(conversation_id, None)
+
+    def get_stats(self) -> dict:
+        with self._lock:
+            self._evict()
+            return {'backend': 'memory', 'size': len(self.conversations), 'evictions': self.evictions}
+
+
+class SQLiteConversationStore(BaseConversationStore):
+    """多个工作进程共享的SQLite存储（WAL模式，读操作不阻塞写操作）
+
+    追加和裁剪在同一个IMMEDIATE事务中完成；读取是一次按(对话ID, 消息ID)索引的查询。
+    最近使用时间在写入时更新（每轮问答都会写入），超过idle_ttl秒未写入的对话视为不存在，
+    创建新对话时清理过期对话，并按最近使用时间把对话数量限制在max_conversations以内。
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS conversations (
+            id TEXT PRIMARY KEY,
+            last_used REAL NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS idx_conversations_last_used ON conversations (last_used);
+        CREATE TABLE IF NOT EXISTS conversation_messages (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            conversation_id TEXT NOT NULL,
+            role TEXT NOT NULL,
+            content TEXT NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS idx_conversation_messages ON conversation_messages (conversation_id, id);
+    """
+
+    def __init__(self, file_path: str, max_conversations: int = 10000, idle_ttl: float = 3600):
+        self.file_path = file_path
+        self.max_conversations = max(1, max_conversations)
+        self.idle_ttl = idle_ttl
+        self._lock = threading.Lock()
+        # 自动提交模式，事务由_write显式开始
+        self._conn = sqlite3.connect(file_path, check_same_thread=False, timeout=30, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.executescript(self.SCHEMA)
+        self.evictions = 0
+
+    def _expired(self, last_used: float) -> bool:
+        return bool(self.idle_ttl) and time.time() - last_used > self.idle_ttl
+
+    def _write(self, operation):
+        """在IMMEDIATE事务中执行写操作（开始时即取得写锁，检查和修改之间不会被其他进程插入）"""
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                result = operation(self._conn)
+                self._conn.execute("COMMIT")
+                return result
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+
+    def _is_live(self, conn: sqlite3.Connection, conversation_id: str) -> bool:
+        row = conn.execute("SELECT last_used FROM conversations WHERE id = ?", (conversation_id,)).fetchone()
+        return row is not None and not self._expired(row[0])
+
+    @staticmethod
+    def _remove(conn: sqlite3.Connection, conversation_ids: List[str]):
+        for conversation_id in conversation_ids:
+            conn.execute("DELETE FROM conversation_messages WHERE conversation_id = ?", (conversation_id,))
+            conn.execute("DELETE FROM conversations WHERE id = ?", (conversation_id,))
+
+    @staticmethod
+    def _trim(conn: sqlite3.Connection, conversation_id: str, max_messages: int):
+        conn.execute("""
+            DELETE FROM conversation_messages WHERE conversation_id = ? AND id <= (
+                SELECT id FROM conversation_messages WHERE conversation_id = ?
+                ORDER BY id DESC LIMIT 1 OFFSET ?
+            )""", (conversation_id, conversation_id, max_messages))
+
+    def get(self, conversation_id: str) -> Optional[List[Turn]]:
+        with self._lock:
+            if not self._is_live(self._conn, conversation_id):
+                return None
+            rows = self._conn.execute(
+                "SELECT role, content FROM conversation_messages WHERE conversation_id = ? ORDER BY id",
+                (conversation_id,)).fetchall()
+        return [(role, content) for role, content in rows]
+
+    def append(self, conversation_id: str, role: str, content: str, max_messages: int) -> bool:
+        def operation(conn):
+            if not self._is_live(conn, conversation_id):
+                return False
+            conn.execute("INSERT INTO conversation_messages (conversation_id, role, content) VALUES (?, ?, ?)",
+                         (conversation_id, role, content))
+            self._trim(conn, conversation_id, max_messages)
+            conn.execute("UPDATE conversations SET last_used = ? WHERE id = ?", (time.time(), conversation_id))
+            return True
+
+        return self._write(operation)
+
+    def create(self, conversation_id: str, messages: List[Turn], max_messages: int) -> bool:
+        def operation(conn):
+            if self._is_live(conn, conversation_id):
+                return False
+
+            # 过期对话和超出数量上限的最久未使用对话
+            stale = [row[0] for row in conn.execute(
+                "SELECT id FROM conversations WHERE last_used < ? OR id = ?",
+                (time.time() - self.idle_ttl if self.idle_ttl else 0, conversation_id))]
+            self._remove(conn, stale)
+            count = conn.execute("SELECT COUNT(*) FROM conversations").fetchone()[0]
+            overflow = count + 1 - self.max_conversations
+            if overflow > 0:
+                oldest = [row[0] for row in conn.execute(
+                    "SELECT id FROM conversations ORDER BY last_used LIMIT ?", (overflow,))]
+                self._remove(conn, oldest)
+                stale += oldest
+            self.evictions += len([stale_id for stale_id in stale if stale_id != conversation_id])
+
+            conn.execute("INSERT INTO conversations (id, last_used) VALUES (?, ?)", (conversation_id, time.time()))
+            conn.executemany("INSERT INTO conversation_messages (conversation_id, role, content) VALUES (?, ?, ?)",
+                             [(conversation_id, role, content) for role, content in messages[-max_messages:]])
+            return True
+
+        return self._write(operation)
+
+    def delete(self, conversation_id: str):
+        self._write(lambda conn: self._remove(conn, [conversation_id]))
+
+    def get_stats(self) -> dict:
+        with self._lock:
+            size = self._conn.execute("SELECT COUNT(*) FROM conversations").fetchone()[0]
+        return {'backend': 'sqlite', 'path': self.file_path, 'size': size, 'evictions': self.evictions}
+
+
+class RedisConversationStore(BaseConversationStore):
+    """多个工作进程（或多台服务器）共享的Redis存储，兼容Redis协议的服务均可使用
+
+    每个对话是一个列表，元素为JSON编码的[角色, 内容]。追加用RPUSHX（对话不存在时不创建）+LTRIM+EXPIRE，
+    在一个MULTI事务中执行；读取是一次LRANGE。空闲过期由键的TTL实现，对话数量上限交给Redis的maxmemory淘汰策略。
+    client可以传入已创建的客户端（如测试用的fakeredis），否则按url连接。
+    """
+
+    def __init__(self, url: str = "redis://localhost:6379/0", idle_ttl: float = 3600,
+                 key_prefix: str = "legal_rag:conversation:", client=None):
+        if client is None:
+            import redis
+            client = redis.Redis.from_url(url)
+        self.client = client
+        self.idle_ttl = int(idle_ttl)
+        self.key_prefix = key_prefix
+
+    def _key(self, conversation_id: str) -> str:
+        return self.key_prefix + conversation_id
+
+    @staticmethod
+    def _encode(role: str, content: str) -> str:
+        return json.dumps([role, content], ensure_ascii=False)
+
+    def get(self, conversation_id: str) -> Optional[List[Turn]]:
+        items = self.client.lrange(self._key(conversation_id), 0, -1)
+        if not items:
+            return None
+        return [tuple(json.loads(item)) for item in items]
+
+    def append(self, conversation_id: str, role: str, content: str, max_messages: int) -> bool:
+        key = self._key(conversation_id)
+        pipe = self.client.pipeline(transaction=True)
+        pipe.rpushx(key, self._encode(role, content))
+        pipe.ltrim(key, -max_messages, -1)
+        if self.idle_ttl:
+            pipe.expire(key, self.idle_ttl)
+        return bool(pipe.execute()[0])
+
+    def create(self, conversation_id: str, messages: List[Turn], max_messages: int) -> bool:
+        from redis.exceptions import WatchError
+
+        messages = messages[-max_messages:]
+        if not messages:
+            # 空列表在Redis中不存在，没有历史的对话在第一次追加时创建
+            return False
+
+        key = self._key(conversation_id)
+        with self.client.pipeline(transaction=True) as pipe:
+            try:
+                # 乐观锁：WATCH之后键被其他进程创建则EXEC失败
+                pipe.watch(key)
+                if pipe.exists(key):
+                    return False
+                pipe.multi()
+                pipe.rpush(key, *(self._encode(role, content) for role, content in messages))
+                if self.idle_ttl:
+                    pipe.expire(key, self.idle_ttl)
+                pipe.execute()
+                return True
+            except WatchError:
+                return False
+
+    def delete(self, conversation_id: str):
+        self.client.delete(self._key(conversation_id))
+
+    def get_stats(self) -> dict:
+        return {'backend': 'redis'}
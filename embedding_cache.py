@@ -0,0 +1,138 @@
+import os
+import re
+import json
+import threading
+import numpy as np
+from typing import List, Optional
+
+
+class EmbeddingCache:
+    """持久化的文档块嵌入缓存，键为(嵌入模型, 规范化文本哈希)
+
+    每个模型一个目录，向量追加写入定长记录文件embeddings.bin（32字节SHA-256 + float32向量），
+    读取时通过内存映射按行取出，启动时只需扫描哈希列建立 哈希 -> 行号 的索引。
+    重建向量库、切换索引类型、构建知识库索引时，已缓存的文档块无需重新嵌入。
+    """
+
+    DATA_FILE = "embeddings.bin"
+    META_FILE = "meta.json"
+
+    def __init__(self, path: str, model_name: str):
+        self.model_name = model_name
+        self.path = os.path.join(path, re.sub(r"[^\w.-]+", "__", model_name))
+        self.dimension = None
+        self._dtype = None
+        self._rows = {}  # 哈希 -> 行号
+        self._mmap = None
+        self._count = 0
+        self._lock = threading.Lock()
+        self.stats = {'hits': 0, 'misses': 0, 'writes': 0}
+
+        meta_path = os.path.join(self.path, self.META_FILE)
+        if os.path.exists(meta_path):
+            with open(meta_path, 'r', encoding='utf-8') as file:
+                meta = json.load(file)
+            if meta.get('model') == model_name:
+                self._set_dimension(meta['dimension'])
+                self._load()
+
+    @staticmethod
+    def key(text_hash: str) -> bytes:
+        return bytes.fromhex(text_hash)
+
+    def __len__(self) -> int:
+        return len(self._rows)
+
+    def _set_dimension(self, dimension: int):
+        self.dimension = dimension
+        self._dtype = np.dtype([('key', 'u1', (32,)), ('vector', '<f4', (dimension,))])
+
+    def _data_path(self) -> str:
+        return os.path.join(self.path, self.DATA_FILE)
+
+    def _load(self):
+        """读取已有记录；上次写到一半的残缺记录直接截掉"""
+        data_path = self._data_path()
+        if not os.path.exists(data_path):
+            return
+
+        size = os.path.getsize(data_path)
+        if size % self._dtype.itemsize:
+            with open(data_path, 'r+b') as file:
+                file.truncate(size - size % self._dtype.itemsize)
+        self._refresh()
+
+    def _refresh(self):
+        """重新映射文件，读入新增记录的哈希（其他进程追加的记录也能看到）"""
+        data_path = self._data_path()
+        if self._dtype is None or not os.path.exists(data_path):
+            return
+
+        count = os.path.getsize(data_path) // self._dtype.itemsize
+        if count == self._count:
+            return
+
+        self._mmap = np.memmap(data_path, dtype=self._dtype, mode='r', shape=(count,)) if count else None
+        for row, key in enumerate(self._mmap['key'][self._count:count], start=self._count):
+            self._rows.setdefault(key.tobytes(), row)
+        self._count = count
+
+    def get_many(self, text_hashes: List[str]) -> List[Optional[np.ndarray]]:
+        """按文本哈希取缓存的向量，未命中为None"""
+        with self._lock:
+            keys = [self.key(text_hash) for text_hash in text_hashes]
+            if any(key not in self._rows for key in keys):
+                self._refresh()
+
+            results = []
+            for key in keys:
+                row = self._rows.get(key)
+                results.append(np.array(self._mmap[row]['vector']) if row is not None else None)
+            hits = sum(1 for vector in results if vector is not None)
+            self.stats['hits'] += hits
+            self.stats['misses'] += len(results) - hits
+            return results
+
+    def put_many(self, text_hashes: List[str], vectors: np.ndarray):
+        """追加新向量，已缓存的哈希跳过；一次写入整批记录"""
+        vectors = np.asarray(vectors, dtype=np.float32)
+        if len(text_hashes) == 0:
+            return
+
+        with self._lock:
+            if self.dimension is None:
+                os.makedirs(self.path, exist_ok=True)
+                self._set_dimension(vectors.shape[1])
+                with open(os.path.join(self.path, self.META_FILE), 'w', encoding='utf-8') as file:
+                    json.dump({'model': self.model_name, 'dimension': self.dimension}, file)
+            elif vectors.shape[1] != self.dimension:
+                print(f"嵌入维度 {vectors.shape[1]} 与缓存维度 {self.dimension} 不一致，跳过缓存")
+                return
+
+            self._refresh()
+            records = []
+            seen = set()
+            for text_hash, vector in zip(text_hashes, vectors):
+                key = self.key(text_hash)
+                if key not in self._rows and key not in seen:
+                    seen.add(key)
+                    records.append((key, vector))
+            if not records:
+                return
+
+            data = np.zeros(len(records), dtype=self._dtype)
+            data['key'] = np.frombuffer(b''.join(key for key, _ in records), dtype=np.uint8).reshape(-1, 32)
+            data['vector'] = np.stack([vector for _, vector in records])
+            # 追加模式下整批一次写入，多个进程同时写也不会交错
+            with open(self._data_path(), 'ab') as file:
+                file.write(data.tobytes())
+                file.flush()
+                os.fsync(file.fileno())
+            self.stats['writes'] += len(records)
+            self._refresh()
+
+    def get_stats(self) -> dict:
+        with self._lock:
+            stats = dict(self.stats)
+        stats['size'] = len(self._rows)
+        return stats
@@ -0,0 +1,197 @@
+import os
+import time
+import hashlib
+import multiprocessing
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from typing import List, Tuple, Callable, Iterator, Optional
+from langchain_community.document_loaders import PyPDFLoader, Docx2txtLoader, TextLoader
+from langchain.text_splitter import RecursiveCharacterTextSplitter
+from legal_splitter import LegalDocumentSplitter
+
+SUPPORTED_EXTENSIONS = ('.pdf', '.doc', '.docx', '.txt')
+
+# 切分器产生的、需要保留到向量库中的元数据
+CHUNK_METADATA_KEYS = ('page', 'law', 'part', 'chapter', 'section', 'article', 'article_key')
+
+
+def file_sha256(file_path: str, block_size: int = 1024 * 1024) -> str:
+    """分块计算文件的SHA-256，用于识别内容相同的文件"""
+    digest = hashlib.sha256()
+    with open(file_path, 'rb') as file:
+        for block in iter(lambda: file.read(block_size), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def create_text_splitter(max_chunk_size: int = 500) -> LegalDocumentSplitter:
+    """法律文档按编/章/节/条切分，每条法条一个文本块；其他文档按字符长度切分"""
+    return LegalDocumentSplitter(
+        fallback=RecursiveCharacterTextSplitter(
+            chunk_size=200,
+            chunk_overlap=20,
+            length_function=len
+        ),
+        max_chunk_size=max_chunk_size
+    )
+
+
+def create_loader(file_path: str):
+    """根据扩展名选择文档加载器，不支持的格式返回None"""
+    # 支持TXT文件
+    if file_path.lower().endswith('.pdf'):
+        return PyPDFLoader(file_path)
+    elif file_path.lower().endswith(('.doc', '.docx')):
+        return Docx2txtLoader(file_path)
+    elif file_path.lower().endswith('.txt'):
+        return TextLoader(file_path, encoding='utf-8')  # 处理TXT文件
+    return None
+
+
+def iter_file_chunks(file_path: str, metadata: dict = None, text_splitter=None,
+                     max_chunk_size: int = 500) -> Iterator[Tuple[str, dict]]:
+    """逐页读取文件并切分，逐个产出(文本块, 元数据)，不会把整个文件加载到内存"""
+    loader = create_loader(file_path)
+    if loader is None:
+        print(f"不支持的文件格式: {file_path}")
+        return
+
+    if text_splitter is None:
+        text_splitter = create_text_splitter(max_chunk_size)
+
+    base_metadata = {key: value for key, value in (metadata or {}).items() if value is not None}
+    base_metadata.setdefault('source', os.path.basename(file_path))
+
+    for doc in text_splitter.iter_split(loader.lazy_load(), source_name=base_metadata['source']):
+        chunk_metadata = dict(base_metadata)
+        for key in CHUNK_METADATA_KEYS:
+            if doc.metadata.get(key) is not None:
+                chunk_metadata[key] = doc.metadata[key]
+        yield doc.page_content, chunk_metadata
+
+
+def iter_file_batches(file_path: str, metadata: dict = None, text_splitter=None, batch_size: int = 64,
+                      max_chunk_size: int = 500) -> Iterator[Tuple[List[str], List[dict]]]:
+    """按batch_size个文本块一批产出(文本列表, 元数据列表)，内存占用只与批大小有关"""
+    texts, metadatas = [], []
+    for text, chunk_metadata in iter_file_chunks(file_path, metadata, text_splitter, max_chunk_size):
+        texts.append(text)
+        metadatas.append(chunk_metadata)
+        if len(texts) >= batch_size:
+            yield texts, metadatas
+            texts, metadatas = [], []
+
+    if texts:
+        yield texts, metadatas
+
+
+def load_file_chunks(file_path: str, metadata: dict = None, text_splitter=None,
+                     max_chunk_size: int = 500) -> Tuple[List[str], List[dict]]:
+    """解析文件并切分为文本块，返回文本和对应的元数据（附带页码和法条层级）"""
+    texts, metadatas = [], []
+    for text, chunk_metadata in iter_file_chunks(file_path, metadata, text_splitter, max_chunk_size):
+        texts.append(text)
+        metadatas.append(chunk_metadata)
+    return texts, metadatas
+
+
+def _parse_worker(file_path: str, metadata: dict, max_chunk_size: int):
+    """进程池中执行的解析任务，返回(文件路径, 文本, 元数据, 耗时, 错误信息)"""
+    start = time.perf_counter()
+    try:
+        texts, metadatas = load_file_chunks(file_path, metadata, max_chunk_size=max_chunk_size)
+        error = None
+    except Exception as e:
+        texts, metadatas, error = [], [], str(e)
+    return file_path, texts, metadatas, time.perf_counter() - start, error
+
+
+class IngestionPipeline:
+    """多文件并行入库流水线
+
+    解析和切分在进程池中并行执行；嵌入阶段在主进程中按完成顺序消费各文件的文本块，
+    凑满batch_size后统一嵌入。返回全部文本块、嵌入、元数据和本次的统计，由调用方一次性写入索引。
+    进程池使用spawn方式启动：流水线在后台线程中运行，主进程已加载torch和FAISS，
+    fork出的子进程会继承其他线程持有的锁。
+    """
+
+    def __init__(self, embed_func: Callable[[List[str]], np.ndarray], workers: int = None,
+                 batch_size: int = 256, max_chunk_size: int = 500):
+        self.embed_func = embed_func
+        self.workers = workers or os.cpu_count() or 1
+        self.batch_size = batch_size
+        self.max_chunk_size = max_chunk_size
+
+    def _iter_parsed(self, files: List[Tuple[str, dict]]):
+        if self.workers <= 1 or len(files) <= 1:
+            for file_path, metadata in files:
+                yield _parse_worker(file_path, metadata, self.max_chunk_size)
+            return
+
+        with ProcessPoolExecutor(max_workers=min(self.workers, len(files)),
+                                 mp_context=multiprocessing.get_context("spawn")) as executor:
+            futures = [executor.submit(_parse_worker, file_path, metadata, self.max_chunk_size)
+                       for file_path, metadata in files]
+            for future in as_completed(futures):
+                yield future.result()
+
+    def run(self, files: List[Tuple[str, dict]],
+            on_parsed: Callable[[str, int, Optional[str]], None] = None
+            ) -> Tuple[List[str], np.ndarray, List[dict], dict]:
+        """处理(文件路径, 元数据)列表，解析失败的文件跳过，返回(文本, 嵌入, 元数据, 各阶段统计)
+
+        on_parsed(文件路径, 文本块数量, 错误信息)在每个文件解析完成（或失败）时调用，用于上报进度。
+        """
+        start = time.perf_counter()
+        parse_seconds = 0.0
+        embed_seconds = 0.0
+        failed = 0
+
+        all_texts, all_metadatas, embedded = [], [], []
+        pending_texts = []
+
+        def embed_batch(batch: List[str]):
+            nonlocal embed_seconds
+            embed_start = time.perf_counter()
+            embedded.append(self.embed_func(batch))
+            embed_seconds += time.perf_counter() - embed_start
+
+        for file_path, texts, metadatas, seconds, error in self._iter_parsed(files):
+            parse_seconds += seconds
+            if on_parsed is not None:
+                on_parsed(file_path, len(texts), error)
+            if error is not None:
+                failed += 1
+                print(f"解析文件 {file_path} 失败: {error}")
+                continue
+
+            print(f"已解析文件: {file_path}, {len(texts)} 个文本块")
+            all_texts.extend(texts)
+            all_metadatas.extend(metadatas)
+
+            # 多个文件的文本块合并成大批次嵌入
+            pending_texts.extend(texts)
+            while len(pending_texts) >= self.batch_size:
+                embed_batch(pending_texts[:self.batch_size])
+                del pending_texts[:self.batch_size]
+
+        if pending_texts:
+            embed_batch(pending_texts)
+
+        total_seconds = time.perf_counter() - start
+        parsed_files = len(files) - failed
+        stats = {
+            'files': parsed_files,
+            'failed_files': failed,
+            'chunks': len(all_texts),
+            'workers': self.workers,
+            'parse_worker_seconds': round(parse_seconds, 3),  # 各进程解析耗时之和
+            'embed_seconds': round(embed_seconds, 3),
+            'total_seconds': round(total_seconds, 3),
+            'files_per_second': round(parsed_files / total_seconds, 2) if total_seconds else None,
+            'embed_chunks_per_second': round(len(all_texts) / embed_seconds, 2) if embed_seconds else None
+        }
+        print(f"入库流水线完成: {stats}")
+
+        embeddings = np.concatenate(embedded) if embedded else np.zeros((0, 0), dtype=np.float32)
+        return all_texts, embeddings, all_metadatas, stats
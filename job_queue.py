@@ -0,0 +1,102 @@
+import time
+import queue
+import threading
+from typing import Callable, List
+
+
+class BackgroundJobQueue:
+    """后台任务队列
+
+    任务以ID的形式提交，工作线程取到一个任务后再等待batch_wait秒收集更多任务，
+    最多batch_size个一起交给handler处理（多个上传文件合并成一批嵌入）。
+    任务状态由handler自行持久化，队列本身只负责调度；失败重试通过submit(job_id, delay)延迟重新入队。
+    工作线程在第一次start()时才启动，避免调试模式下重载器的父进程也处理任务。
+    """
+
+    def __init__(self, handler: Callable[[List[int]], None], workers: int = 1,
+                 batch_size: int = 8, batch_wait: float = 0.5):
+        self.handler = handler
+        self.workers = max(1, workers)
+        self.batch_size = max(1, batch_size)
+        self.batch_wait = batch_wait
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._threads = []
+        self._timers = set()
+        self.stats = {'submitted': 0, 'batches': 0, 'jobs': 0, 'retries': 0, 'errors': 0}
+
+    @property
+    def started(self) -> bool:
+        return bool(self._threads)
+
+    def start(self):
+        with self._lock:
+            if self._threads:
+                return
+            for i in range(self.workers):
+                thread = threading.Thread(target=self._run, name=f"ingestion-worker-{i}", daemon=True)
+                thread.start()
+                self._threads.append(thread)
+        print(f"后台入库队列已启动，工作线程数: {self.workers}")
+
+    def submit(self, job_id: int, delay: float = 0):
+        """提交任务，delay秒后才进入队列（用于失败重试的退避）"""
+        with self._lock:
+            self.stats['submitted'] += 1
+            if delay > 0:
+                self.stats['retries'] += 1
+
+        if delay <= 0:
+            self._queue.put(job_id)
+            return
+
+        def enqueue():
+            with self._lock:
+                self._timers.discard(timer)
+            self._queue.put(job_id)
+
+        timer = threading.Timer(delay, enqueue)
+        timer.daemon = True
+        with self._lock:
+            self._timers.add(timer)
+        timer.start()
+
+    def pending(self) -> int:
+        return self._queue.qsize()
+
+    def get_stats(self) -> dict:
+        with self._lock:
+            stats = dict(self.stats)
+            stats['delayed'] = len(self._timers)
+        stats['pending'] = self.pending()
+        stats['workers'] = len(self._threads)
+        return stats
+
+    def _collect_batch(self) -> List[int]:
+        batch = [self._queue.get()]
+        deadline = time.monotonic() + self.batch_wait
+        while len(batch) < self.batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                job_id = self._queue.get(timeout=remaining)
+            except queue.Empty:
+                break
+            if job_id not in batch:
+                batch.append(job_id)
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._collect_batch()
+            try:
+                self.handler(batch)
+            except Exception as e:
+                # handler负责记录每个任务的状态，这里只兜底，保证工作线程不退出
+                print(f"后台入库任务处理异常: {e}")
+                with self._lock:
+                    self.stats['errors'] += 1
+            with self._lock:
+                self.stats['batches'] += 1
+                self.stats['jobs'] += len(batch)
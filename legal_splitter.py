@@ -0,0 +1,209 @@
+import os
+import re
+import itertools
+from typing import List, Optional, Tuple, Iterable, Iterator
+from langchain_core.documents import Document
+from langchain.text_splitter import RecursiveCharacterTextSplitter
+
+_NUMERAL = r"[零〇一二三四五六七八九十百千两\d]+"
+
+_PART_RE = re.compile(rf"^第{_NUMERAL}编(?:[\s　]+|$)")
+_CHAPTER_RE = re.compile(rf"^第{_NUMERAL}章(?:[\s　]+|$)")
+_SECTION_RE = re.compile(rf"^第{_NUMERAL}节(?:[\s　]+|$)")
+_ARTICLE_RE = re.compile(rf"^第({_NUMERAL})条(?:之([一二三四五六七八九十]+))?(?:[\s　]+|$)")
+
+# 句子（分句）结尾：句号、问号、感叹号、分号和换行，标点保留在句子末尾
+_SENTENCE_END_RE = re.compile(r"(?<=[。！？；;!?\n])")
+
+# 问题中引用的法条，如"刑法第二百六十四条"、"《消费者权益保护法》第55条"
+_CITATION_RE = re.compile(
+    rf"《?([\u4e00-\u9fff]{{1,30}}?法)》?第({_NUMERAL})条(?:之([一二三四五六七八九十]+))?")
+
+_DIGITS = {'零': 0, '〇': 0, '一': 1, '二': 2, '两': 2, '三': 3, '四': 4,
+           '五': 5, '六': 6, '七': 7, '八': 8, '九': 9}
+_UNITS = {'十': 10, '百': 100, '千': 1000}
+
+# 法条至少出现这么多次才按法条结构切分，否则视为普通文档
+MIN_ARTICLES = 3
+
+
+def chinese_to_int(text: str) -> int:
+    """中文数字转整数，如"二百六十四" -> 264，也支持阿拉伯数字"""
+    if text.isdigit():
+        return int(text)
+
+    total, current = 0, 0
+    for char in text:
+        if char in _DIGITS:
+            current = _DIGITS[char]
+        elif char in _UNITS:
+            total += (current or 1) * _UNITS[char]
+            current = 0
+    return total + current
+
+
+def normalize_law_name(name: str) -> str:
+    """规范化法律名称：去掉"中华人民共和国"前缀、年份和修订说明，如"中华人民共和国刑法2020" -> "刑法" """
+    name = os.path.splitext(os.path.basename(name))[0]
+    name = re.sub(r"[【（(\[].*?[】）)\]]", "", name)
+    name = re.sub(r"\d+", "", name)
+    name = name.replace("中华人民共和国", "")
+    return name.strip()
+
+
+def article_key(law: str, article_no: int, sub_no: int = None) -> str:
+    """法条查找键，如"刑法:264"、"刑法:120-1"（第一百二十条之一）"""
+    key = f"{law}:{article_no}"
+    return f"{key}-{sub_no}" if sub_no else key
+
+
+def parse_citations(query: str, known_laws) -> List[str]:
+    """从问题中解析引用的法条，返回法条查找键；法律名称按已知法律的最长后缀匹配"""
+    known_laws = sorted(known_laws, key=len, reverse=True)
+    keys = []
+    for name, number, sub in _CITATION_RE.findall(query):
+        name = name.replace("中华人民共和国", "")
+        law = next((known for known in known_laws if name.endswith(known)), None)
+        if law is None:
+            continue
+        key = article_key(law, chinese_to_int(number), chinese_to_int(sub) if sub else None)
+        if key not in keys:
+            keys.append(key)
+    return keys
+
+
+def article_label(text: str) -> str:
+    """文本块开头的法条序号，如"第九十五条 "，不是法条时返回空字符串"""
+    match = _ARTICLE_RE.match(text)
+    return text[:match.end()] if match else ""
+
+
+def split_sentences(text: str) -> List[str]:
+    """按句号、分号、换行等切分句子，各句依次拼接即为原文（只有空白的部分并入前一句）"""
+    sentences = []
+    for sentence in _SENTENCE_END_RE.split(text):
+        if sentences and not sentence.strip():
+            sentences[-1] += sentence
+        elif sentence:
+            sentences.append(sentence)
+    return sentences
+
+
+class LegalDocumentSplitter:
+    """法律文档切分器
+
+    识别编/章/节/第X条结构，每条法条生成一个文本块，层级信息写入元数据
+    （law、part、chapter、section、article、article_key）。超长法条按max_chunk_size
+    再切分，只有第一块以"第X条"开头；没有正文的条目（目录）不生成文本块。
+    识别不到法条结构的文档交给fallback切分器处理。支持逐页流式处理。
+    """
+
+    def __init__(self, fallback, max_chunk_size: int = 500, lookahead_pages: int = 10):
+        self.fallback = fallback
+        self.max_chunk_size = max_chunk_size
+        self.lookahead_pages = lookahead_pages
+        self.article_splitter = RecursiveCharacterTextSplitter(
+            chunk_size=max_chunk_size,
+            chunk_overlap=0,
+            separators=["\n", "。", "；", ""]
+        )
+
+    def _iter_lines(self, pages: Iterable[Document]):
+        for page in pages:
+            for line in page.page_content.splitlines():
+                line = line.strip()
+                if line:
+                    yield line, page.metadata.get('page')
+
+    def _emit(self, lines: List[str], metadata: dict) -> Iterator[Document]:
+        text = "\n".join(lines)
+        if text.strip() == metadata['article']:
+            # 只有"第X条"而没有正文（目录中的条目），不生成文本块
+            return
+        if len(text) <= self.max_chunk_size:
+            yield Document(page_content=text, metadata=metadata)
+            return
+
+        for piece in self.article_splitter.split_text(text):
+            yield Document(page_content=piece, metadata=dict(metadata))
+
+    def iter_statute(self, pages: Iterable[Document], law: str, source_metadata: dict) -> Iterator[Document]:
+        """逐页处理法律文档，每读完一条法条就产出对应的文本块"""
+        hierarchy = {'part': None, 'chapter': None, 'section': None}
+        preamble = []
+        current: Optional[Tuple[List[str], dict]] = None
+
+        for line, page in self._iter_lines(pages):
+            heading = None
+            if _PART_RE.match(line):
+                heading = ('part', ('chapter', 'section'))
+            elif _CHAPTER_RE.match(line):
+                heading = ('chapter', ('section',))
+            elif _SECTION_RE.match(line):
+                heading = ('section', ())
+
+            if heading is not None:
+                level, children = heading
+                hierarchy[level] = re.sub(r"[\s　]+", " ", line)
+                for child in children:
+                    hierarchy[child] = None
+                continue
+
+            match = _ARTICLE_RE.match(line)
+            if match:
+                if current is not None:
+                    yield from self._emit(*current)
+                elif preamble:
+                    # 第一条之前的内容（标题、目录、前言）按普通文本切分
+                    preamble_doc = Document(page_content="\n".join(preamble), metadata=dict(source_metadata, law=law))
+                    yield from self.fallback.split_documents([preamble_doc])
+                    preamble = []
+
+                article_no = chinese_to_int(match.group(1))
+                sub_no = chinese_to_int(match.group(2)) if match.group(2) else None
+                metadata = dict(source_metadata)
+                metadata.update({key: value for key, value in hierarchy.items() if value})
+                metadata.update({
+                    'law': law,
+                    'article': line[:match.end()].strip(),
+                    'article_key': article_key(law, article_no, sub_no)
+                })
+                if page is not None:
+                    metadata['page'] = page
+                current = ([line], metadata)
+            elif current is not None:
+                current[0].append(line)
+            else:
+                preamble.append(line)
+
+        if current is not None:
+            yield from self._emit(*current)
+
+    def iter_split(self, pages: Iterable[Document], source_name: str = None) -> Iterator[Document]:
+        """流式切分：先预读少量页面判断是否为法律文档，之后逐页产出文本块，内存占用与文档大小无关"""
+        pages = iter(pages)
+        lookahead = []
+        article_count = 0
+        for page in pages:
+            lookahead.append(page)
+            article_count += sum(1 for line, _ in self._iter_lines([page]) if _ARTICLE_RE.match(line))
+            if article_count >= MIN_ARTICLES or len(lookahead) >= self.lookahead_pages:
+                break
+
+        if not lookahead:
+            return
+
+        all_pages = itertools.chain(lookahead, pages)
+        if article_count < MIN_ARTICLES:
+            # 普通文档逐页按字符长度切分
+            for page in all_pages:
+                yield from self.fallback.split_documents([page])
+            return
+
+        source_metadata = {key: value for key, value in lookahead[0].metadata.items() if key != 'page'}
+        law = normalize_law_name(source_name or source_metadata.get('source', ''))
+        yield from self.iter_statute(all_pages, law, source_metadata)
+
+    def split_documents(self, pages: List[Document], source_name: str = None) -> List[Document]:
+        """切分文档，source_name为原始文件名（用于识别法律名称，默认取页面元数据中的source）"""
+        return list(self.iter_split(pages, source_name))
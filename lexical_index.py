@@ -0,0 +1,128 @@
+import re
+import json
+import math
+import unicodedata
+from collections import Counter
+from typing import List, Tuple, Iterable, Optional
+
+try:
+    import jieba
+except ImportError:
+    jieba = None
+
+TOKENIZER_NAME = "jieba" if jieba is not None else "bigram"
+
+_CJK_RUN = re.compile(r"[\u4e00-\u9fff]+")
+_WORD_RUN = re.compile(r"[\u4e00-\u9fff]+|[a-z0-9]+")
+
+
+def tokenize(text: str) -> List[str]:
+    """中文分词：安装了jieba时使用搜索引擎模式分词，否则使用汉字二元组；英文和数字按整词切分"""
+    text = unicodedata.normalize("NFKC", text).lower()
+
+    if jieba is not None:
+        return [token for token in jieba.cut_for_search(text) if _WORD_RUN.fullmatch(token)]
+
+    tokens = []
+    for run in _WORD_RUN.findall(text):
+        if _CJK_RUN.fullmatch(run) and len(run) > 1:
+            tokens.extend(run[i:i + 2] for i in range(len(run) - 1))
+        else:
+            tokens.append(run)
+    return tokens
+
+
+class BM25Index:
+    """文档块的倒排索引，使用BM25打分
+
+    与向量索引共用向量ID，可以按向量ID集合过滤（知识库/用户范围）。
+    """
+
+    def __init__(self, k1: float = 1.5, b: float = 0.75):
+        self.k1 = k1
+        self.b = b
+        self.postings = {}  # 词 -> {向量ID: 词频}
+        self.doc_lengths = {}  # 向量ID -> 文档长度（词数）
+        self.total_length = 0
+
+    def __len__(self) -> int:
+        return len(self.doc_lengths)
+
+    def add(self, vector_id: int, text: str):
+        tokens = tokenize(text)
+        for term, tf in Counter(tokens).items():
+            self.postings.setdefault(term, {})[vector_id] = tf
+        self.doc_lengths[vector_id] = len(tokens)
+        self.total_length += len(tokens)
+
+    def remove(self, vector_id: int, text: str):
+        if vector_id not in self.doc_lengths:
+            return
+
+        for term in set(tokenize(text)):
+            posting = self.postings.get(term)
+            if posting is not None:
+                posting.pop(vector_id, None)
+                if not posting:
+                    del self.postings[term]
+        self.total_length -= self.doc_lengths.pop(vector_id)
+
+    def search(self, query: str, k: int = 10, allowed_ids: Optional[set] = None) -> List[Tuple[int, float]]:
+        """返回BM25得分最高的k个(向量ID, 得分)，allowed_ids不为None时只在其中检索"""
+        n_docs = len(self.doc_lengths)
+        if n_docs == 0:
+            return []
+
+        avg_length = self.total_length / n_docs
+        scores = {}
+        for term in set(tokenize(query)):
+            posting = self.postings.get(term)
+            if not posting:
+                continue
+
+            idf = math.log(1 + (n_docs - len(posting) + 0.5) / (len(posting) + 0.5))
+            for vector_id, tf in posting.items():
+                if allowed_ids is not None and vector_id not in allowed_ids:
+                    continue
+                norm = self.k1 * (1 - self.b + self.b * self.doc_lengths[vector_id] / avg_length)
+                scores[vector_id] = scores.get(vector_id, 0.0) + idf * tf * (self.k1 + 1) / (tf + norm)
+
+        return sorted(scores.items(), key=lambda x: x[1], reverse=True)[:k]
+
+    def to_json(self) -> str:
+        return json.dumps({
+            'tokenizer': TOKENIZER_NAME,
+            'postings': {term: [[vector_id, tf] for vector_id, tf in posting.items()]
+                         for term, posting in self.postings.items()},
+            'doc_lengths': [[vector_id, length] for vector_id, length in self.doc_lengths.items()]
+        }, ensure_ascii=False)
+
+    @classmethod
+    def from_json(cls, data: str) -> Optional["BM25Index"]:
+        """从JSON恢复，分词器与当前环境不一致时返回None（需要重建）"""
+        data = json.loads(data)
+        if data.get('tokenizer') != TOKENIZER_NAME:
+            return None
+
+        index = cls()
+        index.postings = {term: {vector_id: tf for vector_id, tf in posting}
+                          for term, posting in data['postings'].items()}
+        index.doc_lengths = {vector_id: length for vector_id, length in data['doc_lengths']}
+        index.total_length = sum(index.doc_lengths.values())
+        return index
+
+    @classmethod
+    def build(cls, items: Iterable[Tuple[int, str]]) -> "BM25Index":
+        index = cls()
+        for vector_id, text in items:
+            index.add(vector_id, text)
+        return index
+
+
+def reciprocal_rank_fusion(rankings: List[List[int]], k: int = 60) -> List[Tuple[int, float]]:
+    """倒数排名融合：score = sum(1 / (k + rank))"""
+    scores = {}
+    for ranking in rankings:
+        for rank, vector_id in enumerate(ranking):
+            scores[vector_id] = scores.get(vector_id, 0.0) + 1.0 / (k + rank + 1)
+    return sorted(scores.items(), key=lambda x: x[1], reverse=True)
@@ -1,52 +1,158 @@
-from langchain_community.document_loaders import PyPDFLoader, Docx2txtLoader, TextLoader
 from langchain_openai import ChatOpenAI
-from langchain.text_splitter import RecursiveCharacterTextSplitter
-from langchain_community.vectorstores.faiss import FAISS
 from langchain_huggingface import HuggingFaceEmbeddings
+from langchain_core.embeddings import Embeddings
+from langchain_core.messages import AIMessageChunk
 import os
-import requests
+import shutil
+import asyncio
 import yaml
+import string
+import time
+import unicodedata
 import numpy as np
-from typing import List, Tuple
+import threading
+from collections import OrderedDict
+from typing import List, Tuple, Optional, Callable
 from dotenv import load_dotenv
-from datetime import datetime
+from vector_store import LegalVectorStore, load_vector_store, content_hash
+from chunk_store import release_writer_locks, try_acquire_writer_lock
+from embedding_cache import EmbeddingCache
+from legal_splitter import parse_citations
+from ingestion import (SUPPORTED_EXTENSIONS, IngestionPipeline, create_text_splitter, file_sha256,
+                       iter_file_batches, load_file_chunks)
+from reranker import BaseReranker, RemoteReranker, LocalCrossEncoderReranker
+from context_builder import ContextBuilder, SentenceCompressor, estimate_tokens
+from conversation_store import (BaseConversationStore, InProcessConversationStore, SQLiteConversationStore,
+                                RedisConversationStore)
 
 load_dotenv()
 
 
+async def _aiter(items):
+    """把列表包装成异步迭代器"""
+    for item in items:
+        yield item
+
+
+def _detect_embedding_device() -> str:
+    """自动检测嵌入模型运行设备"""
+    try:
+        import torch
+        return 'cuda' if torch.cuda.is_available() else 'cpu'
+    except ImportError:
+        return 'cpu'
+
+
+class SharedEmbeddings(Embeddings):
+    """进程内共享的嵌入模型
+
+    首次调用时才加载HuggingFace模型，所有DeepSeekApiRag实例共用同一份模型。
+    """
+
+    def __init__(self, model_name: str, device: str = None, num_threads: int = None, batch_size: int = 32):
+        self.model_name = model_name
+        self.device = device
+        self.num_threads = num_threads
+        self.batch_size = batch_size
+        self._model = None
+        self._lock = threading.Lock()
+
+    @property
+    def model(self) -> HuggingFaceEmbeddings:
+        if self._model is None:
+            with self._lock:
+                if self._model is None:
+                    device = self.device or _detect_embedding_device()
+                    if self.num_threads:
+                        import torch
+                        torch.set_num_threads(self.num_threads)
+
+                    print(f"正在加载嵌入模型: {self.model_name} (device={device})")
+                    self._model = HuggingFaceEmbeddings(
+                        model_name=self.model_name,
+                        model_kwargs={'device': device},
+                        encode_kwargs={
+                            'normalize_embeddings': True,  # 标准化嵌入
+                            'batch_size': self.batch_size
+                        }
+                    )
+        return self._model
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        return self.model.embed_documents(texts)
+
+    def embed_query(self, text: str) -> List[float]:
+        return self.model.embed_query(text)
+
+
+_shared_embeddings = None
+_shared_embeddings_lock = threading.Lock()
+
+
+def get_embedding_model() -> SharedEmbeddings:
+    """获取进程内共享的嵌入模型（按环境变量配置）"""
+    global _shared_embeddings
+    with _shared_embeddings_lock:
+        if _shared_embeddings is None:
+            num_threads = os.getenv("EMBEDDING_NUM_THREADS")
+            _shared_embeddings = SharedEmbeddings(
+                model_name=os.getenv("EMBEDDING_MODEL", "BAAI/bge-small-zh-v1.5"),
+                device=os.getenv("EMBEDDING_DEVICE") or None,
+                num_threads=int(num_threads) if num_threads else None,
+                batch_size=int(os.getenv("EMBEDDING_BATCH_SIZE", "32"))
+            )
+    return _shared_embeddings
+
+
 class ConversationMemory:
-    """对话记忆管理类"""
+    """对话记忆管理类
+
+    每个对话只保存最近max_history_turns轮的(角色, 内容)，存储在可替换的后端中（见conversation_store）。
+    对话不在存储中时（被淘汰、过期或服务重启）通过history_loader从消息表中读取最近的消息，
+    淘汰不会改变回答所用的对话历史。
+    """
 
-    def __init__(self, max_history_turns: int = 5):
+    def __init__(self, max_history_turns: int = 5, store: BaseConversationStore = None,
+                 history_loader: Callable[[str, int], List[Tuple[str, str]]] = None):
         self.max_history_turns = max_history_turns
-        self.conversations = {}
+        self.store = store or InProcessConversationStore()
+        # (conversation_id, 最大消息数) -> 按时间顺序的[(角色, 内容)]，角色为user/assistant
+        self.history_loader = history_loader
+        self._lock = threading.Lock()
+        self.stats = {'hits': 0, 'loads': 0}
 
-    def add_message(self, conversation_id: str, role: str, content: str):
-        """添加消息到对话历史"""
-        if conversation_id not in self.conversations:
-            self.conversations[conversation_id] = {
-                'history': [],
-                'created_at': datetime.now()
-            }
+    @property
+    def max_messages(self) -> int:
+        return self.max_history_turns * 2
 
-        conversation = self.conversations[conversation_id]
-        conversation['history'].append({
-            'role': role,
-            'content': content,
-            'timestamp': datetime.now()
-        })
+    def _count(self, key: str):
+        with self._lock:
+            self.stats[key] += 1
 
-        # 保留最近5轮对话
-        max_messages = self.max_history_turns * 2
-        if len(conversation['history']) > max_messages:
-            conversation['history'] = conversation['history'][-max_messages:]
+    def _load(self, conversation_id: str) -> List[Tuple[str, str]]:
+        self._count('loads')
+        return self.history_loader(conversation_id, self.max_messages) if self.history_loader else []
+
+    def add_message(self, conversation_id: str, role: str, content: str):
+        """添加消息到对话历史（存储后端只保留最近的消息）"""
+        if self.store.append(conversation_id, role, content, self.max_messages):
+            return
+
+        # 对话不在存储中：加载历史后连同这条消息一起写入；其他进程已抢先创建时改为追加
+        history = self._load(conversation_id) + [(role, content)]
+        if not self.store.create(conversation_id, history, self.max_messages):
+            self.store.append(conversation_id, role, content, self.max_messages)
 
     def get_recent_history(self, conversation_id: str) -> List[dict]:
         """获取最近的对话历史"""
-        if conversation_id not in self.conversations:
-            return []
-
-        return self.conversations[conversation_id]['history']
+        history = self.store.get(conversation_id)
+        if history is not None:
+            self._count('hits')
+        else:
+            history = self._load(conversation_id)[-self.max_messages:]
+            if history and not self.store.create(conversation_id, history, self.max_messages):
+                history = self.store.get(conversation_id) or history
+        return [{'role': role, 'content': content} for role, content in history]
 
     def get_formatted_history(self, conversation_id: str) -> str:
         """获取格式化的对话历史"""
@@ -62,9 +168,340 @@ class ConversationMemory:
         return formatted
 
     def clear_conversation(self, conversation_id: str):
-        """清空特定对话的记忆"""
-        if conversation_id in self.conversations:
-            del self.conversations[conversation_id]
+        """清空特定对话的记忆（消息表中的清空位置由调用方记录，否则下次会重新加载）"""
+        self.store.delete(conversation_id)
+
+    def get_stats(self) -> dict:
+        with self._lock:
+            stats = dict(self.stats)
+        stats.update(self.store.get_stats())
+        return stats
+
+
+class LRUCache:
+    """带过期时间的LRU缓存（线程安全），记录命中/未命中次数"""
+
+    def __init__(self, max_size: int = 1024, ttl: float = 3600):
+        self.max_size = max(1, max_size)
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None or (self.ttl and time.monotonic() - entry[1] > self.ttl):
+                if entry is not None:
+                    del self._data[key]
+                self.misses += 1
+                return None
+
+            self._data.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key, value):
+        with self._lock:
+            self._data[key] = (value, time.monotonic())
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def get_stats(self) -> dict:
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                'size': len(self._data),
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / total if total else 0.0
+            }
+
+
+class SemanticAnswerCache:
+    """语义回答缓存
+
+    以问题的嵌入向量为键，新问题与缓存问题的余弦相似度超过阈值、
+    且作用域（知识库、提示词、索引版本）一致时直接复用之前的回答。
+    """
+
+    def __init__(self, max_size: int = 256, ttl: float = 3600, threshold: float = 0.95):
+        self.max_size = max(1, max_size)
+        self.ttl = ttl
+        self.threshold = threshold
+        self._entries = OrderedDict()  # 条目ID -> (嵌入向量, 作用域, 回答, 写入时间)
+        self._next_id = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def _evict_expired(self):
+        now = time.monotonic()
+        expired = [key for key, entry in self._entries.items() if self.ttl and now - entry[3] > self.ttl]
+        for key in expired:
+            del self._entries[key]
+
+    def lookup(self, embedding: np.ndarray, scope) -> Optional[str]:
+        """查找相似问题的回答，未命中返回None"""
+        with self._lock:
+            self._evict_expired()
+            candidates = [(key, entry) for key, entry in self._entries.items() if entry[1] == scope]
+            if not candidates:
+                self.misses += 1
+                return None
+
+            # 向量已标准化，一次矩阵乘法得到全部余弦相似度
+            matrix = np.stack([entry[0] for _, entry in candidates])
+            similarities = matrix @ embedding
+            best = int(np.argmax(similarities))
+            if similarities[best] < self.threshold:
+                self.misses += 1
+                return None
+
+            key, entry = candidates[best]
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[2]
+
+    def put(self, embedding: np.ndarray, scope, answer: str):
+        with self._lock:
+            self._entries[self._next_id] = (embedding, scope, answer, time.monotonic())
+            self._next_id += 1
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def get_stats(self) -> dict:
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                'size': len(self._entries),
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / total if total else 0.0
+            }
+
+
+class PromptLoader:
+    """提示词模板加载器
+
+    YAML文件解析一次后缓存在内存中，只有文件修改时间变化时才重新加载；
+    加载时校验所有模板的占位符。
+    """
+
+    REQUIRED_PLACEHOLDERS = {'query', 'context'}
+    OPTIONAL_PLACEHOLDERS = {'conversation_history'}
+
+    def __init__(self, prompts_path: str):
+        self.prompts_path = prompts_path
+        self._prompts = None
+        self._mtime = None
+        self._lock = threading.Lock()
+
+    @classmethod
+    def validate(cls, prompts: dict):
+        """校验模板占位符，缺少必需占位符或包含未知占位符时抛出ValueError"""
+        if not prompts or not isinstance(prompts, dict):
+            raise ValueError("提示词文件为空或格式不正确")
+
+        allowed = cls.REQUIRED_PLACEHOLDERS | cls.OPTIONAL_PLACEHOLDERS
+        for name, template in prompts.items():
+            if not isinstance(template, str):
+                raise ValueError(f"提示词 '{name}' 不是字符串")
+            try:
+                fields = {field for _, field, _, _ in string.Formatter().parse(template) if field is not None}
+            except ValueError as e:
+                raise ValueError(f"提示词 '{name}' 格式错误: {e}")
+
+            missing = cls.REQUIRED_PLACEHOLDERS - fields
+            if missing:
+                raise ValueError(f"提示词 '{name}' 缺少占位符: {', '.join(sorted(missing))}")
+            unknown = fields - allowed
+            if unknown:
+                raise ValueError(f"提示词 '{name}' 包含未知占位符: {', '.join(sorted(unknown))}")
+            for field in sorted(cls.OPTIONAL_PLACEHOLDERS - fields):
+                print(f"警告: 提示词 '{name}' 未使用占位符 {field}")
+
+    def _load(self):
+        if not os.path.exists(self.prompts_path):
+            raise FileNotFoundError(f"提示词文件不存在: {self.prompts_path}")
+
+        mtime = os.path.getmtime(self.prompts_path)
+        if mtime == self._mtime:
+            return
+
+        with self._lock:
+            if mtime == self._mtime:
+                return
+            try:
+                with open(self.prompts_path, 'r', encoding='utf-8') as file:
+                    prompts = yaml.safe_load(file)
+                self.validate(prompts)
+            except (yaml.YAMLError, ValueError) as e:
+                if self._prompts is None:
+                    raise ValueError(f"加载提示词文件失败: {e}")
+                # 修改后的文件有问题时继续使用上一次的有效版本
+                print(f"提示词文件更新失败，继续使用缓存版本: {e}")
+                self._mtime = mtime
+                return
+
+            self._prompts = prompts
+            self._mtime = mtime
+            print(f"已加载提示词文件: {self.prompts_path}")
+
+    def get(self, prompt_name: str) -> str:
+        self._load()
+        if prompt_name not in self._prompts:
+            raise ValueError(f"提示词 '{prompt_name}' 在YAML文件中不存在")
+        return self._prompts[prompt_name]
+
+
+class KnowledgeBaseIndexManager:
+    """知识库向量索引管理类
+
+    每个知识库对应一个独立的FAISS索引，首次使用时构建并保存到磁盘，
+    内存中按LRU策略缓存最近使用的若干个索引。
+    read_only为True时（多进程部署中的只读进程）不构建索引，只加载写入进程保存的索引，
+    每隔refresh_interval秒检查缓存的索引在磁盘上是否有更新或已被删除。
+    """
+
+    def __init__(self, embedding_model, base_path: str, max_cached: int = 8,
+                 read_only: bool = False, refresh_interval: float = 2.0):
+        self.embedding_model = embedding_model
+        self.base_path = base_path
+        self.max_cached = max(1, max_cached)
+        self.read_only = read_only
+        self.refresh_interval = refresh_interval
+        self._cache = OrderedDict()
+        self._checked = {}  # kb_id -> 上次检查磁盘的时间
+        self._lock = threading.RLock()
+        self._build_locks = {}
+
+    def _index_path(self, kb_id) -> str:
+        return os.path.join(self.base_path, f"kb_{kb_id}")
+
+    def _build_lock(self, kb_id) -> threading.Lock:
+        with self._lock:
+            return self._build_locks.setdefault(kb_id, threading.Lock())
+
+    def _put_cache(self, kb_id, vector_db):
+        self._cache[kb_id] = vector_db
+        self._cache.move_to_end(kb_id)
+        while len(self._cache) > self.max_cached:
+            evicted_id, _ = self._cache.popitem(last=False)
+            print(f"知识库索引缓存已满，移出内存: kb_{evicted_id}")
+
+    def _refresh_cached(self, kb_id):
+        """只读进程：缓存的索引在磁盘上已被删除时移出缓存，有更新时重新加载"""
+        now = time.monotonic()
+        if now - self._checked.get(kb_id, 0.0) < self.refresh_interval:
+            return
+        self._checked[kb_id] = now
+
+        index_path = self._index_path(kb_id)
+        if not LegalVectorStore.exists(index_path):
+            self._cache.pop(kb_id, None)
+        elif self._cache[kb_id].is_stale(index_path):
+            try:
+                self._cache[kb_id] = LegalVectorStore.load_local(index_path, self.embedding_model)
+                print(f"已重新加载知识库索引: {index_path}")
+            except Exception as e:
+                print(f"重新加载知识库索引 {index_path} 失败（稍后重试）: {e}")
+
+    def get(self, kb_id) -> Optional[LegalVectorStore]:
+        """从内存缓存或磁盘获取知识库索引，不存在时返回None"""
+        kb_id = int(kb_id)
+        with self._lock:
+            if kb_id in self._cache and self.read_only:
+                self._refresh_cached(kb_id)
+            if kb_id in self._cache:
+                self._cache.move_to_end(kb_id)
+                return self._cache[kb_id]
+
+            index_path = self._index_path(kb_id)
+            vector_db = load_vector_store(index_path, self.embedding_model)
+            if vector_db is None:
+                return None
+
+            print(f"已加载知识库索引: {index_path}")
+            self._put_cache(kb_id, vector_db)
+            return vector_db
+
+    def put(self, kb_id, vector_db: LegalVectorStore, save_to_disk: bool = True):
+        """缓存知识库索引并保存到磁盘"""
+        kb_id = int(kb_id)
+        with self._lock:
+            self._put_cache(kb_id, vector_db)
+            if save_to_disk:
+                vector_db.persist(self._index_path(kb_id))
+
+    def get_or_build(self, kb_id, builder: Callable[[], Optional[LegalVectorStore]]) -> Optional[LegalVectorStore]:
+        """获取知识库索引，不存在时调用builder构建（同一知识库只构建一次，只读进程不构建）"""
+        kb_id = int(kb_id)
+        vector_db = self.get(kb_id)
+        if vector_db is not None or self.read_only:
+            return vector_db
+
+        with self._build_lock(kb_id):
+            vector_db = self.get(kb_id)
+            if vector_db is None:
+                vector_db = builder()
+                if vector_db is not None:
+                    self.put(kb_id, vector_db)
+        return vector_db
+
+    def add_embeddings(self, kb_id, texts: List[str], embeddings: np.ndarray,
+                       metadatas: List[dict] = None) -> bool:
+        """向已构建的知识库索引增量添加文档块
+
+        索引尚未构建时不做处理，首次查询时会包含全部文档。
+        """
+        kb_id = int(kb_id)
+        with self._lock:
+            vector_db = self.get(kb_id)
+            if vector_db is None:
+                return False
+
+            vector_db.add_embeddings(texts, embeddings, metadatas)
+            vector_db.persist(self._index_path(kb_id))
+            print(f"知识库索引 kb_{kb_id} 已添加 {len(texts)} 个文档块。")
+            return True
+
+    def delete_document(self, kb_id, doc_id: int) -> int:
+        """从知识库索引中删除某个文档的向量（索引未构建时不做处理）"""
+        kb_id = int(kb_id)
+        with self._lock:
+            vector_db = self.get(kb_id)
+            if vector_db is None:
+                return 0
+
+            removed = vector_db.delete_document(doc_id)
+            if removed:
+                vector_db.persist(self._index_path(kb_id))
+            return removed
+
+    def clear_cache(self):
+        with self._lock:
+            self._cache.clear()
+            self._checked.clear()
+
+    def remove(self, kb_id):
+        """删除知识库索引（内存和磁盘）"""
+        kb_id = int(kb_id)
+        with self._lock:
+            self._cache.pop(kb_id, None)
+            index_path = self._index_path(kb_id)
+            if os.path.exists(index_path):
+                shutil.rmtree(index_path, ignore_errors=True)
 
 
 class DeepSeekApiRag:
@@ -75,14 +512,8 @@ class DeepSeekApiRag:
         if db_path is None:
             db_path = os.getenv("VECTOR_DB_PATH", "law_faiss")
 
-        # 1. 初始化嵌入模型
-        print("正在加载嵌入模型...")
-        embedding_model_name = os.getenv("EMBEDDING_MODEL", "BAAI/bge-small-zh-v1.5")
-        self.embedding_model = HuggingFaceEmbeddings(
-            model_name=embedding_model_name,
-            model_kwargs={'device': 'cuda'},  # 添加设备配置
-            encode_kwargs={'normalize_embeddings': True}  # 标准化嵌入
-        )
+        # 1. 获取共享嵌入模型（首次使用时加载）
+        self.embedding_model = get_embedding_model()
 
         # 2. 初始化DeepSeek API
         print("正在初始化DeepSeek API...")
@@ -93,24 +524,105 @@ class DeepSeekApiRag:
             api_key=api_key,
             base_url=deepseek_base_url,
             model=deepseek_model,
+            # 流式响应的最后一个分块返回token用量，用于统计实际的提示词token数
+            stream_usage=True,
         )
 
         # 3. 初始化向量数据库
         self.db_path = db_path
         self.vector_db = None
-        self.text_splitter = RecursiveCharacterTextSplitter(
-            chunk_size=200,
-            chunk_overlap=20,
-            length_function=len
+        self._write_lock = threading.RLock()
+        # 法律文档按编/章/节/条切分，每条法条一个文本块；其他文档按字符长度切分
+        self.max_chunk_size = int(os.getenv("ARTICLE_MAX_CHUNK_SIZE", "500"))
+        self.text_splitter = create_text_splitter(self.max_chunk_size)
+
+        # 多文件入库流水线：进程池解析切分，嵌入阶段跨文件批量处理
+        ingest_workers = os.getenv("INGEST_WORKERS")
+        self.ingestion = IngestionPipeline(
+            self._embed_texts,
+            workers=int(ingest_workers) if ingest_workers else None,
+            batch_size=int(os.getenv("INGEST_EMBED_BATCH", "256")),
+            max_chunk_size=self.max_chunk_size
         )
+        # 持久化嵌入缓存：按(嵌入模型, 文本哈希)保存向量，重建索引时无需重新嵌入
+        self.embedding_cache = None
+        if os.getenv("EMBEDDING_CACHE_ENABLED", "true").lower() == "true":
+            self.embedding_cache = EmbeddingCache(
+                os.getenv("EMBEDDING_CACHE_PATH", "embedding_cache"),
+                getattr(self.embedding_model, 'model_name', os.getenv("EMBEDDING_MODEL", "BAAI/bge-small-zh-v1.5"))
+            )
+            print(f"已加载嵌入缓存: {self.embedding_cache.path}，共 {len(self.embedding_cache)} 条")
+        # 单个文件（上传）流式入库时每批嵌入并写入索引的文本块数，决定入库时的峰值内存
+        self.ingest_stream_batch = int(os.getenv("INGEST_STREAM_BATCH", "64"))
+
+        # 4. 初始化Reranker（RERANKER_BACKEND=remote使用远程接口，local使用本地交叉编码器）
+        self.reranker = self._create_reranker()
+
+        # 5. 初始化记忆模块（最近使用的对话留在内存中，其余的按需从消息表加载，见app中的history_loader）
+        self.memory = ConversationMemory(
+            max_history_turns=int(os.getenv("MEMORY_HISTORY_TURNS", "5")),
+            store=self._create_conversation_store()
+        )
+
+        # 5.1 查询缓存：问题文本 -> 嵌入向量，(问题, 索引版本) -> 检索结果
+        query_cache_size = int(os.getenv("QUERY_CACHE_SIZE", "1024"))
+        query_cache_ttl = float(os.getenv("QUERY_CACHE_TTL", "3600"))
+        self.query_embedding_cache = LRUCache(query_cache_size, query_cache_ttl)
+        self.search_cache = LRUCache(query_cache_size, query_cache_ttl)
+
+        # 5.2 检索方式：向量 + BM25混合检索，融合后送入重排序的候选数量
+        self.hybrid_search = os.getenv("HYBRID_SEARCH", "true").lower() == "true"
+        self.retrieval_candidates = int(os.getenv("RETRIEVAL_CANDIDATES", "6"))
+
+        # 5.3 语义回答缓存（默认关闭，ANSWER_CACHE_ENABLED=true开启）
+        self.answer_cache = None
+        if os.getenv("ANSWER_CACHE_ENABLED", "false").lower() == "true":
+            self.answer_cache = SemanticAnswerCache(
+                max_size=int(os.getenv("ANSWER_CACHE_SIZE", "256")),
+                ttl=float(os.getenv("ANSWER_CACHE_TTL", "3600")),
+                threshold=float(os.getenv("ANSWER_CACHE_THRESHOLD", "0.95"))
+            )
 
-        # 4. 初始化Reranker配置
-        self.reranker_api_key = os.getenv("RERANKER_API_KEY")
-        self.reranker_url = os.getenv("RERANKER_BASE_URL", "https://api.siliconflow.cn/v1/rerank")
-        self.reranker_model = os.getenv("RERANKER_MODEL", "BAAI/bge-reranker-v2-m3")
+        # 5.4 按token预算组装上下文：检索到的文档优先，其次是最近的对话原文，最后是较早对话的滚动摘要
+        summary_enabled = os.getenv("CONTEXT_SUMMARY_ENABLED", "true").lower() == "true"
+        self.context_builder = ContextBuilder(
+            token_budget=int(os.getenv("CONTEXT_TOKEN_BUDGET", "4000")),
+            # 每个文档块最多占用的token数（约500个汉字，一条法条一个文本块，通常可以保留完整条文），
+            # 超出时按问题抽取最相关的句子
+            doc_max_tokens=int(os.getenv("CONTEXT_DOC_MAX_TOKENS", "300")),
+            recent_turns=int(os.getenv("CONTEXT_RECENT_TURNS", "3")),
+            summarizer=self._summarize if summary_enabled else None,
+            summary_max_tokens=int(os.getenv("CONTEXT_SUMMARY_MAX_TOKENS", "300")),
+            summary_cache=LRUCache(int(os.getenv("MEMORY_MAX_CONVERSATIONS", "1000")),
+                                   float(os.getenv("MEMORY_IDLE_TTL", "3600"))),
+            compressor=SentenceCompressor(
+                self._embed_sentences,
+                sentence_cache=LRUCache(int(os.getenv("CONTEXT_SENTENCE_CACHE_SIZE", "20000")), ttl=0)
+            ) if os.getenv("CONTEXT_COMPRESSION", "true").lower() == "true" else None
+        )
 
-        # 5. 初始化记忆模块
-        self.memory = ConversationMemory(max_history_turns=5)
+        # 6. 加载并校验提示词模板
+        current_dir = os.path.dirname(os.path.abspath(__file__))
+        self.prompt_loader = PromptLoader(os.path.join(current_dir, "prompts.yaml"))
+        self.prompt_loader.get("legal_advisor_prompt")
+
+        # 7. 多进程部署：只有取得向量库写锁的进程（写入进程，见acquire_writer）修改全局索引和知识库索引，
+        #    其他进程只读，每隔VECTOR_DB_REFRESH_INTERVAL秒检查写入进程保存的新数据并重新加载
+        self.is_writer = False
+        self.refresh_interval = float(os.getenv("VECTOR_DB_REFRESH_INTERVAL", "2"))
+        self._last_refresh = time.monotonic()
+        self._refresh_lock = threading.Lock()
+
+        # 8. 知识库检索方式：filter在全局索引中按kb_id过滤（默认），
+        #    separate为每个知识库单独建索引（LRU缓存）
+        self.kb_index_mode = os.getenv("KB_INDEX_MODE", "filter").lower()
+        self.kb_indexes = KnowledgeBaseIndexManager(
+            self.embedding_model,
+            os.getenv("KB_INDEX_PATH", f"{db_path}_kb"),
+            max_cached=int(os.getenv("KB_INDEX_CACHE_SIZE", "8")),
+            read_only=True,
+            refresh_interval=self.refresh_interval
+        )
 
         # 如果向量数据库已存在，直接加载
         if os.path.exists(db_path):
@@ -119,33 +631,65 @@ class DeepSeekApiRag:
         else:
             print(f"向量数据库不存在，将在添加文档时创建: {db_path}")
 
-    def _load_prompt(self, prompt_name: str = "legal_advisor_prompt") -> str:
-        """从YAML文件加载提示词模板"""
-        prompts_file = "prompts.yaml"
-
-        # 获取当前脚本目录
-        current_dir = os.path.dirname(os.path.abspath(__file__))
-        prompts_path = os.path.join(current_dir, prompts_file)
-
-        print(f"正在加载提示词文件: {prompts_path}")
-
-        if not os.path.exists(prompts_path):
-            raise FileNotFoundError(f"提示词文件不存在: {prompts_path}")
-
-        try:
-            with open(prompts_path, 'r', encoding='utf-8') as file:
-                prompts = yaml.safe_load(file)
+    def _summarize(self, prompt: str) -> str:
+        """生成对话摘要（由上下文组装器在后台线程中调用）"""
+        return self.llm.invoke(prompt).content
+
+    @staticmethod
+    def _create_conversation_store() -> BaseConversationStore:
+        """根据环境变量创建对话记忆存储（多个工作进程部署时使用sqlite或redis共享对话记忆）"""
+        backend = os.getenv("MEMORY_BACKEND", "memory").lower()
+        idle_ttl = float(os.getenv("MEMORY_IDLE_TTL", "3600"))
+        if backend == "sqlite":
+            return SQLiteConversationStore(
+                os.getenv("MEMORY_SQLITE_PATH", "conversation_memory.sqlite"),
+                max_conversations=int(os.getenv("MEMORY_MAX_CONVERSATIONS", "10000")),
+                idle_ttl=idle_ttl
+            )
+        if backend == "redis":
+            return RedisConversationStore(
+                url=os.getenv("MEMORY_REDIS_URL", "redis://localhost:6379/0"),
+                idle_ttl=idle_ttl,
+                key_prefix=os.getenv("MEMORY_REDIS_PREFIX", "legal_rag:conversation:")
+            )
+        return InProcessConversationStore(
+            max_conversations=int(os.getenv("MEMORY_MAX_CONVERSATIONS", "1000")),
+            idle_ttl=idle_ttl
+        )
 
-            if not prompts or prompt_name not in prompts:
-                raise ValueError(f"提示词 '{prompt_name}' 在YAML文件中不存在")
+    @staticmethod
+    def _create_reranker() -> BaseReranker:
+        """根据环境变量创建重排序后端"""
+        backend = os.getenv("RERANKER_BACKEND", "remote").lower()
+        reranker_model = os.getenv("RERANKER_MODEL", "BAAI/bge-reranker-v2-m3")
+
+        if backend == "local":
+            num_threads = os.getenv("RERANKER_NUM_THREADS")
+            return LocalCrossEncoderReranker(
+                model_name=reranker_model,
+                max_length=int(os.getenv("RERANKER_MAX_LENGTH", "512")),
+                runtime=os.getenv("RERANKER_RUNTIME", "torch").lower(),
+                quantize=os.getenv("RERANKER_QUANTIZE", "false").lower() == "true",
+                num_threads=int(num_threads) if num_threads else None
+            )
 
-            print(f"成功加载提示词模板: {prompt_name}")
-            return prompts[prompt_name]
+        # 远程接口（长连接 + 时间预算 + 熔断）
+        reranker = RemoteReranker(
+            api_key=os.getenv("RERANKER_API_KEY"),
+            url=os.getenv("RERANKER_BASE_URL", "https://api.siliconflow.cn/v1/rerank"),
+            model=reranker_model,
+            timeout=float(os.getenv("RERANKER_TIMEOUT", "3")),
+            failure_threshold=int(os.getenv("RERANKER_FAILURE_THRESHOLD", "3")),
+            cooldown=float(os.getenv("RERANKER_COOLDOWN", "30")),
+            async_pool_size=int(os.getenv("RERANKER_ASYNC_POOL_SIZE", "100"))
+        )
+        if not reranker.api_key:
+            print("未设置 Reranker API 密钥，将跳过重排序")
+        return reranker
 
-        except yaml.YAMLError as e:
-            raise ValueError(f"YAML文件解析错误: {e}")
-        except Exception as e:
-            raise ValueError(f"加载提示词文件失败: {e}")
+    def _load_prompt(self, prompt_name: str = "legal_advisor_prompt") -> str:
+        """从缓存获取提示词模板（YAML文件修改后自动重新加载）"""
+        return self.prompt_loader.get(prompt_name)
 
     def _get_prompt(self, prompt_name: str = "legal_advisor_prompt", **kwargs) -> str:
         """获取格式化后的提示词"""
@@ -163,172 +707,489 @@ class DeepSeekApiRag:
             documents: List[str],
             top_k: int = 3
     ) -> List[Tuple[str, float]]:
-        if not self.reranker_api_key:
-            print("未设置 Reranker API 密钥，跳过重排序")
-            return [(doc, 0.0) for doc in documents[:top_k]]
-
-        headers = {
-            "Authorization": f"Bearer {self.reranker_api_key}",
-            "Content-Type": "application/json"
-        }
-        payload = {
-            "model": self.reranker_model,
-            "query": query,
-            "documents": documents
-        }
+        return self.reranker.rerank(query, documents, top_k=top_k)
+
+    def _reuse_db_vectors(self, texts: List[str], vectors: List[Optional[np.ndarray]]):
+        """用向量数据库中内容相同的文档块的向量填充vectors中未命中的行"""
+        known = [(row, vector_id) for row, vector_id in enumerate(self.vector_db.find_by_content(texts))
+                 if vector_id is not None and vectors[row] is None]
+        if known:
+            reused = self.vector_db.reconstruct([vector_id for _, vector_id in known])
+            for (row, _), vector in zip(known, reused):
+                vectors[row] = vector
+
+    def _embed_sentences(self, sentences: List[str]) -> np.ndarray:
+        """生成上下文压缩所需的句子向量：直接调用嵌入模型，只缓存在压缩器的进程内LRU中，
+        不查询向量数据库，也不写入持久化嵌入缓存（检索时的句子不是文档块，写入会让缓存无限增长）"""
+        return np.array(self.embedding_model.embed_documents(sentences), dtype=np.float32)
+
+    def _embed_texts(self, texts: List[str]) -> np.ndarray:
+        """生成文本块的嵌入向量
+
+        相同内容只嵌入一次；依次复用向量数据库中已有文档块的向量（如多份文件引用的同一法条）
+        和持久化嵌入缓存中的向量，只有都未命中的文本块才调用嵌入模型，结果写回缓存。
+        向量数据库使用量化存储时只能取回近似向量，此时优先使用缓存。
+        """
+        hashes = [content_hash(text) for text in texts]
+        vectors = [None] * len(texts)
+
+        exact_db = self.vector_db is not None and self.vector_db.exact_vectors
+        if exact_db:
+            self._reuse_db_vectors(texts, vectors)
+
+        if self.embedding_cache is not None:
+            missing = [row for row, vector in enumerate(vectors) if vector is None]
+            if missing:
+                for row, vector in zip(missing, self.embedding_cache.get_many([hashes[row] for row in missing])):
+                    vectors[row] = vector
+
+        if self.vector_db is not None and not exact_db:
+            self._reuse_db_vectors(texts, vectors)
+
+        unique_texts = {}
+        for row, vector in enumerate(vectors):
+            if vector is None:
+                unique_texts.setdefault(hashes[row], texts[row])
+
+        if unique_texts:
+            # 手动生成嵌入向量并确保是numpy数组格式
+            embeddings = np.array(self.embedding_model.embed_documents(list(unique_texts.values())), dtype=np.float32)
+
+            # 检查嵌入维度是否一致
+            if len(embeddings.shape) != 2:
+                raise ValueError(f"嵌入维度不正确，期望2D数组，得到{embeddings.shape}")
+            if self.embedding_cache is not None:
+                self.embedding_cache.put_many(list(unique_texts), embeddings)
+
+            embedded = dict(zip(unique_texts, embeddings))
+            for row, vector in enumerate(vectors):
+                if vector is None:
+                    vectors[row] = embedded[hashes[row]]
+
+        if not vectors:
+            return np.zeros((0, 0), dtype=np.float32)
+        return np.vstack(vectors).astype(np.float32)
+
+    def _link_file(self, file_path: str, metadata: dict) -> int:
+        """内容相同的文件已入库时直接引用已有的文档块（不解析、不嵌入），返回引用的文档块数量"""
+        if self.vector_db is None or not self.vector_db.has_file(metadata['file_hash']):
+            return 0
+
+        with self._write_lock:
+            linked = self.vector_db.link_file(metadata['file_hash'], metadata)
+            if not linked:
+                return 0
+            self.save_vector_db()
 
-        try:
-            response = requests.post(
-                self.reranker_url,
-                json=payload,
-                headers=headers,
-                timeout=30)
-            response.raise_for_status()
-            results = response.json().get("results", [])
-
-            reranked = sorted(
-                zip(documents, [res["relevance_score"] for res in results]),
-                key=lambda x: x[1],
-                reverse=True
+        kb_id = metadata.get('kb_id')
+        if kb_id and self.kb_index_mode == "separate":
+            vector_ids = [vector_id for vector_id, _ in linked]
+            self.kb_indexes.add_embeddings(
+                kb_id,
+                self.vector_db.get_texts(vector_ids),
+                self.vector_db.reconstruct(vector_ids),
+                [ref for _, ref in linked]
             )
-            return reranked[:top_k]
-        except Exception as e:
-            print(f"Reranker 调用失败: {e}")
-            return [(doc, 0.0) for doc in documents[:top_k]]
+        print(f"文件 {file_path} 与已入库文件内容相同，直接引用 {len(linked)} 个文档块")
+        return len(linked)
 
-    def add_documents(self, documents: List[str], save_to_disk: bool = True):
+    def _create_vector_db(self, texts: List[str], embeddings: np.ndarray,
+                          metadatas: List[dict] = None) -> LegalVectorStore:
+        """使用已有的嵌入向量创建向量数据库"""
+        return LegalVectorStore.from_embeddings(texts, embeddings, self.embedding_model, metadatas)
+
+    def add_documents(self, documents: List[str], save_to_disk: bool = True,
+                      embeddings: np.ndarray = None, metadatas: List[dict] = None):
         if not documents:
             return
 
         print(f"正在向向量数据库添加 {len(documents)} 个文档块...")
 
-        # 手动生成嵌入向量并确保是numpy数组格式
-        embeddings = self.embedding_model.embed_documents(documents)
-
-        # 确保所有嵌入都是numpy数组
-        embeddings_array = np.array(embeddings, dtype=np.float32)
+        if embeddings is None:
+            embeddings = self._embed_texts(documents)
+
+        # 后台入库线程和请求线程可能同时写入，索引的创建和保存需要串行
+        with self._write_lock:
+            if self.vector_db is None:
+                self.vector_db = self._create_vector_db(documents, embeddings, metadatas)
+                print(f"FAISS 数据库已初始化，包含 {len(documents)} 个文档块。")
+            else:
+                self.vector_db.add_embeddings(documents, embeddings, metadatas)
+                print(f"FAISS 数据库已添加 {len(documents)} 个文档块。")
+
+            if save_to_disk:
+                self.save_vector_db()
+
+    def load_file_chunks(self, file_path: str, metadata: dict = None) -> Tuple[List[str], List[dict]]:
+        """解析文件并切分为文本块，返回文本和对应的元数据（附带页码和法条层级）"""
+        return load_file_chunks(file_path, metadata, text_splitter=self.text_splitter)
+
+    def add_files(self, files: List[Tuple[str, dict]], save_to_disk: bool = True,
+                  on_parsed: Callable[[str, int, Optional[str]], None] = None) -> dict:
+        """批量添加(文件路径, 元数据)：并行解析、批量嵌入，最后只写一次索引，返回各阶段统计
+
+        on_parsed(文件路径, 文本块数量, 错误信息)在每个文件解析完成时调用。
+        元数据中记录文件的SHA-256（file_hash），内容相同的文件已入库时直接引用，不再解析。
+        """
+        pending = []
+        for path, metadata in files:
+            if not os.path.exists(path):
+                continue
+            metadata = dict(metadata, file_hash=metadata.get('file_hash') or file_sha256(path))
+            linked = self._link_file(path, metadata)
+            if linked:
+                if on_parsed is not None:
+                    on_parsed(path, linked, None)
+                continue
+            pending.append((path, metadata))
+
+        if not pending:
+            return {}
+
+        texts, embeddings, metadatas, stats = self.ingestion.run(pending, on_parsed=on_parsed)
+        if texts:
+            self.add_documents(texts, save_to_disk, embeddings=embeddings, metadatas=metadatas)
+        return stats
+
+    def add_file_documents(self, file_path: str, save_to_disk: bool = True, knowledge_base_id=None,
+                           doc_id: int = None, user_id: int = None, source: str = None,
+                           on_progress: Callable[[int], None] = None) -> int:
+        """流式添加文件到全局向量数据库，返回文档块数量
+
+        文件逐页读取、切分，每凑满ingest_stream_batch个文本块就嵌入并追加到索引（落盘为一个增量段），
+        内存占用只与批大小有关，与文件大小无关。中途失败时回滚已写入的文档块后抛出异常。
+        doc_id为UploadedDocument.id，用于之后按文档删除向量；kb_id、user_id记录在元数据中，
+        用于检索时按知识库或用户过滤。独立知识库索引模式下同时增量更新该知识库的索引。
+        内容相同的文件已入库时直接引用已有的文档块。on_progress(已入库文本块数)在每批写入后调用。
+        """
+        metadata = {
+            'doc_id': doc_id,
+            'kb_id': int(knowledge_base_id) if knowledge_base_id else None,
+            'user_id': user_id,
+            'source': source,
+            'file_hash': file_sha256(file_path)
+        }
+        linked = self._link_file(file_path, metadata)
+        if linked:
+            if on_progress is not None:
+                on_progress(linked)
+            return linked
 
-        # 检查嵌入维度是否一致
-        if len(embeddings_array.shape) != 2:
-            raise ValueError(f"嵌入维度不正确，期望2D数组，得到{embeddings_array.shape}")
+        batches = iter_file_batches(file_path, metadata, text_splitter=self.text_splitter,
+                                    batch_size=self.ingest_stream_batch)
 
+        total = 0
+        try:
+            for texts, metadatas in batches:
+                # 只做一次嵌入，全局索引和知识库索引共用
+                embeddings = self._embed_texts(texts)
+                self.add_documents(texts, save_to_disk, embeddings=embeddings, metadatas=metadatas)
+
+                if knowledge_base_id and self.kb_index_mode == "separate":
+                    self.kb_indexes.add_embeddings(knowledge_base_id, texts, embeddings, metadatas)
+                total += len(texts)
+                if on_progress is not None:
+                    on_progress(total)
+        except Exception:
+            if doc_id is not None and total:
+                print(f"文件 {file_path} 入库失败，回滚已写入的 {total} 个文档块")
+                self.delete_document(doc_id, knowledge_base_id)
+            raise
+
+        print(f"文件 {file_path} 入库完成，共 {total} 个文档块")
+        return total
+
+    def tag_document(self, doc_id: int, save_to_disk: bool = True, **metadata) -> int:
+        """补充或修改某个文档全部文档块的元数据（如旧数据缺少kb_id），元数据未变化时不写盘"""
         if self.vector_db is None:
-            # 使用FAISS.from_embeddings方法
-            from langchain_core.documents import Document
-            docs = [Document(page_content=text) for text in documents]
-
-            self.vector_db = FAISS.from_embeddings(
-                text_embeddings=list(zip(documents, embeddings_array)),
-                embedding=self.embedding_model,
-                metadatas=[{} for _ in documents]
-            )
-            print(f"FAISS 数据库已初始化，包含 {len(documents)} 个文档块。")
-        else:
-            # 使用add_embeddings方法
-            self.vector_db.add_embeddings(
-                text_embeddings=list(zip(documents, embeddings_array)),
-                metadatas=[{} for _ in documents]
-            )
-            print(f"FAISS 数据库已添加 {len(documents)} 个文档块。")
+            return 0
 
-        if save_to_disk:
+        updated = self.vector_db.update_document_metadata(
+            doc_id, {key: value for key, value in metadata.items() if value is not None})
+        if updated and save_to_disk:
             self.save_vector_db()
+        return updated
 
-    def add_file_documents(self, file_path: str, save_to_disk: bool = True):
-        # 支持TXT文件
-        if file_path.lower().endswith('.pdf'):
-            loader = PyPDFLoader(file_path)
-        elif file_path.lower().endswith(('.doc', '.docx')):
-            loader = Docx2txtLoader(file_path)
-        elif file_path.lower().endswith('.txt'):
-            loader = TextLoader(file_path, encoding='utf-8')  # 处理TXT文件
-        else:
-            print(f"不支持的文件格式: {file_path}")
-            return
-
-        pages = loader.load()
-        documents = self.text_splitter.split_documents(pages)
-        texts = [doc.page_content for doc in documents]
-        self.add_documents(texts, save_to_disk)
-
-    def add_folder_documents(self, folder_path: str, save_to_disk: bool = True):
-        supported_extensions = ('.pdf', '.doc', '.docx', '.txt')  # TXT
-
+    def delete_document(self, doc_id: int, knowledge_base_id=None) -> int:
+        """从全局索引（及所属知识库索引）中删除某个文档的全部向量"""
+        removed = 0
+        if self.vector_db is not None:
+            removed = self.vector_db.delete_document(doc_id)
+            if removed:
+                self.save_vector_db()
+
+        if knowledge_base_id:
+            self.kb_indexes.delete_document(knowledge_base_id, doc_id)
+
+        print(f"已从向量数据库删除文档 {doc_id} 的 {removed} 个文档块")
+        return removed
+
+    def get_knowledge_base_index(self, knowledge_base_id,
+                                 documents: List[Tuple[int, str]]) -> Optional[LegalVectorStore]:
+        """获取知识库索引，首次使用时根据知识库文档(doc_id, 文件路径)构建，知识库为空时返回None"""
+        def build():
+            texts, metadatas = [], []
+            for doc_id, path in documents:
+                if os.path.exists(path):
+                    file_texts, file_metadatas = self.load_file_chunks(
+                        path, {'doc_id': doc_id, 'kb_id': int(knowledge_base_id)})
+                    texts.extend(file_texts)
+                    metadatas.extend(file_metadatas)
+            if not texts:
+                return None
+
+            print(f"正在构建知识库索引 kb_{knowledge_base_id}，共 {len(texts)} 个文档块...")
+            return self._create_vector_db(texts, self._embed_texts(texts), metadatas)
+
+        return self.kb_indexes.get_or_build(knowledge_base_id, build)
+
+    def add_folder_documents(self, folder_path: str, save_to_disk: bool = True) -> dict:
+        """并行处理文件夹中的全部文档，最后一次性写入索引"""
         if not os.path.exists(folder_path):
             print(f"文件夹不存在: {folder_path}")
-            return
-
-        for filename in os.listdir(folder_path):
-            if filename.lower().endswith(supported_extensions):
-                file_path = os.path.join(folder_path, filename)
-                print(f"正在处理文件: {file_path}")
-                self.add_file_documents(file_path, save_to_disk=False)
+            return {}
 
-        if save_to_disk and self.vector_db is not None:
-            self.save_vector_db()
+        files = [
+            (os.path.join(folder_path, filename), {'source': filename})
+            for filename in sorted(os.listdir(folder_path))
+            if filename.lower().endswith(SUPPORTED_EXTENSIONS)
+        ]
+        return self.add_files(files, save_to_disk)
 
     def save_vector_db(self):
-        if self.vector_db is not None:
-            self.vector_db.save_local(self.db_path)
+        """增量保存向量数据库（只追加新变更，不重写整个索引）"""
+        with self._write_lock:
+            if self.vector_db is not None:
+                self.vector_db.persist(self.db_path)
 
     def load_vector_db(self):
-        self.vector_db = FAISS.load_local(
-            self.db_path,
-            self.embedding_model,
-            allow_dangerous_deserialization=True
-        )
+        self.vector_db = load_vector_store(self.db_path, self.embedding_model)
+
+    def acquire_writer(self) -> bool:
+        """尝试成为写入进程（取得全局向量库的写锁），其他进程持有写锁时返回False
+
+        作为只读进程加载的数据可能已过时，成为写入进程时按磁盘上的最新状态重新加载。
+        """
+        with self._write_lock:
+            if self.is_writer:
+                return True
+            os.makedirs(self.db_path, exist_ok=True)
+            if not try_acquire_writer_lock(os.path.join(self.db_path, LegalVectorStore.CHUNKS_FILE)):
+                return False
+
+            if self.vector_db is None or self.vector_db.is_stale(self.db_path):
+                self.load_vector_db()
+            self.kb_indexes.clear_cache()
+            self.kb_indexes.read_only = False
+            self.is_writer = True
+        print(f"本进程（{os.getpid()}）负责写入向量数据库: {self.db_path}")
+        return True
+
+    def release_writer(self):
+        """释放写锁，回到只读进程（启动时构建向量库的进程不一定处理之后的请求，例如调试模式下重载器的父进程）"""
+        with self._write_lock:
+            release_writer_locks()
+            self.kb_indexes.read_only = True
+            self.is_writer = False
+
+    def refresh_vector_db(self):
+        """只读进程：写入进程保存了新数据时重新加载全局索引，每隔refresh_interval秒检查一次"""
+        now = time.monotonic()
+        if self.is_writer or now - self._last_refresh < self.refresh_interval:
+            return
+        if not self._refresh_lock.acquire(blocking=False):
+            return  # 其他请求线程正在检查或重新加载，继续使用当前索引
 
-    def retrieve_documents(self, query: str, top_k: int = 3) -> List[Tuple[str, float]]:
-        """检索 + 重排序"""
-        if self.vector_db is None:
+        try:
+            self._last_refresh = now
+            if self.vector_db is None or self.vector_db.is_stale(self.db_path):
+                vector_db = load_vector_store(self.db_path, self.embedding_model)
+                if vector_db is not None:
+                    self.vector_db = vector_db
+                    print(f"已重新加载写入进程保存的向量数据库: {self.db_path}")
+        except Exception as e:
+            # 写入进程正在保存或合并时可能读到不完整的状态，下次检查时重试
+            print(f"重新加载向量数据库失败（稍后重试）: {e}")
+        finally:
+            self._refresh_lock.release()
+
+    @staticmethod
+    def _normalize_query(query: str) -> str:
+        """规范化问题文本（全角转半角、合并空白），作为缓存键"""
+        return " ".join(unicodedata.normalize("NFKC", query).lower().split())
+
+    def embed_query(self, query: str) -> np.ndarray:
+        """生成问题的嵌入向量（带缓存，规范化文本只用作缓存键，模型输入是原始问题）"""
+        key = self._normalize_query(query)
+        embedding = self.query_embedding_cache.get(key)
+        if embedding is None:
+            embedding = np.array(self.embedding_model.embed_query(query), dtype=np.float32)
+            self.query_embedding_cache.put(key, embedding)
+        return embedding
+
+    def _cached_similarity_search(self, vector_db: LegalVectorStore, query: str, k: int,
+                                  filters: dict = None):
+        """向量检索或混合检索（带缓存），索引变化后版本号不同，旧结果自动失效"""
+        filters_key = tuple(sorted((field, str(value)) for field, value in (filters or {}).items()))
+        key = (self._normalize_query(query), vector_db.generation, k, filters_key)
+        docs_and_scores = self.search_cache.get(key)
+        if docs_and_scores is None:
+            if self.hybrid_search:
+                docs_and_scores = vector_db.hybrid_search(self.embed_query(query), query, k=k, filters=filters)
+            else:
+                docs_and_scores = vector_db.similarity_search_with_score_by_vector(
+                    self.embed_query(query), k=k, filters=filters)
+            self.search_cache.put(key, docs_and_scores)
+        return docs_and_scores
+
+    def get_stats(self) -> dict:
+        """运行统计：缓存命中率、重排序情况等"""
+        return {
+            'vector_db': self.vector_db.get_stats() if self.vector_db is not None else None,
+            'conversation_memory': self.memory.get_stats(),
+            'context': self.context_builder.get_stats(),
+            'query_embedding_cache': self.query_embedding_cache.get_stats(),
+            'embedding_cache': self.embedding_cache.get_stats() if self.embedding_cache is not None else None,
+            'search_cache': self.search_cache.get_stats(),
+            'answer_cache': self.answer_cache.get_stats() if self.answer_cache else None,
+            'reranker': self.reranker.get_stats()
+        }
+
+    def _retrieve_candidates(self, query: str, top_k: int, vector_db: LegalVectorStore = None,
+                             filters: dict = None):
+        """检索阶段（不含重排序），返回(法条直查结果, None)或(None, 待重排序的候选文档和分数)"""
+        if vector_db is None:
+            vector_db = self.vector_db
+        if vector_db is None:
             raise ValueError("知识库中没有文档，请先添加文档")
 
-        docs_and_scores = self.vector_db.similarity_search_with_score(query, k=10)
-        initial_docs = [doc.page_content for doc, _ in docs_and_scores]
+        # 问题直接引用了法条（如"刑法第二百六十四条"）时按编号取出，不做向量检索
+        citations = parse_citations(query, vector_db.metadata_index.values('law'))
+        if citations:
+            articles = vector_db.lookup_articles(citations, filters=filters)
+            if articles:
+                print(f"命中法条直查: {', '.join(citations)}")
+                return [(doc.page_content, 1.0) for doc in articles[:max(top_k, len(citations))]], None
 
-        reranked_docs = self._rerank_documents(query, initial_docs, top_k=top_k)
+        return None, self._cached_similarity_search(vector_db, query, k=self.retrieval_candidates, filters=filters)
 
+    @staticmethod
+    def _with_search_scores(docs_and_scores, reranked_docs) -> List[Tuple[str, float]]:
+        """重排序结果附上检索时的相似度"""
         return [
             (doc, next(score for d, score in docs_and_scores if d.page_content == doc))
             for doc, _ in reranked_docs
         ]
 
-    def generate_response_stream(self, query: str, conversation_id: str = None, top_k: int = 3,
-                                 prompt_name: str = "legal_advisor_prompt"):
-        """生成RAG回答（带记忆）"""
-        try:
-            retrieved_docs = self.retrieve_documents(query, top_k=top_k)
-        except ValueError:
-            retrieved_docs = []
+    def retrieve_documents(self, query: str, top_k: int = 3, vector_db: LegalVectorStore = None,
+                           filters: dict = None) -> List[Tuple[str, float]]:
+        """法条直查 / 检索 + 重排序
 
-        # 构建上下文
-        context_parts = []
+        vector_db为None时使用全局索引；filters按元数据过滤，如{'kb_id': 3}、{'user_id': 5}。
+        """
+        articles, docs_and_scores = self._retrieve_candidates(query, top_k, vector_db, filters)
+        if articles is not None:
+            return articles
 
-        # 1. 添加检索到的文档上下文
-        if retrieved_docs:
-            for i, (doc, score) in enumerate(retrieved_docs):
-                short_doc = doc[:200] + "..." if len(doc) > 200 else doc
-                context_parts.append(f"【相关文档{i + 1}】(相似度:{score:.2f}): {short_doc}")
+        initial_docs = [doc.page_content for doc, _ in docs_and_scores]
+        reranked_docs = self._rerank_documents(query, initial_docs, top_k=top_k)
+        return self._with_search_scores(docs_and_scores, reranked_docs)
 
-        # 2. 添加对话记忆上下文
-        conversation_history = ""
-        if conversation_id:
-            conversation_history = self.memory.get_formatted_history(conversation_id)
-            if conversation_history and conversation_history != "无对话历史":
-                context_parts.append(conversation_history)
+    async def aretrieve_documents(self, query: str, top_k: int = 3, vector_db: LegalVectorStore = None,
+                                  filters: dict = None) -> List[Tuple[str, float]]:
+        """retrieve_documents的异步版本：嵌入和FAISS检索在线程池中执行，重排序使用异步HTTP请求"""
+        articles, docs_and_scores = await asyncio.to_thread(self._retrieve_candidates, query, top_k, vector_db, filters)
+        if articles is not None:
+            return articles
 
-        context = "\n\n".join(context_parts) if context_parts else "无相关上下文"
+        initial_docs = [doc.page_content for doc, _ in docs_and_scores]
+        reranked_docs = await self.reranker.arerank(query, initial_docs, top_k=top_k)
+        return self._with_search_scores(docs_and_scores, reranked_docs)
+
+    def _search_scope(self, knowledge_base_id=None, knowledge_base_documents: List[Tuple[int, str]] = None):
+        """检索范围：返回(知识库独立索引, 元数据过滤条件)，都为None时检索全局索引"""
+        self.refresh_vector_db()
+        vector_db = None
+        filters = None
+        if knowledge_base_id is not None:
+            if self.kb_index_mode == "separate":
+                vector_db = self.get_knowledge_base_index(knowledge_base_id, knowledge_base_documents or [])
+            # 只读进程不构建知识库索引，写入进程尚未构建时在全局索引中按kb_id过滤
+            if vector_db is None and self.vector_db is not None and \
+                    self.vector_db.metadata_index.ids('kb_id', int(knowledge_base_id)):
+                filters = {'kb_id': int(knowledge_base_id)}
+        return vector_db, filters
+
+    def _lookup_answer_cache(self, query: str, history: List[dict], prompt_name: str, knowledge_base_id,
+                             vector_db: LegalVectorStore = None):
+        """语义回答缓存：只对没有对话历史的首轮问题生效，返回(缓存键, 缓存的回答)"""
+        if self.answer_cache is None or history:
+            return None, None
+
+        search_db = vector_db if vector_db is not None else self.vector_db
+        scope = (knowledge_base_id, prompt_name, search_db.generation if search_db is not None else None)
+        answer_cache_key = (self.embed_query(query), scope)
+        return answer_cache_key, self.answer_cache.lookup(*answer_cache_key)
+
+    def _build_prompt(self, query: str, prompt_name: str, retrieved_docs: List[Tuple[str, float]],
+                      history: List[dict], conversation_id: str = None) -> Tuple[str, str, int]:
+        """按token预算构建上下文（按问题压缩的文档、最近的对话、较早对话的摘要），返回(提示词, 上下文, token数)"""
+        template_tokens = estimate_tokens(self._get_prompt(prompt_name, query=query, context="", conversation_history=""))
+        built = self.context_builder.build(template_tokens, retrieved_docs, history, conversation_id,
+                                           query_vector=self.embed_query(query))
+        context = built['context']
 
         # 构建增强的提示词
         prompt = self._get_prompt(
             prompt_name,
             query=query,
             context=context,
-            conversation_history=conversation_history
+            conversation_history=built['conversation_history']
         )
+        prompt_tokens = estimate_tokens(prompt)
+        self.context_builder.record_prompt(prompt_tokens)
+        tokens = built['tokens']
+        print(f"提示词约 {prompt_tokens} tokens（文档 {tokens['documents']}，对话 {tokens['history']}，"
+              f"摘要 {tokens['summary']}，预算 {self.context_builder.token_budget}）")
+        return prompt, context, prompt_tokens
+
+    @staticmethod
+    def _cached_answer_result(conversation_id: str, stream) -> dict:
+        print("语义回答缓存命中，直接返回缓存的回答")
+        return {
+            "stream": stream,
+            "context": "",
+            "retrieved_documents": [],
+            "conversation_id": conversation_id,
+            "answer_cache_key": None,
+            "prompt_tokens": 0
+        }
+
+    def generate_response_stream(self, query: str, conversation_id: str = None, top_k: int = 3,
+                                 prompt_name: str = "legal_advisor_prompt",
+                                 knowledge_base_id=None, knowledge_base_documents: List[Tuple[int, str]] = None):
+        """生成RAG回答（带记忆），指定知识库时只在该知识库的文档中检索，知识库为空时使用全局索引"""
+        vector_db, filters = self._search_scope(knowledge_base_id, knowledge_base_documents)
+        history = self.memory.get_recent_history(conversation_id) if conversation_id else []
+
+        answer_cache_key, cached_answer = self._lookup_answer_cache(query, history, prompt_name, knowledge_base_id,
+                                                                    vector_db)
+        if cached_answer is not None:
+            if conversation_id:
+                self.memory.add_message(conversation_id, 'user', query)
+            return self._cached_answer_result(conversation_id,
+                                              iter([AIMessageChunk(content=cached_answer)]))
+
+        try:
+            retrieved_docs = self.retrieve_documents(query, top_k=top_k, vector_db=vector_db, filters=filters)
+        except ValueError:
+            retrieved_docs = []
+
+        prompt, context, prompt_tokens = self._build_prompt(query, prompt_name, retrieved_docs, history,
+                                                            conversation_id)
 
         # 使用流式调用
-        response_stream = self.llm.stream(prompt)
+        response_stream = self._track_usage(self.llm.stream(prompt))
 
         # 保存用户消息到记忆（如果是对话模式）
         if conversation_id:
@@ -338,14 +1199,76 @@ class DeepSeekApiRag:
             "stream": response_stream,
             "context": context,
             "retrieved_documents": [doc[0] for doc in retrieved_docs],
-            "conversation_id": conversation_id
+            "conversation_id": conversation_id,
+            "answer_cache_key": answer_cache_key,
+            "prompt_tokens": prompt_tokens
+        }
+
+    async def agenerate_response_stream(self, query: str, conversation_id: str = None, top_k: int = 3,
+                                        prompt_name: str = "legal_advisor_prompt", knowledge_base_id=None,
+                                        knowledge_base_documents: List[Tuple[int, str]] = None):
+        """generate_response_stream的异步版本，返回的stream为异步迭代器（LLM使用astream）
+
+        嵌入、FAISS检索、文档压缩和对话记忆读写等同步操作在线程池中执行，不阻塞事件循环。
+        """
+        vector_db, filters = await asyncio.to_thread(self._search_scope, knowledge_base_id, knowledge_base_documents)
+        history = await asyncio.to_thread(self.memory.get_recent_history, conversation_id) if conversation_id else []
+
+        answer_cache_key, cached_answer = await asyncio.to_thread(
+            self._lookup_answer_cache, query, history, prompt_name, knowledge_base_id, vector_db)
+        if cached_answer is not None:
+            if conversation_id:
+                await asyncio.to_thread(self.memory.add_message, conversation_id, 'user', query)
+            return self._cached_answer_result(conversation_id,
+                                              _aiter([AIMessageChunk(content=cached_answer)]))
+
+        try:
+            retrieved_docs = await self.aretrieve_documents(query, top_k=top_k, vector_db=vector_db, filters=filters)
+        except ValueError:
+            retrieved_docs = []
+
+        prompt, context, prompt_tokens = await asyncio.to_thread(
+            self._build_prompt, query, prompt_name, retrieved_docs, history, conversation_id)
+
+        response_stream = self._atrack_usage(self.llm.astream(prompt))
+
+        if conversation_id:
+            await asyncio.to_thread(self.memory.add_message, conversation_id, 'user', query)
+
+        return {
+            "stream": response_stream,
+            "context": context,
+            "retrieved_documents": [doc[0] for doc in retrieved_docs],
+            "conversation_id": conversation_id,
+            "answer_cache_key": answer_cache_key,
+            "prompt_tokens": prompt_tokens
         }
 
-    def save_bot_response(self, conversation_id: str, response: str):
-        """保存AI回复到记忆"""
+    def _record_usage(self, chunk):
+        """记录接口在最后一个流式分块中返回的实际提示词token数"""
+        usage = getattr(chunk, 'usage_metadata', None)
+        if usage and usage.get('input_tokens'):
+            self.context_builder.record_usage(usage['input_tokens'])
+            print(f"实际提示词 {usage['input_tokens']} tokens，回答 {usage.get('output_tokens', 0)} tokens")
+
+    def _track_usage(self, stream):
+        for chunk in stream:
+            self._record_usage(chunk)
+            yield chunk
+
+    async def _atrack_usage(self, stream):
+        async for chunk in stream:
+            self._record_usage(chunk)
+            yield chunk
+
+    def save_bot_response(self, conversation_id: str, response: str, answer_cache_key=None):
+        """保存AI回复到记忆，answer_cache_key不为空时同时写入语义回答缓存"""
         if conversation_id:
             self.memory.add_message(conversation_id, 'assistant', response)
+        if answer_cache_key is not None and self.answer_cache is not None and response:
+            self.answer_cache.put(answer_cache_key[0], answer_cache_key[1], response)
 
     def clear_conversation_memory(self, conversation_id: str):
         """清空特定对话的记忆"""
-        self.memory.clear_conversation(conversation_id)
\ No newline at end of file
+        self.memory.clear_conversation(conversation_id)
+        self.context_builder.clear(conversation_id)
\ No newline at end of file
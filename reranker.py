@@ -0,0 +1,326 @@
+import json
+import time
+import asyncio
+import threading
+import requests
+import numpy as np
+from abc import ABC, abstractmethod
+from requests.adapters import HTTPAdapter
+from typing import List, Tuple
+
+
+class BaseReranker(ABC):
+    """重排序后端接口"""
+
+    @abstractmethod
+    def rerank(self, query: str, documents: List[str], top_k: int = 3) -> List[Tuple[str, float]]:
+        """返回按相关度降序排列的前top_k个(文档, 分数)"""
+
+    async def arerank(self, query: str, documents: List[str], top_k: int = 3) -> List[Tuple[str, float]]:
+        """异步重排序，默认在线程池中执行rerank（本地模型打分是CPU计算）"""
+        return await asyncio.to_thread(self.rerank, query, documents, top_k)
+
+    def get_stats(self) -> dict:
+        return {}
+
+
+class RemoteReranker(BaseReranker):
+    """远程重排序接口客户端（SiliconFlow rerank API）
+
+    - 复用长连接的requests.Session，避免每次请求重新建立TLS连接
+    - 每次请求有总时间预算timeout（从发出请求到读完响应），超时后退回FAISS原始顺序：
+      同步请求边读取响应边检查截止时间，异步请求整体由asyncio.wait_for限时
+    - 连续失败达到阈值后熔断，冷却期内直接跳过远程调用；冷却结束后进入半开状态，只放行一个试探请求，
+      其余请求继续退回原始顺序，试探成功才恢复，失败则重新熔断
+    - arerank使用httpx.AsyncClient，异步服务（asgi.py）中不占用线程，与同步调用共用熔断状态和统计
+    """
+
+    def __init__(self, api_key: str, url: str, model: str, timeout: float = 3.0,
+                 failure_threshold: int = 3, cooldown: float = 30.0, pool_size: int = 10,
+                 async_pool_size: int = 100):
+        self.api_key = api_key
+        self.url = url
+        self.model = model
+        self.timeout = timeout
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        if api_key:
+            self.session.headers.update({"Authorization": f"Bearer {api_key}"})
+        self.async_pool_size = async_pool_size
+        self._async_client = None
+
+        self._lock = threading.Lock()
+        self._consecutive_failures = 0
+        self._open_until = 0.0  # 熔断冷却结束时间，0表示未熔断
+        self._probe_until = 0.0  # 半开状态下试探请求的截止时间，0表示没有进行中的试探
+        self.stats = {
+            'requests': 0,
+            'success': 0,
+            'timeouts': 0,
+            'failures': 0,
+            'fallbacks': 0,
+            'circuit_skips': 0,
+            'circuit_opened': 0
+        }
+
+    def _count(self, key: str):
+        with self._lock:
+            self.stats[key] += 1
+
+    def get_stats(self) -> dict:
+        with self._lock:
+            stats = dict(self.stats)
+            stats['circuit_open'] = self._open_until > 0
+        return stats
+
+    def _circuit_allows(self) -> bool:
+        """未熔断时放行；冷却结束后同一时间只放行一个试探请求
+
+        试探请求正常情况下会记录成功或失败；异步请求被取消时不会记录，超过时间预算后允许下一个试探。
+        """
+        with self._lock:
+            if not self._open_until:
+                return True
+            now = time.monotonic()
+            if now < self._open_until or now < self._probe_until:
+                return False
+            self._probe_until = now + self.timeout + 1.0
+            return True
+
+    def _record_success(self):
+        with self._lock:
+            self._consecutive_failures = 0
+            self._open_until = 0.0
+            self._probe_until = 0.0
+            self.stats['success'] += 1
+
+    def _record_failure(self, key: str):
+        with self._lock:
+            self.stats[key] += 1
+            self._consecutive_failures += 1
+            if self._probe_until:
+                # 半开状态的试探失败：重新熔断
+                self._probe_until = 0.0
+                self._open_until = time.monotonic() + self.cooldown
+                self.stats['circuit_opened'] += 1
+                print(f"Reranker 试探请求失败，继续熔断 {self.cooldown:.0f} 秒")
+            elif not self._open_until and self._consecutive_failures >= self.failure_threshold:
+                # 熔断：冷却期内跳过远程调用
+                self._open_until = time.monotonic() + self.cooldown
+                self.stats['circuit_opened'] += 1
+                print(f"Reranker 连续失败，熔断 {self.cooldown:.0f} 秒")
+
+    def _fallback(self, documents: List[str], top_k: int) -> List[Tuple[str, float]]:
+        self._count('fallbacks')
+        return [(doc, 0.0) for doc in documents[:top_k]]
+
+    def _skip(self, documents: List[str], top_k: int):
+        """不需要或不能调用远程接口时直接返回的结果，需要调用时返回None"""
+        if not documents:
+            return []
+        if not self.api_key:
+            return [(doc, 0.0) for doc in documents[:top_k]]
+        if not self._circuit_allows():
+            self._count('circuit_skips')
+            return self._fallback(documents, top_k)
+        return None
+
+    def _payload(self, query: str, documents: List[str]) -> dict:
+        return {
+            "model": self.model,
+            "query": query,
+            "documents": documents
+        }
+
+    @staticmethod
+    def _parse_results(documents: List[str], results: list) -> List[Tuple[str, float]]:
+        # 返回结果按相关度排序，通过index对应原文档
+        return sorted(
+            ((documents[res["index"]], res["relevance_score"]) for res in results),
+            key=lambda x: x[1],
+            reverse=True
+        )
+
+    def _read_body(self, response, deadline: float) -> bytes:
+        """读取响应，超过总截止时间时按超时处理（requests的read超时只限制单次读取的等待）
+
+        read1有数据到达就返回，服务端缓慢逐字节返回时也能及时检查截止时间。
+        """
+        chunks = []
+        while True:
+            chunk = response.raw.read1(8192, decode_content=True)
+            if not chunk:
+                return b"".join(chunks)
+            chunks.append(chunk)
+            if time.monotonic() > deadline:
+                raise requests.Timeout(f"响应读取超过总时间预算 {self.timeout} 秒")
+
+    def rerank(self, query: str, documents: List[str], top_k: int = 3) -> List[Tuple[str, float]]:
+        """重排序，失败、超时或熔断时按原顺序返回前top_k个文档"""
+        skipped = self._skip(documents, top_k)
+        if skipped is not None:
+            return skipped
+
+        self._count('requests')
+        deadline = time.monotonic() + self.timeout
+        try:
+            with self.session.post(self.url, json=self._payload(query, documents),
+                                   timeout=(min(self.timeout, 1.0), self.timeout), stream=True) as response:
+                response.raise_for_status()
+                body = self._read_body(response, deadline)
+            reranked = self._parse_results(documents, json.loads(body).get("results", []))
+        except requests.Timeout:
+            print(f"Reranker 调用超时（{self.timeout}秒），使用原始检索顺序")
+            self._record_failure('timeouts')
+            return self._fallback(documents, top_k)
+        except Exception as e:
+            print(f"Reranker 调用失败: {e}")
+            self._record_failure('failures')
+            return self._fallback(documents, top_k)
+
+        self._record_success()
+        return reranked[:top_k]
+
+    def _get_async_client(self):
+        """异步HTTP客户端（首次使用时创建，连接池在同一事件循环的请求之间复用）"""
+        if self._async_client is None:
+            import httpx
+            self._async_client = httpx.AsyncClient(
+                headers={"Authorization": f"Bearer {self.api_key}"},
+                timeout=httpx.Timeout(self.timeout, connect=min(self.timeout, 1.0)),
+                limits=httpx.Limits(max_connections=self.async_pool_size,
+                                    max_keepalive_connections=self.async_pool_size)
+            )
+        return self._async_client
+
+    async def arerank(self, query: str, documents: List[str], top_k: int = 3) -> List[Tuple[str, float]]:
+        """异步重排序，行为与rerank一致"""
+        import httpx
+
+        skipped = self._skip(documents, top_k)
+        if skipped is not None:
+            return skipped
+
+        self._count('requests')
+        try:
+            # httpx的超时同样只限制单次读取，整个请求由wait_for限制总耗时
+            response = await asyncio.wait_for(
+                self._get_async_client().post(self.url, json=self._payload(query, documents)),
+                self.timeout
+            )
+            response.raise_for_status()
+            reranked = self._parse_results(documents, response.json().get("results", []))
+        except (httpx.TimeoutException, asyncio.TimeoutError):
+            print(f"Reranker 调用超时（{self.timeout}秒），使用原始检索顺序")
+            self._record_failure('timeouts')
+            return self._fallback(documents, top_k)
+        except Exception as e:
+            print(f"Reranker 调用失败: {e}")
+            self._record_failure('failures')
+            return self._fallback(documents, top_k)
+
+        self._record_success()
+        return reranked[:top_k]
+
+    async def aclose(self):
+        if self._async_client is not None:
+            await self._async_client.aclose()
+            self._async_client = None
+
+
+class LocalCrossEncoderReranker(BaseReranker):
+    """进程内的交叉编码器重排序（bge-reranker等），在CPU上运行
+
+    所有(query, 文档)对在一次前向计算中批量打分，并限制最大序列长度，
+    没有网络开销，延迟可预期。runtime可选torch或onnx，torch下可开启int8动态量化。
+    """
+
+    def __init__(self, model_name: str, max_length: int = 512, runtime: str = 'torch',
+                 quantize: bool = False, num_threads: int = None):
+        self.model_name = model_name
+        self.max_length = max_length
+        self.runtime = runtime
+        self.quantize = quantize
+        self.num_threads = num_threads
+        self._tokenizer = None
+        self._model = None
+        self._lock = threading.Lock()
+        self.stats = {'calls': 0, 'pairs': 0, 'failures': 0, 'fallbacks': 0, 'total_seconds': 0.0}
+
+    def _load(self):
+        if self._model is not None:
+            return
+
+        with self._lock:
+            if self._model is not None:
+                return
+
+            import torch
+            from transformers import AutoTokenizer
+
+            if self.num_threads:
+                torch.set_num_threads(self.num_threads)
+
+            print(f"正在加载本地重排序模型: {self.model_name} (runtime={self.runtime}, int8={self.quantize})")
+            tokenizer = AutoTokenizer.from_pretrained(self.model_name)
+            if self.runtime == 'onnx':
+                from optimum.onnxruntime import ORTModelForSequenceClassification
+                model = ORTModelForSequenceClassification.from_pretrained(self.model_name, export=True)
+            else:
+                from transformers import AutoModelForSequenceClassification
+                model = AutoModelForSequenceClassification.from_pretrained(self.model_name)
+                model.eval()
+                if self.quantize:
+                    model = torch.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+
+            self._tokenizer = tokenizer
+            self._model = model
+
+    def _score(self, query: str, documents: List[str]) -> np.ndarray:
+        import torch
+
+        self._load()
+        inputs = self._tokenizer(
+            [[query, doc] for doc in documents],
+            padding=True,
+            truncation=True,
+            max_length=self.max_length,
+            return_tensors='pt'
+        )
+        with torch.no_grad():
+            logits = self._model(**inputs).logits.view(-1).float().numpy()
+        # 与远程接口一致，把logit映射到0~1的相关度
+        return 1.0 / (1.0 + np.exp(-logits))
+
+    def rerank(self, query: str, documents: List[str], top_k: int = 3) -> List[Tuple[str, float]]:
+        if not documents:
+            return []
+
+        start = time.perf_counter()
+        try:
+            scores = self._score(query, documents)
+        except Exception as e:
+            print(f"本地 Reranker 打分失败: {e}")
+            with self._lock:
+                self.stats['failures'] += 1
+                self.stats['fallbacks'] += 1
+            return [(doc, 0.0) for doc in documents[:top_k]]
+
+        with self._lock:
+            self.stats['calls'] += 1
+            self.stats['pairs'] += len(documents)
+            self.stats['total_seconds'] += time.perf_counter() - start
+
+        order = np.argsort(-scores)[:top_k]
+        return [(documents[i], float(scores[i])) for i in order]
+
+    def get_stats(self) -> dict:
+        with self._lock:
+            stats = dict(self.stats)
+        stats['avg_ms'] = stats['total_seconds'] * 1000 / stats['calls'] if stats['calls'] else 0.0
+        return stats
@@ -0,0 +1,147 @@
+"""多进程共享的对话记忆存储（SQLite、Redis）"""
+import threading
+import time
+
+import fakeredis
+import pytest
+
+import conversation_store
+from conversation_store import RedisConversationStore, SQLiteConversationStore
+
+MESSAGES = [("user", "问题一"), ("assistant", "回答一")]
+
+
+@pytest.fixture(params=['sqlite', 'redis'])
+def make_store(request, tmp_path):
+    """返回创建存储的函数，多次调用得到共享同一份数据的多个存储（模拟多个工作进程）"""
+    server = fakeredis.FakeServer()
+
+    def make(idle_ttl=3600):
+        if request.param == 'sqlite':
+            return SQLiteConversationStore(str(tmp_path / "memory.sqlite"), idle_ttl=idle_ttl)
+        return RedisConversationStore(idle_ttl=idle_ttl, client=fakeredis.FakeRedis(server=server))
+
+    return make
+
+
+def test_create_get_and_append(make_store):
+    store = make_store()
+    assert store.get("c1") is None
+    assert not store.append("c1", "user", "问题", 10)
+
+    assert store.create("c1", MESSAGES, 10)
+    assert store.get("c1") == MESSAGES
+    assert store.append("c1", "user", "问题二", 10)
+    assert store.get("c1") == MESSAGES + [("user", "问题二")]
+
+    # 已存在的对话不会被覆盖
+    assert not store.create("c1", [("user", "其他")], 10)
+    assert store.get("c1") == MESSAGES + [("user", "问题二")]
+
+    store.delete("c1")
+    assert store.get("c1") is None
+
+
+def test_keeps_only_latest_messages(make_store):
+    store = make_store()
+    messages = [("user", f"消息{i}") for i in range(5)]
+    assert store.create("c1", messages, 3)
+    assert store.get("c1") == messages[-3:]
+
+    assert store.append("c1", "assistant", "回答", 3)
+    assert store.get("c1") == messages[-2:] + [("assistant", "回答")]
+
+
+def test_racing_creates_only_one_wins(make_store):
+    stores = [make_store(), make_store()]
+    for round_id in range(20):
+        conversation_id = f"c{round_id}"
+        barrier = threading.Barrier(len(stores))
+        results = {}
+
+        def create(index):
+            barrier.wait()
+            results[index] = stores[index].create(conversation_id, [("user", f"进程{index}")], 10)
+
+        threads = [threading.Thread(target=create, args=(index,)) for index in range(len(stores))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        assert sorted(results.values()) == [False, True]
+        winner = next(index for index, created in results.items() if created)
+        assert stores[0].get(conversation_id) == stores[1].get(conversation_id) == [("user", f"进程{winner}")]
+
+
+def test_sqlite_idle_conversations_expire(tmp_path, monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(conversation_store.time, "time", lambda: now[0])
+    store = SQLiteConversationStore(str(tmp_path / "memory.sqlite"), idle_ttl=60)
+    assert store.create("c1", MESSAGES, 10)
+
+    # 追加会刷新最近使用时间
+    now[0] += 50
+    assert store.append("c1", "user", "问题二", 10)
+    now[0] += 50
+    assert store.get("c1") is not None
+
+    now[0] += 61
+    assert store.get("c1") is None
+    assert not store.append("c1", "user", "问题三", 10)
+    # 过期的对话由消息表重新加载后创建，旧消息被清除
+    assert store.create("c1", [("user", "重新加载")], 10)
+    assert store.get("c1") == [("user", "重新加载")]
+
+
+def test_sqlite_evicts_least_recently_used(tmp_path):
+    store = SQLiteConversationStore(str(tmp_path / "memory.sqlite"), max_conversations=2)
+    for conversation_id in ("c1", "c2"):
+        assert store.create(conversation_id, MESSAGES, 10)
+        time.sleep(0.01)
+    assert store.append("c1", "user", "问题二", 10)
+
+    assert store.create("c3", MESSAGES, 10)
+    assert store.get("c2") is None
+    assert store.get("c1") is not None
+    assert store.get_stats()['evictions'] == 1
+
+
+def test_redis_ttl_is_refreshed_and_expires():
+    client = fakeredis.FakeRedis()
+    store = RedisConversationStore(idle_ttl=1, client=client)
+    key = store._key("c1")
+    assert store.create("c1", MESSAGES, 10)
+    assert 0 < client.ttl(key) <= 1
+
+    time.sleep(0.6)
+    assert store.append("c1", "user", "问题二", 10)
+    time.sleep(0.6)
+    assert store.get("c1") is not None
+
+    time.sleep(1.1)
+    assert store.get("c1") is None
+    assert not store.append("c1", "user", "问题三", 10)
+
+
+def test_redis_create_loses_when_key_appears_after_watch(monkeypatch):
+    server = fakeredis.FakeServer()
+    first = RedisConversationStore(client=fakeredis.FakeRedis(server=server))
+    second = RedisConversationStore(client=fakeredis.FakeRedis(server=server))
+    pipeline = first.client.pipeline
+
+    def racing_pipeline(*args, **kwargs):
+        # WATCH和EXISTS检查之后、事务开始之前，其他进程创建了同一个对话
+        pipe = pipeline(*args, **kwargs)
+        multi = pipe.multi
+
+        def multi_after_other_create():
+            assert second.create("c1", [("user", "乙")], 10)
+            multi()
+
+        pipe.multi = multi_after_other_create
+        return pipe
+
+    monkeypatch.setattr(first.client, "pipeline", racing_pipeline)
+    assert not first.create("c1", [("user", "甲")], 10)
+    assert first.get("c1") == [("user", "乙")]
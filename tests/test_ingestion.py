@@ -0,0 +1,47 @@
+"""多文件入库流水线：进程池解析和并发调用的统计"""
+import threading
+
+import numpy as np
+
+from ingestion import IngestionPipeline
+
+
+def fake_embed(texts):
+    return np.ones((len(texts), 4), dtype=np.float32)
+
+
+def write_files(tmp_path, prefix, count):
+    files = []
+    for i in range(count):
+        path = tmp_path / f"{prefix}_{i}.txt"
+        path.write_text(f"第{i + 1}条 {prefix}文件的内容。", encoding='utf-8')
+        files.append((str(path), {'doc_id': i}))
+    return files
+
+
+def test_process_pool_parses_all_files(tmp_path):
+    pipeline = IngestionPipeline(fake_embed, workers=2, batch_size=2)
+    texts, embeddings, metadatas, stats = pipeline.run(write_files(tmp_path, "a", 3))
+
+    assert len(texts) == len(metadatas) == embeddings.shape[0] == 3
+    assert stats['files'] == 3
+    assert stats['failed_files'] == 0
+    assert stats['chunks'] == 3
+
+
+def test_concurrent_runs_return_their_own_stats(tmp_path):
+    pipeline = IngestionPipeline(fake_embed, workers=2)
+    batches = {'a': write_files(tmp_path, "a", 2), 'b': write_files(tmp_path, "b", 4)}
+    results = {}
+
+    def run(name):
+        results[name] = pipeline.run(batches[name])[3]
+
+    threads = [threading.Thread(target=run, args=(name,)) for name in batches]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert results['a']['files'] == 2
+    assert results['b']['files'] == 4
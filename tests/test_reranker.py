@@ -0,0 +1,126 @@
+"""远程重排序的总时间预算和熔断（本地HTTP桩服务）"""
+import asyncio
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from reranker import RemoteReranker
+
+DOCUMENTS = ["甲", "乙", "丙"]
+FALLBACK = [("甲", 0.0), ("乙", 0.0)]
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    """按server.mode返回：ok正常打分，error返回500，slow逐字节缓慢返回"""
+
+    def do_POST(self):
+        self.server.hits += 1
+        self.rfile.read(int(self.headers['Content-Length']))
+        if self.server.mode == 'error':
+            self.send_response(500)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+
+        body = json.dumps({'results': [
+            {'index': 2, 'relevance_score': 0.9},
+            {'index': 0, 'relevance_score': 0.5}
+        ]}).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if self.server.mode == 'slow':
+            # 每次读取都在单次读取超时内到达，但总耗时远超时间预算
+            for byte in body:
+                self.wfile.write(bytes([byte]))
+                self.wfile.flush()
+                time.sleep(0.05)
+        else:
+            self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def server():
+    httpd = ThreadingHTTPServer(('127.0.0.1', 0), StubHandler)
+    httpd.daemon_threads = True
+    httpd.mode = 'ok'
+    httpd.hits = 0
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    yield httpd
+    httpd.shutdown()
+    httpd.server_close()
+
+
+def make_reranker(server, **kwargs):
+    return RemoteReranker("key", f"http://127.0.0.1:{server.server_port}/rerank", "stub", **kwargs)
+
+
+def test_success_returns_reranked_documents(server):
+    reranker = make_reranker(server)
+    assert reranker.rerank("问题", DOCUMENTS, top_k=2) == [("丙", 0.9), ("甲", 0.5)]
+    assert asyncio.run(reranker.arerank("问题", DOCUMENTS, top_k=2)) == [("丙", 0.9), ("甲", 0.5)]
+
+
+def test_slow_response_falls_back_within_total_deadline(server):
+    server.mode = 'slow'
+    reranker = make_reranker(server, timeout=0.5)
+
+    start = time.monotonic()
+    assert reranker.rerank("问题", DOCUMENTS, top_k=2) == FALLBACK
+    assert time.monotonic() - start < 1.5
+
+    start = time.monotonic()
+    assert asyncio.run(reranker.arerank("问题", DOCUMENTS, top_k=2)) == FALLBACK
+    assert time.monotonic() - start < 1.5
+
+    stats = reranker.get_stats()
+    assert stats['timeouts'] == 2
+    assert stats['fallbacks'] == 2
+
+
+def test_open_circuit_skips_remote_calls(server):
+    server.mode = 'error'
+    reranker = make_reranker(server, failure_threshold=2, cooldown=60)
+    for _ in range(2):
+        assert reranker.rerank("问题", DOCUMENTS, top_k=2) == FALLBACK
+    assert server.hits == 2
+
+    server.mode = 'ok'
+    assert reranker.rerank("问题", DOCUMENTS, top_k=2) == FALLBACK
+    assert asyncio.run(reranker.arerank("问题", DOCUMENTS, top_k=2)) == FALLBACK
+    assert server.hits == 2
+
+    stats = reranker.get_stats()
+    assert stats['circuit_open']
+    assert stats['circuit_opened'] == 1
+    assert stats['circuit_skips'] == 2
+
+
+def test_probe_closes_circuit_or_reopens_it(server):
+    server.mode = 'error'
+    reranker = make_reranker(server, failure_threshold=1, cooldown=0.2)
+    reranker.rerank("问题", DOCUMENTS, top_k=2)
+    assert reranker.get_stats()['circuit_opened'] == 1
+
+    # 冷却结束后的试探请求失败：重新熔断并计数
+    time.sleep(0.3)
+    assert reranker.rerank("问题", DOCUMENTS, top_k=2) == FALLBACK
+    stats = reranker.get_stats()
+    assert stats['circuit_open']
+    assert stats['circuit_opened'] == 2
+
+    # 试探请求成功：恢复远程调用
+    server.mode = 'ok'
+    time.sleep(0.3)
+    assert reranker.rerank("问题", DOCUMENTS, top_k=2) == [("丙", 0.9), ("甲", 0.5)]
+    assert not reranker.get_stats()['circuit_open']
+    assert reranker.rerank("问题", DOCUMENTS, top_k=2) == [("丙", 0.9), ("甲", 0.5)]
+    assert server.hits == 4
@@ -0,0 +1,266 @@
+"""向量库持久化的崩溃恢复和并发保存"""
+import os
+import threading
+
+import numpy as np
+import pytest
+
+from vector_store import LegalVectorStore
+
+DIMENSION = 8
+
+
+def add_texts(store, texts, doc_id=1):
+    embeddings = np.random.RandomState(len(texts)).rand(len(texts), DIMENSION).astype(np.float32)
+    return store.add_embeddings(texts, embeddings, [{'doc_id': doc_id} for _ in texts])
+
+
+def stored_texts(store):
+    return set(store.get_texts(store.chunks.ids()))
+
+
+def base_dirs(path):
+    return sorted(name for name in os.listdir(path) if name.startswith("base_"))
+
+
+def current_base(path):
+    with open(os.path.join(path, LegalVectorStore.CURRENT_FILE), encoding='utf-8') as file:
+        return file.read().strip()
+
+
+@pytest.fixture(autouse=True)
+def compact_threshold(monkeypatch):
+    monkeypatch.setenv("VECTOR_DB_COMPACT_SEGMENTS", "1000")
+
+
+def test_segments_replayed_on_load(tmp_path):
+    path = str(tmp_path)
+    store = LegalVectorStore(None, DIMENSION)
+    add_texts(store, ["第一条 甲"])
+    store.save_local(path)
+    add_texts(store, ["第二条 乙", "第三条 丙"], doc_id=2)
+    store.persist(path)
+    store.delete_document(1)
+    store.persist(path)
+
+    loaded = LegalVectorStore.load_local(path, None)
+    assert stored_texts(loaded) == {"第二条 乙", "第三条 丙"}
+    assert loaded.ntotal == 2
+    assert loaded.next_id == store.next_id
+
+
+def test_crash_before_chunk_commit_recovers_from_segment(tmp_path, monkeypatch):
+    path = str(tmp_path)
+    store = LegalVectorStore(None, DIMENSION)
+    add_texts(store, ["第一条 甲"])
+    store.save_local(path)
+
+    add_texts(store, ["第二条 乙"])
+    # 段文件已写入，文档块存储的事务提交前进程崩溃
+    monkeypatch.setattr(store.chunks, "commit", lambda segment=None: (_ for _ in ()).throw(OSError("crash")))
+    with pytest.raises(OSError):
+        store.persist(path)
+    store.chunks._conn.rollback()
+    store.chunks._conn.close()
+
+    loaded = LegalVectorStore.load_local(path, None)
+    assert stored_texts(loaded) == {"第一条 甲", "第二条 乙"}
+    assert loaded.chunks.applied_segment == 1
+
+
+def test_leftover_temp_files_and_unfinished_base_are_ignored(tmp_path):
+    path = str(tmp_path)
+    store = LegalVectorStore(None, DIMENSION)
+    add_texts(store, ["第一条 甲"])
+    store.save_local(path)
+
+    # 崩溃时留下的临时文件和没有切换CURRENT的快照目录
+    with open(os.path.join(path, LegalVectorStore.CURRENT_FILE + ".tmp"), 'wb') as file:
+        file.write(b"base_99")
+    os.makedirs(os.path.join(path, "base_00000000_deadbeef"))
+
+    loaded = LegalVectorStore.load_local(path, None)
+    assert stored_texts(loaded) == {"第一条 甲"}
+
+    # 未完成的快照在比它新的快照被替换时清理
+    for text in ["第二条 乙", "第三条 丙"]:
+        add_texts(loaded, [text])
+        loaded.save_local(path)
+        assert os.path.isdir(os.path.join(path, current_base(path)))
+    assert base_dirs(path) == [current_base(path)]
+
+
+def test_stale_snapshot_does_not_replace_newer_base(tmp_path):
+    path = str(tmp_path)
+    store = LegalVectorStore(None, DIMENSION)
+    add_texts(store, ["第一条 甲"])
+    store.save_local(path)
+
+    add_texts(store, ["第二条 乙"])
+    store.persist(path)
+    with store._lock:
+        stale = store._snapshot()  # 后台合并截取的快照
+
+    add_texts(store, ["第三条 丙"])
+    store.save_local(path)  # 合并完成之前的一次完整保存
+    newer = current_base(path)
+
+    assert store._write_base(path, stale) is False
+    assert current_base(path) == newer
+    assert base_dirs(path) == [newer]
+    assert stored_texts(LegalVectorStore.load_local(path, None)) == {"第一条 甲", "第二条 乙", "第三条 丙"}
+
+
+def test_concurrent_save_and_compaction_keep_current_valid(tmp_path, monkeypatch):
+    monkeypatch.setenv("VECTOR_DB_COMPACT_SEGMENTS", "1")
+    path = str(tmp_path)
+    store = LegalVectorStore(None, DIMENSION)
+    add_texts(store, ["初始"])
+    store.save_local(path)
+
+    errors = []
+
+    def run(save, prefix):
+        try:
+            for i in range(20):
+                add_texts(store, [f"{prefix}{i}"])
+                save(path)
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=run, args=(store.persist, "增量")),
+               threading.Thread(target=run, args=(store.save_local, "完整"))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    while store._compacting:
+        threading.Event().wait(0.01)
+
+    assert not errors
+    assert os.path.isdir(os.path.join(path, current_base(path)))
+    loaded = LegalVectorStore.load_local(path, None)
+    assert stored_texts(loaded) == stored_texts(store)
+    assert len(stored_texts(loaded)) == 41
+
+
+def test_lookup_articles_prefers_full_article_over_summary_copy():
+    from langchain_core.documents import Document
+    from ingestion import create_text_splitter
+
+    # 文档开头是目录和只含首句的摘要版本，之后才是完整正文；第三条超长，会被再切分
+    long_article = "第三条 " + "。".join(f"第{i}项规定" for i in range(80)) + "。"
+    text = "\n".join([
+        "目录", "第一条", "第二条",
+        "第一条 总则首句。", "第二条 适用范围首句。", "第三条 第0项规定。",
+        "第一章 总则",
+        "第一条 总则首句。", "总则第二款。",
+        "第二条 适用范围首句。", "适用范围第二款。",
+        long_article
+    ])
+    chunks = create_text_splitter(max_chunk_size=200).split_documents(
+        [Document(page_content=text, metadata={'source': "测试法.txt"})])
+    assert all(chunk.page_content.strip() != chunk.metadata.get('article') for chunk in chunks)
+
+    store = LegalVectorStore(None, DIMENSION)
+    store.add_embeddings([chunk.page_content for chunk in chunks],
+                         np.random.RandomState(0).rand(len(chunks), DIMENSION).astype(np.float32),
+                         [chunk.metadata for chunk in chunks])
+
+    assert [doc.page_content for doc in store.lookup_articles(["测试法:1"])] == ["第一条 总则首句。\n总则第二款。"]
+    pieces = [doc.page_content for doc in store.lookup_articles(["测试法:3"])]
+    assert len(pieces) > 1 and "".join(pieces).replace("\n", "") == long_article
+
+
+def test_second_process_cannot_write(tmp_path):
+    import subprocess
+    import sys
+
+    path = str(tmp_path)
+    store = LegalVectorStore(None, DIMENSION)
+    add_texts(store, ["第一条 甲"])
+    store.save_local(path)
+    add_texts(store, ["第二条 乙"])  # 未保存的修改，写入进程持有SQLite写事务
+
+    # 被拒绝的写入不能改动第二个进程中已加载的向量库
+    script = f"""
+import sys
+import numpy as np
+sys.path.insert(0, {os.path.dirname(os.path.dirname(os.path.abspath(__file__)))!r})
+from vector_store import LegalVectorStore
+store = LegalVectorStore.load_local({path!r}, None)
+query = np.random.RandomState(1).rand({DIMENSION}).astype(np.float32)
+
+def state():
+    return (store.ntotal, store.next_id, store.generation, sorted(store.chunks.ids()),
+            sorted(store.metadata_index.ids('doc_id', 1)), store.similarity_search_with_score_by_vector(query, k=4))
+
+print(sorted(store.get_texts(store.chunks.ids())))
+before = state()
+writes = [
+    lambda: store.add_embeddings(["第三条 丙"], np.zeros((1, {DIMENSION}), dtype=np.float32), [{{'doc_id': 2}}]),
+    lambda: store.add_embeddings(["第一条 甲"], np.zeros((1, {DIMENSION}), dtype=np.float32), [{{'doc_id': 3}}]),
+    lambda: store.delete_document(1),
+    lambda: store.update_document_metadata(1, {{'kb_id': 5}}),
+]
+for write in writes:
+    try:
+        write()
+    except RuntimeError:
+        print("locked", state() == before)
+print(len(before[5]))
+"""
+    result = subprocess.run([sys.executable, "-c", script], capture_output=True, text=True, timeout=60)
+    assert result.stdout.splitlines() == ["['第一条 甲']"] + ["locked True"] * 4 + ["1"], result.stderr
+
+    store.persist(path)
+    assert stored_texts(LegalVectorStore.load_local(path, None)) == {"第一条 甲", "第二条 乙"}
+
+
+def test_reader_detects_new_segments_and_compaction(tmp_path):
+    path = str(tmp_path)
+    writer = LegalVectorStore(None, DIMENSION)
+    add_texts(writer, ["第一条 甲"])
+    writer.save_local(path)
+
+    reader = LegalVectorStore.load_local(path, None)
+    assert not reader.is_stale(path)
+
+    add_texts(writer, ["第二条 乙"], doc_id=2)
+    writer.persist(path)
+    assert reader.is_stale(path)
+    reader = LegalVectorStore.load_local(path, None)
+    assert not reader.is_stale(path)
+    assert stored_texts(reader) == {"第一条 甲", "第二条 乙"}
+
+    writer.delete_document(1)
+    writer.save_local(path)
+    assert reader.is_stale(path)
+    assert stored_texts(LegalVectorStore.load_local(path, None)) == {"第二条 乙"}
+
+
+def test_released_writer_lock_can_be_taken_by_another_process(tmp_path):
+    import subprocess
+    import sys
+
+    from chunk_store import release_writer_locks
+
+    path = str(tmp_path)
+    store = LegalVectorStore(None, DIMENSION)
+    add_texts(store, ["第一条 甲"])
+    store.save_local(path)
+
+    script = f"""
+import sys
+sys.path.insert(0, {os.path.dirname(os.path.dirname(os.path.abspath(__file__)))!r})
+from chunk_store import try_acquire_writer_lock
+print(try_acquire_writer_lock({os.path.join(path, LegalVectorStore.CHUNKS_FILE)!r}))
+"""
+
+    def other_process_acquires():
+        result = subprocess.run([sys.executable, "-c", script], capture_output=True, text=True, timeout=60)
+        return result.stdout.strip()
+
+    assert other_process_acquires() == "False"
+    release_writer_locks()
+    assert other_process_acquires() == "True"
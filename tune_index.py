@@ -0,0 +1,151 @@
+"""离线向量索引调参工具
+
+在现有向量库的全部向量上，以精确检索(flat)为基准，测量各索引类型和参数组合的
+recall@k、单条查询延迟和索引大小，推荐满足目标召回率且最快的配置。
+
+默认用库中随机抽取的文档块向量作为查询（去掉命中自身的结果）；也可以用 --questions
+指定一个每行一个问题的文本文件，用嵌入模型生成查询向量。
+
+用法:
+    python tune_index.py --db law_faiss --queries 200 --k 10 --target-recall 0.95
+    python tune_index.py --apply        # 把向量库转换为推荐的索引类型并保存
+"""
+import os
+import time
+import argparse
+import faiss
+import numpy as np
+from dotenv import load_dotenv
+from ann_index import build_index, min_train_size, needs_training, normalize_spec, sample_rows, search_params
+from vector_store import load_vector_store
+
+load_dotenv()
+
+
+def search_all(index, spec, queries, k, exclude_ids=None):
+    """逐条查询（与线上一致），返回结果ID、相似度和平均延迟(ms)"""
+    results, scores = [], []
+    start = time.perf_counter()
+    for row, query in enumerate(queries):
+        selector = None
+        if exclude_ids is not None:
+            excluded = faiss.IDSelectorBatch(exclude_ids[row:row + 1])
+            selector = faiss.IDSelectorNot(excluded)
+        distances, ids = index.search(query.reshape(1, -1), k, params=search_params(index, spec, selector))
+        results.append(ids[0])
+        scores.append(distances[0])
+    return np.array(results), np.array(scores), (time.perf_counter() - start) * 1000 / max(len(queries), 1)
+
+
+def recall_at_k(results, ground_truth):
+    hits = sum(len(set(result.tolist()) & set(truth.tolist())) for result, truth in zip(results, ground_truth))
+    return hits / ground_truth.size
+
+
+def sample_queries(ids, vectors, count, questions_file=None):
+    """生成查询向量：问题文件中的问题，或库中随机抽取的文档块（同时返回需要排除的自身ID）"""
+    if questions_file:
+        from model_utils import get_embedding_model
+        with open(questions_file, 'r', encoding='utf-8') as file:
+            questions = [line.strip() for line in file if line.strip()][:count]
+        return np.array(get_embedding_model().embed_documents(questions), dtype=np.float32), None
+
+    rows = sample_rows(len(ids), count, seed=1)
+    return vectors[rows], ids[rows]
+
+
+def candidate_specs(dimension):
+    """待测试的(构建参数, 检索参数列表)"""
+    candidates = [({'type': 'hnsw', 'hnsw_m': m}, [{'ef_search': ef} for ef in (16, 32, 64, 128, 256)])
+                  for m in (16, 32)]
+    nprobes = [{'nprobe': nprobe} for nprobe in (1, 2, 4, 8, 16, 32, 64)]
+    candidates.append(({'type': 'ivf_flat'}, nprobes))
+    for pq_m in (dimension // 4, dimension // 8):
+        if pq_m and dimension % pq_m == 0:
+            candidates.append(({'type': 'ivf_pq', 'pq_m': pq_m}, nprobes))
+    return candidates
+
+
+def main():
+    parser = argparse.ArgumentParser(description="向量索引调参：对比各索引类型相对精确检索的recall@k和延迟")
+    parser.add_argument('--db', default=os.getenv("VECTOR_DB_PATH", "law_faiss"), help="向量库路径")
+    parser.add_argument('--queries', type=int, default=200, help="抽样查询数量")
+    parser.add_argument('--questions', help="问题文件（每行一个），不指定时用库中文档块作为查询")
+    parser.add_argument('--k', type=int, default=10)
+    parser.add_argument('--target-recall', type=float, default=0.95)
+    parser.add_argument('--apply', action='store_true', help="把向量库转换为推荐配置并保存")
+    args = parser.parse_args()
+
+    store = load_vector_store(args.db, None)
+    if store is None:
+        print(f"向量库不存在: {args.db}")
+        return
+
+    ids, vectors = store.live_vectors()
+    count, dimension = vectors.shape
+    print(f"向量库: {args.db}，{count} 个向量，维度 {dimension}，当前索引 {store.index_type}，"
+          f"候选索引的存储精度 {normalize_spec(None)['storage']}")
+
+    queries, exclude_ids = sample_queries(ids, vectors, args.queries, args.questions)
+
+    baseline_spec = normalize_spec({'type': 'flat', 'storage': 'fp32'})
+    baseline = build_index(baseline_spec, dimension)
+    baseline.add_with_ids(vectors, ids)
+    ground_truth, _, baseline_ms = search_all(baseline, baseline_spec, queries, args.k, exclude_ids)
+    print(f"\n{'配置':<44}{'recall@' + str(args.k):>10}{'延迟(ms)':>10}{'大小(MB)':>10}")
+    print(f"{'flat':<44}{1.0:>10.3f}{baseline_ms:>10.3f}{vectors.nbytes / 2**20:>10.1f}")
+
+    results = []
+    for build_params, search_grid in candidate_specs(dimension):
+        spec = normalize_spec(build_params)
+        if needs_training(spec) and count < min_train_size(spec, count):
+            print(f"{spec['type']:<44}跳过：向量数量不足 {min_train_size(spec, count)}，无法训练")
+            continue
+
+        start = time.perf_counter()
+        train_vectors = vectors[sample_rows(count, spec['train_size'])] if needs_training(spec) else None
+        index = build_index(spec, dimension, train_vectors)
+        index.add_with_ids(vectors, ids)
+        build_seconds = time.perf_counter() - start
+        size_mb = faiss.serialize_index(index).nbytes / 2**20
+
+        for search in search_grid:
+            spec = normalize_spec({**build_params, **search})
+            found, _, latency = search_all(index, spec, queries, args.k, exclude_ids)
+            recall = recall_at_k(found, ground_truth)
+            label = ", ".join(f"{key}={value}" for key, value in {**build_params, **search}.items())
+            print(f"{label:<44}{recall:>10.3f}{latency:>10.3f}{size_mb:>10.1f}")
+            results.append({'spec': spec, 'build': build_params, 'search': search, 'recall': recall,
+                            'latency': latency, 'size_mb': size_mb, 'build_seconds': build_seconds})
+
+    if not results:
+        print("\n向量数量较少，精确检索(flat)即可")
+        return
+
+    qualified = [result for result in results if result['recall'] >= args.target_recall]
+    if qualified:
+        best = min(qualified, key=lambda result: result['latency'])
+    else:
+        best = max(results, key=lambda result: result['recall'])
+        print(f"\n没有配置达到目标召回率 {args.target_recall}，推荐召回率最高的配置")
+
+    if best['latency'] >= baseline_ms:
+        print(f"\n推荐继续使用flat：最佳候选 {best['build']} {best['search']} 并不比精确检索快")
+        return
+
+    print(f"\n推荐配置: recall@{args.k}={best['recall']:.3f}，延迟 {best['latency']:.3f}ms "
+          f"（精确检索 {baseline_ms:.3f}ms），构建耗时 {best['build_seconds']:.1f}s")
+    print("环境变量:")
+    env_names = {'type': 'VECTOR_INDEX_TYPE', 'hnsw_m': 'VECTOR_INDEX_HNSW_M', 'pq_m': 'VECTOR_INDEX_PQ_M',
+                 'nprobe': 'VECTOR_INDEX_NPROBE', 'ef_search': 'VECTOR_INDEX_EF_SEARCH'}
+    for key, value in {**best['build'], **best['search']}.items():
+        print(f"  {env_names[key]}={value}")
+
+    if args.apply:
+        store.convert_index(best['spec'])
+        store.persist(args.db)
+        print(f"向量库已转换并保存: {args.db}（检索参数需要通过上面的环境变量设置）")
+
+
+if __name__ == '__main__':
+    main()
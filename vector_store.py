@@ -0,0 +1,877 @@
+import os
+import json
+import shutil
+import uuid
+import threading
+import faiss
+import numpy as np
+from typing import List, Tuple, Optional
+from langchain_core.documents import Document
+from chunk_store import ChunkStore, acquire_writer_lock, content_hash
+from lexical_index import BM25Index, reciprocal_rank_fusion
+from legal_splitter import article_label
+from ann_index import (build_index, configure_search, fallback_spec, index_storage, index_type, matches_spec,
+                       min_train_size, needs_training, normalize_spec, read_index, sample_rows, search_params,
+                       stored_ids, supports_remove, writable_copy)
+
+
+class MetadataIndex:
+    """文档块元数据的倒排表：字段值 -> 向量ID集合
+
+    检索时据此生成FAISS的IDSelector，只在指定知识库/用户/文档的向量中搜索，
+    无需为每个知识库单独建索引；article_key用于按法条编号直接查找。
+    """
+
+    FIELDS = ('doc_id', 'kb_id', 'user_id', 'law', 'article_key', 'file_hash')
+
+    def __init__(self):
+        self._postings = {field: {} for field in self.FIELDS}
+
+    def add(self, vector_id: int, metadata: dict):
+        for field in self.FIELDS:
+            value = metadata.get(field)
+            if value is not None:
+                self._postings[field].setdefault(value, set()).add(vector_id)
+
+    def remove(self, vector_id: int, metadata: dict):
+        for field in self.FIELDS:
+            value = metadata.get(field)
+            ids = self._postings[field].get(value)
+            if ids is not None:
+                ids.discard(vector_id)
+                if not ids:
+                    del self._postings[field][value]
+
+    def ids(self, field: str, value) -> set:
+        return self._postings[field].get(value, set())
+
+    def values(self, field: str):
+        return self._postings[field].keys()
+
+    def select(self, filters: dict) -> np.ndarray:
+        """按过滤条件返回向量ID：字段之间为与，字段的多个取值之间为或"""
+        selected = None
+        for field, values in filters.items():
+            if field not in self._postings:
+                raise ValueError(f"不支持的过滤字段: {field}")
+            if not isinstance(values, (list, tuple, set)):
+                values = [values]
+
+            field_ids = set()
+            for value in values:
+                field_ids |= self.ids(field, value)
+            selected = field_ids if selected is None else selected & field_ids
+            if not selected:
+                break
+
+        return np.fromiter(selected or (), dtype=np.int64)
+
+
+class LegalVectorStore:
+    """基于FAISS IndexIDMap2的向量存储
+
+    每个文档块分配一个int64向量ID，元数据记录doc_id(UploadedDocument.id)、kb_id、
+    user_id、source、page。删除文档时可直接从索引中移除其全部向量，无需重建；
+    检索时可按元数据过滤。向量已标准化，使用内积作为相似度（越大越相似）。
+
+    内容相同的文档块（按content_hash判断）只保存一个向量，每个来源文档作为一条引用
+    （refs，每条引用一份完整元数据）挂在该向量上；删除文档只移除它的引用，
+    引用计数归零时才删除向量。
+
+    索引类型由index_spec指定（flat/ivf_flat/hnsw/ivf_pq，见ann_index）。需要训练的类型
+    在向量数量达到训练要求之前使用精确索引，达到后自动在样本上训练并转换；
+    HNSW不支持删除，删除的向量先标记，比例过高时重建。索引类型随快照保存。
+
+    向量可以按fp16或sq8存储以减少内存；加载时可以内存映射索引文件（多个工作进程共享），
+    映射的索引是只读的，第一次添加或删除向量时才复制到进程内存。
+
+    文档块的文本和引用保存在SQLite文档块存储中（见chunk_store），检索时只读取命中的文档块；
+    内存中只保留向量ID、用于过滤的元数据倒排表和BM25索引。
+    """
+
+    # 随快照保存的索引构建参数；nprobe/efSearch等检索参数始终取环境变量，便于调整
+    INDEX_BUILD_KEYS = ('type', 'nlist', 'hnsw_m', 'ef_construction', 'pq_m', 'storage')
+
+    # 引用中属于来源文件（而不是文档块本身）的元数据字段
+    OWNER_FIELDS = ('doc_id', 'kb_id', 'user_id', 'source', 'file_hash')
+
+    INDEX_FILE = "index.faiss"
+    MANIFEST_FILE = "manifest.json"
+    LEXICAL_FILE = "lexical.json"
+    CHUNKS_FILE = "chunks.sqlite"
+    # 旧格式的基础快照把全部文档块保存在这个JSON文件中，加载时迁移到文档块存储
+    DOCSTORE_FILE = "docstore.json"
+
+    def __init__(self, embedding, dimension: int, index_spec: dict = None, chunks: ChunkStore = None):
+        self.embedding = embedding
+        self.dimension = dimension
+        self.index_spec = normalize_spec(index_spec)
+        # 需要训练的索引类型先用精确索引，数据量足够后再训练转换
+        initial_spec = fallback_spec(self.index_spec) if needs_training(self.index_spec) else self.index_spec
+        self.index = build_index(initial_spec, dimension)
+        self._mmapped = False  # 索引是否为内存映射的只读索引
+        self._tombstones = set()  # 不支持删除的索引（HNSW）中已删除的向量ID
+        self._full_save = False  # 索引结构变化（训练、重建）后需要写完整快照
+        self.chunks = chunks if chunks is not None else ChunkStore()  # 向量ID -> 文本和引用（磁盘）
+        self.metadata_index = MetadataIndex()
+        self.lexical_index = BM25Index()
+        self.next_id = 0
+        self._lock = threading.RLock()
+        self._instance_id = uuid.uuid4().hex
+        self._version = 0
+        self._segment_seq = 0
+        self._merged_segment = 0  # 已合并进基础快照的最后一个段号
+        self._compacting = False
+        self._base_lock = threading.Lock()  # 串行写入基础快照（同步保存和后台合并之间）
+        self._snapshot_seq = 0  # 基础快照的截取序号，用于丢弃过时的快照
+        self._written_snapshot = 0  # 已写入磁盘的最新基础快照的截取序号
+        self._loaded_base = None  # 从磁盘加载时的基础快照目录名
+        self._reset_pending()
+
+    @classmethod
+    def from_embeddings(cls, texts: List[str], embeddings: np.ndarray, embedding,
+                        metadatas: List[dict] = None, index_spec: dict = None) -> "LegalVectorStore":
+        store = cls(embedding, embeddings.shape[1], index_spec)
+        store.add_embeddings(texts, embeddings, metadatas)
+        return store
+
+    @classmethod
+    def from_langchain_faiss(cls, legacy, embedding) -> "LegalVectorStore":
+        """从旧版langchain FAISS数据库转换（旧数据没有文档ID标记）"""
+        vectors = legacy.index.reconstruct_n(0, legacy.index.ntotal)
+        texts, metadatas = [], []
+        for i in range(legacy.index.ntotal):
+            doc = legacy.docstore.search(legacy.index_to_docstore_id[i])
+            texts.append(doc.page_content)
+            metadatas.append(dict(doc.metadata or {}))
+        return cls.from_embeddings(texts, np.asarray(vectors, dtype=np.float32), embedding, metadatas)
+
+    @property
+    def ntotal(self) -> int:
+        return len(self.chunks)
+
+    @property
+    def index_type(self) -> str:
+        """当前实际使用的索引类型（训练前为flat）"""
+        return index_type(self.index)
+
+    @property
+    def exact_vectors(self) -> bool:
+        """索引中保存的是否为原始float32向量（量化存储时取回的是近似向量）"""
+        return index_storage(self.index) == 'fp32'
+
+    def _check_writer(self):
+        """修改内存中的索引和元数据之前调用：文件存储的向量库先取得写锁，
+        其他进程持有写锁时抛出RuntimeError，本进程的向量库保持不变"""
+        if self.chunks.file_path:
+            acquire_writer_lock(self.chunks.file_path)
+
+    def _writable_index(self) -> faiss.Index:
+        """修改索引前调用：内存映射的只读索引先复制到进程内存"""
+        if self._mmapped:
+            print("内存映射的向量索引即将修改，复制到进程内存")
+            self.index = writable_copy(self.index)
+            configure_search(self.index, self.index_spec)
+            self._mmapped = False
+        return self.index
+
+    def live_vectors(self) -> Tuple[np.ndarray, np.ndarray]:
+        """全部有效向量的(ID, 向量)，按ID排序"""
+        with self._lock:
+            ids = np.array(self.chunks.ids(), dtype=np.int64)
+            if len(ids) == 0:
+                return ids, np.zeros((0, self.dimension), dtype=np.float32)
+            return ids, np.vstack([self.index.reconstruct(int(vector_id)) for vector_id in ids])
+
+    def _rebuild_index(self, spec: dict):
+        """用现有向量按spec重建索引，需要训练但数据量不足时先使用精确索引"""
+        ids, vectors = self.live_vectors()
+        if needs_training(spec) and len(ids) < min_train_size(spec, len(ids)):
+            index = build_index(fallback_spec(spec), self.dimension)
+        else:
+            train_vectors = vectors[sample_rows(len(ids), spec['train_size'])] if needs_training(spec) else None
+            index = build_index(spec, self.dimension, train_vectors)
+
+        if len(ids):
+            index.add_with_ids(vectors, ids)
+        self.index = index
+        self._mmapped = False
+        self._tombstones = set()
+        self._full_save = True
+        self._version += 1
+
+    def _maybe_train(self):
+        """向量数量达到训练要求时，把精确索引转换为配置的索引类型"""
+        if needs_training(self.index_spec) and not matches_spec(self.index, self.index_spec) and \
+                self.ntotal >= min_train_size(self.index_spec, self.ntotal):
+            print(f"向量数量达到 {self.ntotal}，正在训练 {self.index_spec['type']}"
+                  f"（{self.index_spec['storage']}）索引...")
+            self._rebuild_index(self.index_spec)
+
+    def convert_index(self, index_spec: dict):
+        """切换索引类型或构建参数（用现有向量重建，下次保存时写完整快照）
+
+        从IVF-PQ或量化存储转出时只能取回近似向量，需要精确向量时应重建向量库（嵌入缓存命中，无需重新嵌入）。
+        """
+        self._check_writer()
+        with self._lock:
+            self.index_spec = normalize_spec(index_spec)
+            self._rebuild_index(self.index_spec)
+            print(f"索引已转换为 {self.index_type}/{index_storage(self.index)}"
+                  f"（配置: {self.index_spec['type']}/{self.index_spec['storage']}）")
+
+    def set_search_params(self, nprobe: int = None, ef_search: int = None):
+        with self._lock:
+            if nprobe:
+                self.index_spec['nprobe'] = nprobe
+            if ef_search:
+                self.index_spec['ef_search'] = ef_search
+            configure_search(self.index, self.index_spec)
+
+    def _remove_vectors(self, vector_ids: List[int], rebuild: bool = True):
+        if supports_remove(self.index):
+            self._writable_index().remove_ids(np.array(vector_ids, dtype=np.int64))
+            return
+
+        self._tombstones.update(vector_ids)
+        ratio = float(os.getenv("VECTOR_INDEX_TOMBSTONE_RATIO", "0.2"))
+        if rebuild and len(self._tombstones) > ratio * max(self.index.ntotal, 1):
+            print(f"已删除向量 {len(self._tombstones)} 个，正在重建索引...")
+            self._rebuild_index(self.index_spec)
+
+    def get_stats(self) -> dict:
+        return {
+            'vectors': self.ntotal,
+            'index_type': self.index_type,
+            'storage': index_storage(self.index),
+            'mmap': self._mmapped,
+            'tombstones': len(self._tombstones)
+        }
+
+    @property
+    def generation(self) -> Tuple[str, int]:
+        """索引版本标识，每次添加或删除向量后变化，用于使检索缓存失效"""
+        return self._instance_id, self._version
+
+    def _register(self, vector_id: int, text: str, metadata: dict):
+        self.chunks.put(vector_id, text, [metadata])
+        self.metadata_index.add(vector_id, metadata)
+
+    def _unregister(self, vector_id: int) -> Optional[dict]:
+        """删除文档块（删除记录在下一个段文件中）"""
+        entry = self.chunks.get(vector_id)
+        if entry is not None:
+            for ref in entry['refs']:
+                self.metadata_index.remove(vector_id, ref)
+            self.chunks.delete(vector_id, self._segment_seq + 1)
+        return entry
+
+    def _refs(self, vector_id: int) -> List[dict]:
+        return self.chunks.get(vector_id)['refs']
+
+    def _set_refs(self, vector_id: int, refs: List[dict], old_refs: List[dict]):
+        """替换向量的引用列表（倒排表整体重建，多条引用取值相同时不会误删）"""
+        for ref in old_refs:
+            self.metadata_index.remove(vector_id, ref)
+        for ref in refs:
+            self.metadata_index.add(vector_id, ref)
+        self.chunks.set_refs(vector_id, refs)
+        self._pending_updates.append([vector_id, refs])
+
+    def has_document(self, doc_id: int) -> bool:
+        return bool(self.metadata_index.ids('doc_id', doc_id))
+
+    def has_file(self, file_hash: str) -> bool:
+        return bool(self.metadata_index.ids('file_hash', file_hash))
+
+    def find_by_content(self, texts: List[str]) -> List[Optional[int]]:
+        """按内容哈希查找已存在的文档块，返回向量ID（不存在为None）"""
+        with self._lock:
+            return [self.chunks.find(content_hash(text)) for text in texts]
+
+    def get_texts(self, vector_ids: List[int]) -> List[str]:
+        with self._lock:
+            entries = self.chunks.get_many(vector_ids)
+            return [entries[vector_id]['text'] for vector_id in vector_ids]
+
+    def reconstruct(self, vector_ids: List[int]) -> np.ndarray:
+        """取出已保存的向量（复用已有文档块的嵌入，无需重新计算）"""
+        with self._lock:
+            if not vector_ids:
+                return np.zeros((0, self.dimension), dtype=np.float32)
+            return np.vstack([self.index.reconstruct(int(vector_id)) for vector_id in vector_ids])
+
+    def add_embeddings(self, texts: List[str], embeddings: np.ndarray,
+                       metadatas: List[dict] = None) -> List[int]:
+        """添加文档块及其嵌入向量，返回每个文档块对应的向量ID
+
+        内容已存在的文档块不新增向量，只在已有向量上增加一条引用。
+        """
+        if metadatas is None:
+            metadatas = [{} for _ in texts]
+
+        self._check_writer()
+        embeddings = np.ascontiguousarray(embeddings, dtype=np.float32)
+        with self._lock:
+            result, new_rows, new_ids = [], [], []
+            for row, (text, metadata) in enumerate(zip(texts, metadatas)):
+                metadata = dict(metadata)
+                vector_id = self.chunks.find(content_hash(text))
+                if vector_id is not None:
+                    refs = self._refs(vector_id)
+                    if metadata not in refs:
+                        self._set_refs(vector_id, refs + [metadata], refs)
+                else:
+                    vector_id = self.next_id
+                    self.next_id += 1
+                    self._register(vector_id, text, metadata)
+                    self.lexical_index.add(vector_id, text)
+                    self._pending_records.append({'text': text, 'metadata': metadata})
+                    new_rows.append(row)
+                    new_ids.append(vector_id)
+                result.append(vector_id)
+
+            if new_ids:
+                vectors = embeddings[new_rows]
+                self._writable_index().add_with_ids(vectors, np.array(new_ids, dtype=np.int64))
+                self._pending_ids.extend(new_ids)
+                self._pending_vectors.append(vectors)
+                self._maybe_train()
+            self._version += 1
+        return result
+
+    def link_file(self, file_hash: str, metadata: dict) -> List[Tuple[int, dict]]:
+        """相同内容的文件已入库时，直接为其全部文档块添加引用，返回(向量ID, 新引用)
+
+        文档块层面的元数据（页码、法条等）沿用已有引用，来源字段使用metadata。
+        """
+        owner = {key: value for key, value in metadata.items() if value is not None}
+        owner['file_hash'] = file_hash
+        self._check_writer()
+        with self._lock:
+            linked = []
+            entries = self.chunks.get_many(sorted(self.metadata_index.ids('file_hash', file_hash)))
+            for vector_id, entry in entries.items():
+                refs = entry['refs']
+                base = next(ref for ref in refs if ref.get('file_hash') == file_hash)
+                ref = {key: value for key, value in base.items() if key not in self.OWNER_FIELDS}
+                ref.update(owner)
+                if ref not in refs:
+                    self._set_refs(vector_id, refs + [ref], refs)
+                linked.append((vector_id, ref))
+            if linked:
+                self._version += 1
+            return linked
+
+    def delete_document(self, doc_id: int) -> int:
+        """删除某个文档的全部引用，返回涉及的文档块数量；没有其他引用的向量从索引中移除"""
+        self._check_writer()
+        with self._lock:
+            ids = sorted(self.metadata_index.ids('doc_id', doc_id))
+            if not ids:
+                return 0
+
+            removed = []
+            for vector_id, entry in self.chunks.get_many(ids).items():
+                refs = [ref for ref in entry['refs'] if ref.get('doc_id') != doc_id]
+                if refs:
+                    self._set_refs(vector_id, refs, entry['refs'])
+                else:
+                    removed.append(vector_id)
+
+            if removed:
+                self._remove_vectors(removed)
+                for vector_id in removed:
+                    entry = self._unregister(vector_id)
+                    self.lexical_index.remove(vector_id, entry['text'])
+                self._pending_deleted.extend(removed)
+            self._version += 1
+            return len(ids)
+
+    def update_document_metadata(self, doc_id: int, updates: dict) -> int:
+        """更新某个文档全部引用的元数据（如补充kb_id），返回更新的文档块数量"""
+        self._check_writer()
+        with self._lock:
+            updated = 0
+            for vector_id, entry in self.chunks.get_many(sorted(self.metadata_index.ids('doc_id', doc_id))).items():
+                refs = entry['refs']
+                new_refs = [{**ref, **updates} if ref.get('doc_id') == doc_id else ref for ref in refs]
+                if new_refs == refs:
+                    continue
+
+                self._set_refs(vector_id, new_refs, refs)
+                updated += 1
+            if updated:
+                self._version += 1
+            return updated
+
+    def _dense_search(self, query: np.ndarray, k: int, filters: dict = None) -> List[Tuple[int, float]]:
+        """向量检索，返回(向量ID, 相似度)，调用方需持有锁"""
+        if self.index.ntotal == 0:
+            return []
+
+        selector = excluded = None
+        if filters:
+            selected = self.metadata_index.select(filters)
+            if len(selected) == 0:
+                return []
+            selector = faiss.IDSelectorBatch(selected)
+            k = min(k, len(selected))
+        elif self._tombstones:
+            excluded = faiss.IDSelectorBatch(np.fromiter(self._tombstones, dtype=np.int64))
+            selector = faiss.IDSelectorNot(excluded)
+
+        params = search_params(self.index, self.index_spec, selector)
+        scores, ids = self.index.search(query, min(k, self.index.ntotal), params=params)
+        return [(vector_id, score) for vector_id, score in zip(ids[0].tolist(), scores[0].tolist())
+                if vector_id >= 0 and vector_id in self.chunks]
+
+    def _longest_occurrence(self, vector_ids: List[int]) -> List[int]:
+        """同一法条出现多次时（例如文档开头有只含首句的摘要版本），只保留正文最长的一次
+
+        以"第X条"开头的文本块开始一次出现，其后不以它开头的文本块是同一条超长法条切分出的后续部分。
+        """
+        entries = self.chunks.get_many(vector_ids)
+        occurrences = []
+        for vector_id in vector_ids:
+            if vector_id not in entries:
+                continue
+            if not occurrences or article_label(entries[vector_id]['text']):
+                occurrences.append([])
+            occurrences[-1].append(vector_id)
+        return max(occurrences, key=lambda ids: sum(len(entries[vector_id]['text']) for vector_id in ids),
+                   default=[])
+
+    def lookup_articles(self, keys: List[str], filters: dict = None) -> List[Document]:
+        """按法条查找键（如"刑法:264"）直接取出对应文本块，不做向量检索"""
+        with self._lock:
+            allowed_ids = set(self.metadata_index.select(filters).tolist()) if filters else None
+            vector_ids = []
+            for key in keys:
+                key_ids = [vector_id for vector_id in sorted(self.metadata_index.ids('article_key', key))
+                           if allowed_ids is None or vector_id in allowed_ids]
+                vector_ids.extend(self._longest_occurrence(key_ids))
+            return self._to_documents(vector_ids, filters)
+
+    @staticmethod
+    def _matches(metadata: dict, filters: dict) -> bool:
+        for field, values in filters.items():
+            if not isinstance(values, (list, tuple, set)):
+                values = [values]
+            if metadata.get(field) not in values:
+                return False
+        return True
+
+    def _to_documents(self, vector_ids: List[int], filters: dict = None) -> List[Document]:
+        """从文档块存储一次读出命中的文档块并转换为Document，有过滤条件时使用符合条件的那条引用的元数据"""
+        entries = self.chunks.get_many(vector_ids)
+        documents = []
+        for vector_id in vector_ids:
+            entry = entries[vector_id]
+            metadata = entry['metadata']
+            if filters and len(entry['refs']) > 1:
+                metadata = next((ref for ref in entry['refs'] if self._matches(ref, filters)), metadata)
+            documents.append(Document(page_content=entry['text'], metadata=metadata))
+        return documents
+
+    def similarity_search_with_score_by_vector(self, embedding: np.ndarray, k: int = 4,
+                                               filters: dict = None) -> List[Tuple[Document, float]]:
+        """向量检索，filters如{'kb_id': 3}或{'user_id': [1, 2]}，在搜索时通过IDSelector过滤"""
+        query = np.asarray(embedding, dtype=np.float32).reshape(1, -1)
+        with self._lock:
+            hits = self._dense_search(query, k, filters)
+            documents = self._to_documents([vector_id for vector_id, _ in hits], filters)
+            return list(zip(documents, [score for _, score in hits]))
+
+    def similarity_search_with_score(self, query: str, k: int = 4,
+                                     filters: dict = None) -> List[Tuple[Document, float]]:
+        return self.similarity_search_with_score_by_vector(self.embedding.embed_query(query), k=k, filters=filters)
+
+    def _dense_score(self, query: np.ndarray, vector_id: int) -> float:
+        try:
+            return float(self.index.reconstruct(int(vector_id)) @ query[0])
+        except RuntimeError:
+            return 0.0
+
+    def hybrid_search(self, embedding: np.ndarray, query: str, k: int = 4, fetch_k: int = None,
+                      filters: dict = None) -> List[Tuple[Document, float]]:
+        """混合检索：向量检索与BM25各取fetch_k个候选，按倒数排名融合后取前k个
+
+        返回的分数统一为向量相似度，只被BM25召回的文档块单独计算相似度。
+        """
+        fetch_k = fetch_k or k * 2
+        query_vector = np.asarray(embedding, dtype=np.float32).reshape(1, -1)
+        with self._lock:
+            dense_scores = dict(self._dense_search(query_vector, fetch_k, filters))
+
+            allowed_ids = set(self.metadata_index.select(filters).tolist()) if filters else None
+            lexical = self.lexical_index.search(query, k=fetch_k, allowed_ids=allowed_ids)
+
+            fused = [vector_id for vector_id, _ in
+                     reciprocal_rank_fusion([list(dense_scores), [vector_id for vector_id, _ in lexical]])[:k]]
+            scores = []
+            for vector_id in fused:
+                score = dense_scores.get(vector_id)
+                if score is None:
+                    score = self._dense_score(query_vector, vector_id)
+                scores.append(score)
+            return list(zip(self._to_documents(fused, filters), scores))
+
+    # ---------- 持久化：不可变基础快照 + 追加式段日志 + 文档块存储 ----------
+    #
+    # 目录结构:
+    #   CURRENT                  当前基础快照目录名（原子替换）
+    #   chunks.sqlite            文档块存储：文本和引用，记录已写入的最后一个段号
+    #   base_<段号>_<随机后缀>/index.faiss     基础快照索引
+    #   base_<段号>_<随机后缀>/manifest.json   维度、下一个向量ID、已合并的段号、索引配置
+    #   base_<段号>_<随机后缀>/lexical.json     BM25倒排索引
+    #   segments/seg_00000001.npz  追加段：新增向量、文本、被删除的向量ID和元数据更新
+    #
+    # 每次保存只写入上次保存以来的变更，写完段文件后再提交文档块存储的事务（提交前崩溃时，
+    # 加载时用段文件中的记录补上）；段数达到阈值后在后台合并为新的基础快照。
+    # 向量ID和段号由进程内计数器分配，一个目录只能由一个进程写入：修改前取得写锁（chunks.sqlite.lock），
+    # 其他进程可以加载和检索，写入时报错；它们通过is_stale发现写入进程保存的新数据后重新加载。
+
+    CURRENT_FILE = "CURRENT"
+    SEGMENTS_DIR = "segments"
+
+    @staticmethod
+    def exists(path: str) -> bool:
+        return os.path.exists(os.path.join(path, LegalVectorStore.CURRENT_FILE))
+
+    @staticmethod
+    def _fsync_dir(dir_path: str):
+        """同步目录项，保证重命名在断电后仍然有效（Windows不支持打开目录，跳过）"""
+        if os.name != 'posix':
+            return
+        fd = os.open(dir_path, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+    @classmethod
+    def _atomic_write(cls, file_path: str, write_func):
+        """先写临时文件再重命名，保证崩溃时不会留下写了一半的文件"""
+        tmp_path = file_path + ".tmp"
+        with open(tmp_path, 'wb') as file:
+            write_func(file)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(tmp_path, file_path)
+        cls._fsync_dir(os.path.dirname(file_path) or ".")
+
+    @classmethod
+    def _current_base(cls, path: str) -> Optional[str]:
+        current_path = os.path.join(path, cls.CURRENT_FILE)
+        if not os.path.exists(current_path):
+            return None
+        with open(current_path, 'r', encoding='utf-8') as file:
+            return file.read().strip()
+
+    @staticmethod
+    def _base_segment(name: str) -> int:
+        """基础快照目录名中的段号（base_<段号>_<随机后缀>），无法解析时返回-1"""
+        try:
+            return int(name.split("_")[1])
+        except (IndexError, ValueError):
+            return -1
+
+    @classmethod
+    def _segment_path(cls, path: str, seq: int) -> str:
+        return os.path.join(path, cls.SEGMENTS_DIR, f"seg_{seq:08d}.npz")
+
+    @classmethod
+    def _list_segments(cls, path: str) -> List[int]:
+        segments_dir = os.path.join(path, cls.SEGMENTS_DIR)
+        if not os.path.exists(segments_dir):
+            return []
+        return sorted(
+            int(name[4:-4]) for name in os.listdir(segments_dir)
+            if name.startswith("seg_") and name.endswith(".npz")
+        )
+
+    def is_stale(self, path: str) -> bool:
+        """path中的数据是否比本进程加载的新（其他进程保存了新的段文件或基础快照），只读进程据此重新加载"""
+        base = self._current_base(path)
+        if base is None:
+            return False
+        return base != self._loaded_base or max(self._list_segments(path), default=0) > self._segment_seq
+
+    def _reset_pending(self):
+        self._pending_ids = []
+        self._pending_vectors = []
+        self._pending_records = []
+        self._pending_deleted = []
+        self._pending_updates = []
+
+    def _has_pending(self) -> bool:
+        return bool(self._pending_ids or self._pending_deleted or self._pending_updates)
+
+    def _write_segment(self, path: str):
+        """把未保存的变更写成一个新的段文件，然后提交文档块存储"""
+        seq = self._segment_seq + 1
+        if self._pending_vectors:
+            vectors = np.concatenate(self._pending_vectors).astype(np.float32)
+        else:
+            vectors = np.zeros((0, self.dimension), dtype=np.float32)
+
+        os.makedirs(os.path.join(path, self.SEGMENTS_DIR), exist_ok=True)
+        self._atomic_write(self._segment_path(path, seq), lambda file: np.savez(
+            file,
+            ids=np.array(self._pending_ids, dtype=np.int64),
+            vectors=vectors,
+            records=np.array(json.dumps(self._pending_records, ensure_ascii=False)),
+            deleted=np.array(self._pending_deleted, dtype=np.int64),
+            updates=np.array(json.dumps(self._pending_updates, ensure_ascii=False))
+        ))
+        self._segment_seq = seq
+        self._reset_pending()
+        # 已合并进基础快照的删除不再需要保留文本，随这次提交清除
+        self.chunks.purge(self._merged_segment)
+        self.chunks.commit(seq)
+
+    def _snapshot(self) -> dict:
+        """在锁内截取当前状态，供写入基础快照使用"""
+        self._snapshot_seq += 1
+        return {
+            'seq': self._snapshot_seq,
+            'index': faiss.serialize_index(self.index),
+            'lexical': self.lexical_index.to_json(),
+            'manifest': {
+                'dimension': self.dimension,
+                'next_id': self.next_id,
+                'last_segment': self._segment_seq,
+                'index_spec': {key: self.index_spec[key] for key in self.INDEX_BUILD_KEYS}
+            }
+        }
+
+    def _write_base(self, path: str, snapshot: dict):
+        """写入新的基础快照，切换CURRENT后清理被替换的旧快照和已合并的段
+
+        同步保存和后台合并可能同时进行，写入在_base_lock内串行执行；比已写入的快照更早截取的快照
+        （例如合并期间又做了一次完整保存）直接丢弃，不会让CURRENT退回旧状态。
+        """
+        with self._base_lock:
+            if snapshot['seq'] <= self._written_snapshot:
+                return False
+            self._switch_base(path, snapshot)
+            self._written_snapshot = snapshot['seq']
+            return True
+
+    def _switch_base(self, path: str, snapshot: dict):
+        last_segment = snapshot['manifest']['last_segment']
+        replaced = self._current_base(path)
+        base_name = f"base_{last_segment:08d}_{uuid.uuid4().hex[:8]}"
+        base_dir = os.path.join(path, base_name)
+        os.makedirs(base_dir, exist_ok=True)
+
+        self._atomic_write(os.path.join(base_dir, self.INDEX_FILE),
+                           lambda file: file.write(snapshot['index'].tobytes()))
+        self._atomic_write(os.path.join(base_dir, self.MANIFEST_FILE),
+                           lambda file: file.write(json.dumps(snapshot['manifest']).encode('utf-8')))
+        self._atomic_write(os.path.join(base_dir, self.LEXICAL_FILE),
+                           lambda file: file.write(snapshot['lexical'].encode('utf-8')))
+        self._atomic_write(os.path.join(path, self.CURRENT_FILE),
+                           lambda file: file.write(base_name.encode('utf-8')))
+
+        # 只删除被替换的快照和比它更早的快照（包括崩溃时留下的未完成快照），
+        # 其他进程正在写入的更新的快照和CURRENT指向的快照都保留
+        if replaced is not None:
+            current = self._current_base(path)
+            for name in os.listdir(path):
+                if name.startswith("base_") and name not in (base_name, current) and \
+                        (name == replaced or self._base_segment(name) < self._base_segment(replaced)):
+                    shutil.rmtree(os.path.join(path, name), ignore_errors=True)
+        for seq in self._list_segments(path):
+            if seq <= last_segment:
+                os.remove(self._segment_path(path, seq))
+        self._merged_segment = max(self._merged_segment, last_segment)
+
+    def _compact_in_background(self, path: str, snapshot: dict):
+        def run():
+            try:
+                if self._write_base(path, snapshot):
+                    print(f"向量数据库段日志已合并: {path}")
+            except Exception as e:
+                print(f"向量数据库段日志合并失败: {e}")
+            finally:
+                self._compacting = False
+
+        threading.Thread(target=run, daemon=True).start()
+
+    def save_local(self, path: str):
+        """保存完整的基础快照（同步）"""
+        os.makedirs(path, exist_ok=True)
+        chunks_path = os.path.join(path, self.CHUNKS_FILE)
+        acquire_writer_lock(chunks_path)
+        with self._lock:
+            if self.chunks.file_path == chunks_path and self.exists(path):
+                if self._has_pending():
+                    self._write_segment(path)
+            else:
+                # 第一次保存到该路径：基础快照包含全部数据，目录中已有的段文件作废
+                self._reset_pending()
+                self._segment_seq = max([self._segment_seq] + self._list_segments(path))
+                self.chunks.purge()
+                self.chunks.attach(chunks_path)
+                self.chunks.commit(self._segment_seq)
+            snapshot = self._snapshot()
+            self._full_save = False
+        self._write_base(path, snapshot)
+
+    def persist(self, path: str):
+        """增量保存：只把新增向量和删除记录追加为一个段文件，段过多时后台合并"""
+        if not self.exists(path) or self._full_save or \
+                self.chunks.file_path != os.path.join(path, self.CHUNKS_FILE):
+            self.save_local(path)
+            return
+
+        acquire_writer_lock(self.chunks.file_path)
+        compact_threshold = int(os.getenv("VECTOR_DB_COMPACT_SEGMENTS", "20"))
+        with self._lock:
+            if self._has_pending():
+                self._write_segment(path)
+
+            snapshot = None
+            if not self._compacting and len(self._list_segments(path)) >= compact_threshold:
+                snapshot = self._snapshot()
+                self._compacting = True
+
+        if snapshot is not None:
+            self._compact_in_background(path, snapshot)
+
+    def _apply_segment(self, segment_path: str, seq: int, apply_chunks: bool):
+        """重放段文件；apply_chunks为False表示文档块存储已包含该段，只需恢复向量索引和BM25索引"""
+        with np.load(segment_path, allow_pickle=False) as segment:
+            ids = segment['ids']
+            if len(ids):
+                self._writable_index().add_with_ids(np.ascontiguousarray(segment['vectors'], dtype=np.float32), ids)
+                for vector_id, record in zip(ids.tolist(), json.loads(str(segment['records']))):
+                    if apply_chunks:
+                        self.chunks.put(vector_id, record['text'], [record['metadata']])
+                    self.lexical_index.add(vector_id, record['text'])
+                self.next_id = max(self.next_id, int(ids.max()) + 1)
+
+            deleted = segment['deleted']
+            if len(deleted):
+                self._remove_vectors(deleted.tolist(), rebuild=False)
+                for vector_id in deleted.tolist():
+                    text = self.chunks.text(vector_id, include_deleted=True)
+                    if text is not None:
+                        self.lexical_index.remove(vector_id, text)
+                    if apply_chunks:
+                        self.chunks.delete(vector_id, seq)
+
+            if apply_chunks and 'updates' in segment.files:
+                # 每条更新记录向量的完整引用列表（旧格式为单个元数据）
+                for vector_id, refs in json.loads(str(segment['updates'])):
+                    if vector_id in self.chunks:
+                        self.chunks.set_refs(vector_id, refs if isinstance(refs, list) else [refs])
+
+    @classmethod
+    def _migrate_docstore(cls, path: str, data: dict) -> ChunkStore:
+        """旧格式的基础快照把文档块保存在docstore.json中，导入到新建的文档块存储"""
+        print(f"正在把文档块迁移到文档块存储: {path}")
+        chunks = ChunkStore.create(os.path.join(path, cls.CHUNKS_FILE))
+        for key, entry in data['docstore'].items():
+            chunks.put(int(key), entry['text'], entry.get('refs') or [entry['metadata']])
+        chunks.commit(data['last_segment'])
+        return chunks
+
+    @classmethod
+    def load_local(cls, path: str, embedding, mmap: bool = None) -> "LegalVectorStore":
+        """加载基础快照并按顺序重放其后的段文件
+
+        文档块存储只读取引用（用于重建元数据倒排表），文本在检索命中时才读取。
+        mmap为True（默认取环境变量VECTOR_DB_MMAP）时内存映射索引文件；其后的段文件中有新增或删除的向量时，
+        重放会把索引复制到进程内存，所以需要共享内存的部署应让段日志及时合并（VECTOR_DB_COMPACT_SEGMENTS）。
+        """
+        if mmap is None:
+            mmap = os.getenv("VECTOR_DB_MMAP", "false").lower() == "true"
+
+        with open(os.path.join(path, cls.CURRENT_FILE), 'r', encoding='utf-8') as file:
+            base_dir = os.path.join(path, file.read().strip())
+
+        legacy = not os.path.exists(os.path.join(base_dir, cls.MANIFEST_FILE))
+        manifest_file = cls.DOCSTORE_FILE if legacy else cls.MANIFEST_FILE
+        with open(os.path.join(base_dir, manifest_file), 'r', encoding='utf-8') as file:
+            data = json.load(file)
+
+        if legacy:
+            chunks = cls._migrate_docstore(path, data)
+            del data['docstore']
+        else:
+            chunks = ChunkStore(os.path.join(path, cls.CHUNKS_FILE))
+
+        saved_spec = data.get('index_spec')
+        if saved_spec is not None:
+            # 增加存储精度配置之前保存的快照都是float32向量
+            saved_spec.setdefault('storage', 'fp32')
+        store = cls(embedding, data['dimension'], saved_spec, chunks)
+        store._loaded_base = os.path.basename(base_dir)
+        store.index = read_index(os.path.join(base_dir, cls.INDEX_FILE), mmap=mmap)
+        store._mmapped = mmap
+        configure_search(store.index, store.index_spec)
+        store.next_id = data['next_id']
+        store._segment_seq = data['last_segment']
+        store._merged_segment = data['last_segment']
+
+        # 倒排索引：优先读取快照，缺失或分词器不一致时根据文本重建
+        lexical_path = os.path.join(base_dir, cls.LEXICAL_FILE)
+        lexical_index = None
+        if os.path.exists(lexical_path):
+            with open(lexical_path, 'r', encoding='utf-8') as file:
+                lexical_index = BM25Index.from_json(file.read())
+        if lexical_index is None:
+            print("正在重建BM25倒排索引...")
+            lexical_index = BM25Index.build(chunks.iter_texts())
+        store.lexical_index = lexical_index
+
+        applied_segment = chunks.applied_segment
+        for seq in cls._list_segments(path):
+            if seq > data['last_segment']:
+                store._apply_segment(cls._segment_path(path, seq), seq, apply_chunks=seq > applied_segment)
+                store._segment_seq = seq
+        if store._segment_seq > applied_segment:
+            chunks.commit(store._segment_seq)
+
+        for vector_id, refs in chunks.iter_refs():
+            for ref in refs:
+                store.metadata_index.add(vector_id, ref)
+
+        if not supports_remove(store.index):
+            store._tombstones = set(stored_ids(store.index).tolist()) - set(chunks.ids())
+
+        configured = os.getenv("VECTOR_INDEX_TYPE")
+        if configured and configured != store.index_spec['type']:
+            print(f"向量数据库使用已保存的索引类型 {store.index_spec['type']}（环境变量为 {configured}），"
+                  f"可通过 tune_index.py --apply 转换")
+        configured_storage = os.getenv("VECTOR_INDEX_STORAGE")
+        if configured_storage and configured_storage != store.index_spec['storage']:
+            print(f"向量数据库使用已保存的存储精度 {store.index_spec['storage']}（环境变量为 {configured_storage}），"
+                  f"可通过 bench_storage.py --apply 转换")
+
+        if legacy:
+            # 写入新格式的基础快照，旧快照（含docstore.json）随之删除
+            store.save_local(path)
+        return store
+
+
+def load_vector_store(path: str, embedding) -> Optional[LegalVectorStore]:
+    """加载向量存储，兼容旧版langchain FAISS格式（自动转换），路径不存在时返回None"""
+    if LegalVectorStore.exists(path):
+        return LegalVectorStore.load_local(path, embedding)
+
+    if os.path.exists(os.path.join(path, "index.faiss")) and os.path.exists(os.path.join(path, "index.pkl")):
+        from langchain_community.vectorstores.faiss import FAISS
+
+        print(f"检测到旧版向量数据库格式，正在转换: {path}")
+        legacy = FAISS.load_local(path, embedding, allow_dangerous_deserialization=True)
+        store = LegalVectorStore.from_langchain_faiss(legacy, embedding)
+        store.save_local(path)
+        os.remove(os.path.join(path, "index.faiss"))
+        os.remove(os.path.join(path, "index.pkl"))
+        return store
+
+    return None